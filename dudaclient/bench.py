@@ -0,0 +1,627 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# HTTP load generator
+# ===================
+# A single threaded HTTP/1.1 client driven by an epoll (or select) event
+# loop: every connection sends a request, waits for the full response and
+# sends the next one on the same connection (keep-alive).
+#
+# With a fixed rate the requests follows a schedule and the latency is
+# measured from the time the request should have been sent, so a stalled
+# server is not hidden by the client waiting for it (coordinated omission).
+
+import os
+import ssl
+import math
+import time
+import errno
+import socket
+import select
+import urlparse
+
+# Defaults
+BENCH_CONNECTIONS = 10
+BENCH_DURATION    = 10
+BENCH_TIMEOUT     = 10
+
+# Seconds to wait before connecting again after an error
+BENCH_RETRY = 0.05
+
+# Significant digits kept by the latency histogram
+BENCH_DIGITS = 3
+
+# Percentiles reported
+BENCH_PERCENTILES = [50, 90, 99, 99.9]
+
+EV_READ  = 1
+EV_WRITE = 2
+
+# Latency histogram with a fixed relative precision (HdrHistogram like).
+# Values are microseconds: below 2^bits they are exact, above that every
+# power of two range is split in 2^(bits - 1) buckets.
+class Histogram:
+    def __init__(self, digits=BENCH_DIGITS):
+        self.bits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.sum_sq = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        shift = max(0, value.bit_length() - self.bits)
+        return (shift, value >> shift)
+
+    # Highest value that belongs to a bucket
+    def value(self, bucket):
+        shift, sub = bucket
+        return ((sub + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        b = self.bucket(value)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.sum_sq += value * value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.total == 0:
+            return 0
+
+        target = max(1, int(math.ceil(p / 100.0 * self.total)))
+        count = 0
+        for b in sorted(self.counts.keys()):
+            count += self.counts[b]
+            if count >= target:
+                return min(self.value(b), self.max)
+
+        return self.max
+
+    def mean(self):
+        if self.total == 0:
+            return 0
+        return float(self.sum) / self.total
+
+    def stddev(self):
+        if self.total < 2:
+            return 0
+        var = (self.sum_sq - float(self.sum) * self.sum / self.total) / (self.total - 1)
+        return math.sqrt(max(0, var))
+
+    # Pairs of [value, count], enough to rebuild the distribution
+    def export(self):
+        return [[self.value(b), self.counts[b]] for b in sorted(self.counts.keys())]
+
+# epoll when available, select() otherwise
+class Poller:
+    def __init__(self):
+        self.fds = {}
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+
+    def set(self, fd, events):
+        if self.epoll is not None:
+            mask = 0
+            if events & EV_READ:
+                mask |= select.EPOLLIN
+            if events & EV_WRITE:
+                mask |= select.EPOLLOUT
+
+            if fd in self.fds:
+                self.epoll.modify(fd, mask)
+            else:
+                self.epoll.register(fd, mask)
+        self.fds[fd] = events
+
+    def remove(self, fd):
+        if fd not in self.fds:
+            return
+
+        del self.fds[fd]
+        if self.epoll is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError):
+                pass
+
+    # Return a list of (fd, readable, writable), errors are reported as
+    # both so the connection finds them on its next operation
+    def poll(self, timeout):
+        ret = []
+        if self.epoll is not None:
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    return ret
+                raise
+
+            for fd, mask in events:
+                err = mask & (select.EPOLLERR | select.EPOLLHUP)
+                ret.append((fd, (mask & select.EPOLLIN) or err,
+                            (mask & select.EPOLLOUT) or err))
+            return ret
+
+        rlist = [fd for fd, ev in self.fds.iteritems() if ev & EV_READ]
+        wlist = [fd for fd, ev in self.fds.iteritems() if ev & EV_WRITE]
+        if len(rlist) == 0 and len(wlist) == 0:
+            time.sleep(timeout)
+            return ret
+
+        try:
+            r, w, x = select.select(rlist, wlist, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return ret
+            raise
+
+        for fd in set(r) | set(w):
+            ret.append((fd, fd in r, fd in w))
+        return ret
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+class ConnectionError(Exception):
+    pass
+
+# A client connection, it runs one request at a time
+class Connection:
+    def __init__(self, bench):
+        self.bench = bench
+        self.sock = None
+        self.state = None
+        self.due = None
+        self.intended = None
+        self.sent_at = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def open(self):
+        b = self.bench
+        self.sock = socket.socket(b.family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        b.opened += 1
+
+        self.state = 'connect'
+        self.sent_at = time.time()
+        err = self.sock.connect_ex(b.addr)
+        if err not in [0, errno.EINPROGRESS]:
+            raise ConnectionError(os.strerror(err))
+
+        b.watch(self, EV_WRITE)
+
+    def close(self):
+        if self.sock is None:
+            return
+
+        self.bench.poller.remove(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+    def handle(self, readable, writable):
+        try:
+            if self.state == 'connect':
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise ConnectionError(os.strerror(err))
+
+                if self.bench.tls is True:
+                    self.sock = ssl.wrap_socket(self.sock, do_handshake_on_connect=False)
+                    self.state = 'handshake'
+                    self.handshake()
+                else:
+                    self.ready()
+            elif self.state == 'handshake':
+                self.handshake()
+            elif self.state == 'send':
+                self.write()
+            elif self.state == 'recv':
+                self.read()
+        except ConnectionError, e:
+            self.fail(str(e))
+        except ssl.SSLError, e:
+            self.fail('ssl: %s' % str(e))
+        except socket.error, e:
+            self.fail(os.strerror(e.args[0]))
+
+    # Run an SSL operation, it returns False if it must wait for the socket
+    def ssl_call(self, func, *args):
+        try:
+            return func(*args)
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.bench.watch(self, EV_READ)
+                return False
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.bench.watch(self, EV_WRITE)
+                return False
+            raise
+
+    def handshake(self):
+        if self.ssl_call(self.sock.do_handshake) is False:
+            return
+        self.ready()
+
+    # The connection can take a new request
+    def ready(self):
+        b = self.bench
+        slot = b.next_slot()
+        if slot is None:
+            self.close()
+            self.state = 'done'
+            return
+
+        if slot > time.time():
+            self.wait(slot, 'send')
+        else:
+            self.send(slot)
+
+    def wait(self, due, action):
+        self.state = 'wait'
+        self.due = due
+        self.action = action
+        if self.sock is not None:
+            self.bench.watch(self, 0)
+        self.bench.waiting.append(self)
+
+    # Called from the event loop once the due time is reached
+    def resume(self):
+        try:
+            if self.action == 'open':
+                self.open()
+            else:
+                self.send(self.due)
+        except ConnectionError, e:
+            self.fail(str(e))
+        except socket.error, e:
+            self.fail(os.strerror(e.args[0]))
+
+    def send(self, intended):
+        b = self.bench
+        self.intended = intended
+        self.sent_at = time.time()
+        self.out = b.request
+        self.buf = ''
+        self.headers = None
+        b.sent += 1
+        self.state = 'send'
+        self.write()
+
+    def write(self):
+        if self.bench.tls is True:
+            n = self.ssl_call(self.sock.send, self.out)
+            if n is False:
+                return
+        else:
+            try:
+                n = self.sock.send(self.out)
+            except socket.error, e:
+                if e.args[0] == errno.EAGAIN:
+                    self.bench.watch(self, EV_WRITE)
+                    return
+                raise
+
+        self.out = self.out[n:]
+        if len(self.out) > 0:
+            self.bench.watch(self, EV_WRITE)
+            return
+
+        self.state = 'recv'
+        self.bench.watch(self, EV_READ)
+
+    def read(self):
+        while True:
+            if self.bench.tls is True:
+                data = self.ssl_call(self.sock.recv, 65536)
+                if data is False:
+                    return
+            else:
+                try:
+                    data = self.sock.recv(65536)
+                except socket.error, e:
+                    if e.args[0] == errno.EAGAIN:
+                        self.bench.watch(self, EV_READ)
+                        return
+                    raise
+
+            if len(data) == 0:
+                # A response without length ends when the connection closes
+                if self.headers is not None and self.length is None and \
+                        self.chunked is False:
+                    self.complete(True)
+                    return
+                raise ConnectionError('connection closed')
+
+            self.buf += data
+            if self.parse() is True:
+                self.complete(self.keepalive is False)
+                return
+
+            if self.bench.tls is True and self.sock.pending() == 0:
+                self.bench.watch(self, EV_READ)
+                return
+
+    # Parse the response received so far, it returns True once it's
+    # complete
+    def parse(self):
+        if self.headers is None:
+            end = self.buf.find('\r\n\r\n')
+            if end < 0:
+                return False
+
+            lines = self.buf[:end].split('\r\n')
+            try:
+                self.status = int(lines[0].split()[1])
+            except (IndexError, ValueError):
+                raise ConnectionError('invalid response')
+
+            self.headers = {}
+            for line in lines[1:]:
+                k, sep, v = line.partition(':')
+                self.headers[k.strip().lower()] = v.strip()
+
+            self.body = end + 4
+            self.length = None
+            self.chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+            self.chunk = self.body
+            if 'content-length' in self.headers:
+                self.length = int(self.headers['content-length'])
+
+            conn = self.headers.get('connection', '').lower()
+            self.keepalive = self.bench.keepalive
+            if conn == 'close' or (lines[0].startswith('HTTP/1.0') and conn != 'keep-alive'):
+                self.keepalive = False
+
+            # Responses without body
+            if self.status == 204 or self.status == 304 or self.status < 200:
+                self.length = 0
+
+        if self.length is not None:
+            return len(self.buf) - self.body >= self.length
+
+        if self.chunked is False:
+            return False
+
+        while True:
+            eol = self.buf.find('\r\n', self.chunk)
+            if eol < 0:
+                return False
+
+            try:
+                size = int(self.buf[self.chunk:eol].split(';')[0], 16)
+            except ValueError:
+                raise ConnectionError('invalid chunk')
+
+            if size == 0:
+                # last chunk and optional trailers
+                return self.buf.find('\r\n\r\n', eol) >= 0 or \
+                    self.buf[eol:eol + 4] == '\r\n\r\n'
+
+            if len(self.buf) < eol + 2 + size + 2:
+                return False
+            self.chunk = eol + 2 + size + 2
+
+    def complete(self, close):
+        b = self.bench
+        b.record(time.time() - self.intended, self.status, len(self.buf))
+        if close is True:
+            self.close()
+            self.state = 'closed'
+            if b.next_slot(peek=True) is not None:
+                self.wait(time.time(), 'open')
+            return
+
+        self.ready()
+
+    def fail(self, reason):
+        b = self.bench
+        if self.state != 'wait':
+            b.error(reason)
+
+        self.close()
+        self.wait(time.time() + BENCH_RETRY, 'open')
+
+class Bench:
+    def __init__(self, url, connections=BENCH_CONNECTIONS, duration=BENCH_DURATION,
+                 rate=0, requests=0, keepalive=True, timeout=BENCH_TIMEOUT):
+        self.url = url
+        self.connections = connections
+        self.duration = duration
+        self.rate = rate
+        self.requests = requests
+        self.keepalive = keepalive
+        self.timeout = timeout
+
+        u = urlparse.urlparse(url)
+        if u.scheme not in ['http', 'https'] or u.hostname is None:
+            raise ValueError('invalid URL ' + url)
+
+        self.tls = u.scheme == 'https'
+        port = u.port
+        if port is None:
+            port = 443 if self.tls else 80
+
+        info = socket.getaddrinfo(u.hostname, port, 0, socket.SOCK_STREAM)[0]
+        self.family = info[0]
+        self.addr = info[4]
+
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+
+        self.request  = 'GET %s HTTP/1.1\r\n' % path
+        self.request += 'Host: %s\r\n' % u.netloc
+        self.request += 'User-Agent: dudac-bench\r\n'
+        if keepalive is False:
+            self.request += 'Connection: close\r\n'
+        self.request += '\r\n'
+
+    # Time to send the next request, None when there is nothing else to
+    # send. With 'peek' the request is not taken.
+    def next_slot(self, peek=False):
+        now = time.time()
+        if now >= self.end:
+            return None
+        if self.requests > 0 and self.sent >= self.requests:
+            return None
+
+        if self.rate <= 0:
+            return now
+
+        slot = self.start + self.scheduled / float(self.rate)
+        if peek is False:
+            self.scheduled += 1
+        return slot
+
+    def watch(self, conn, events):
+        fd = conn.fileno()
+        self.fds[fd] = conn
+        self.poller.set(fd, events)
+
+    def record(self, latency, status, size):
+        self.histogram.record(latency)
+        self.status[status] = self.status.get(status, 0) + 1
+        self.bytes += size
+        second = int(time.time() - self.start)
+        self.timeline[second] = self.timeline.get(second, 0) + 1
+
+    def error(self, reason):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def run(self):
+        self.histogram = Histogram()
+        self.status = {}
+        self.errors = {}
+        self.timeline = {}
+        self.bytes = 0
+        self.sent = 0
+        self.opened = 0
+        self.scheduled = 0
+        self.waiting = []
+        self.fds = {}
+        self.poller = Poller()
+
+        self.start = time.time()
+        self.end = self.start + self.duration
+        if self.duration <= 0:
+            self.end = float('inf')
+
+        conns = []
+        for i in range(self.connections):
+            c = Connection(self)
+            conns.append(c)
+            try:
+                c.open()
+            except (ConnectionError, socket.error), e:
+                c.fail(str(e))
+
+        while True:
+            now = time.time()
+            if now >= self.end:
+                break
+
+            active = [c for c in conns if c.state not in ['done', 'closed', 'wait']]
+            if len(active) == 0 and len(self.waiting) == 0:
+                break
+
+            timeout = min(0.1, self.end - now)
+            if len(self.waiting) > 0:
+                timeout = max(0, min(timeout, min([c.due for c in self.waiting]) - now))
+
+            for fd, readable, writable in self.poller.poll(timeout):
+                conn = self.fds.get(fd)
+                if conn is not None and conn.sock is not None:
+                    conn.handle(readable, writable)
+
+            now = time.time()
+            due = [c for c in self.waiting if c.due <= now]
+            self.waiting = [c for c in self.waiting if c.due > now]
+            for c in due:
+                c.resume()
+
+            # Requests taking too long
+            for c in conns:
+                if c.state in ['connect', 'handshake', 'send', 'recv'] and \
+                        now - c.sent_at > self.timeout:
+                    c.fail('timeout')
+
+        elapsed = time.time() - self.start
+        for c in conns:
+            c.close()
+        self.poller.close()
+
+        return self.results(elapsed)
+
+    def results(self, elapsed):
+        h = self.histogram
+        latency = {'min'   : (h.min or 0) / 1000.0,
+                   'mean'  : h.mean() / 1000.0,
+                   'stddev': h.stddev() / 1000.0,
+                   'max'   : (h.max or 0) / 1000.0}
+        for p in BENCH_PERCENTILES:
+            latency['p%s' % str(p).replace('.0', '')] = h.percentile(p) / 1000.0
+
+        seconds = int(elapsed)
+        timeline = [self.timeline.get(i, 0) for i in range(seconds)]
+
+        return {'url'        : self.url,
+                'connections': self.connections,
+                'duration'   : elapsed,
+                'rate'       : self.rate,
+                'keepalive'  : self.keepalive,
+                'requests'   : h.total,
+                'rps'        : h.total / max(elapsed, 0.001),
+                'bytes'      : self.bytes,
+                'connects'   : self.opened,
+                'status'     : dict([(str(k), v) for k, v in self.status.iteritems()]),
+                'errors'     : self.errors,
+                'latency'    : latency,
+                'timeline'   : timeline,
+                'histogram'  : h.export()}
+
+# Lines of the report of a result
+def report(r):
+    lat = r['latency']
+    lines = []
+    lines.append('%s' % r['url'])
+    lines.append('  %i requests in %.2fs, %.1f req/s, %.2f MB, %i connects' % \
+                     (r['requests'], r['duration'], r['rps'],
+                      r['bytes'] / 1048576.0, r['connects']))
+    lines.append('  latency ms: p50 %.3f  p90 %.3f  p99 %.3f  p99.9 %.3f  max %.3f' % \
+                     (lat['p50'], lat['p90'], lat['p99'], lat['p99.9'], lat['max']))
+
+    status = ', '.join(['%s: %i' % (k, v) for k, v in sorted(r['status'].items())])
+    if len(status) > 0:
+        lines.append('  status: ' + status)
+
+    errors = sum(r['errors'].values())
+    if errors > 0:
+        detail = ', '.join(['%s: %i' % (k, v) for k, v in sorted(r['errors'].items())])
+        lines.append('  errors: %i (%s)' % (errors, detail))
+
+    return lines
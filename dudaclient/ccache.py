@@ -0,0 +1,356 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Compiler cache
+# ==============
+# This file is used as a module by dudac and also as a wrapper around the
+# real compiler, e.g:
+#
+#    make CC='python2 /path/to/ccache.py gcc'
+#
+# Every object compiled with '-c' is stored under the cache directory using
+# a key composed by the compiler version, the command line arguments and the
+# preprocessed source. Anything else (linking, dependencies only, etc) is
+# passed to the compiler as is.
+
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+# Default cache size (MB)
+CCACHE_SIZE = 1024
+
+# Source files extensions we know how to cache
+CCACHE_SOURCES = ('.c', '.cc', '.cpp', '.cxx', '.S')
+
+# Options that takes the next argument as their value
+CCACHE_OPT_ARGS = ['-o', '-I', '-D', '-U', '-x', '-MF', '-MT', '-MQ',
+                   '-include', '-imacros', '-isystem', '-iquote',
+                   '-idirafter', '-Xpreprocessor', '-Xassembler', '-Xlinker']
+
+# Options not accepted by the compiler when preprocessing
+CCACHE_OPT_DEPS = ['-MD', '-MMD', '-MP']
+
+class CompilerCache:
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is None:
+            size = os.getenv('DUDAC_CCACHE_SIZE')
+
+        try:
+            self.size = int(size) * 1024 * 1024
+        except (TypeError, ValueError):
+            self.size = CCACHE_SIZE * 1024 * 1024
+
+    # The command that replaces $(CC) on the Makefiles
+    def wrapper(self, cc=None):
+        if cc is None:
+            cc = os.getenv('CC', 'gcc')
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ccache.py')
+        return "%s %s %s" % (sys.executable, script, cc)
+
+    def stats_file(self):
+        return os.path.join(self.path, 'stats')
+
+    def reset_stats(self):
+        self.mkdir(self.path)
+        f = open(self.stats_file(), 'w')
+        f.close()
+
+    # Return a tuple with the number of hits and misses since the last reset
+    def stats(self):
+        hits = 0
+        misses = 0
+        try:
+            f = open(self.stats_file(), 'r')
+        except IOError:
+            return (0, 0)
+
+        for line in f.readlines():
+            if line.startswith('h'):
+                hits += 1
+            elif line.startswith('m'):
+                misses += 1
+        f.close()
+
+        return (hits, misses)
+
+    # Many compilers runs at the same time, every record is a single
+    # write() in append mode
+    def record(self, hit):
+        try:
+            fd = os.open(self.stats_file(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        except OSError:
+            return
+
+        if hit is True:
+            os.write(fd, 'h\n')
+        else:
+            os.write(fd, 'm\n')
+        os.close(fd)
+
+    def mkdir(self, path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def which(self, cc):
+        if os.path.sep in cc:
+            return os.path.abspath(cc)
+
+        for p in os.getenv('PATH', '').split(os.pathsep):
+            f = os.path.join(p, cc)
+            if os.path.isfile(f) and os.access(f, os.X_OK):
+                return f
+
+        return cc
+
+    # The compiler identity is the output of 'cc -v', it's cached by the
+    # compiler binary path, size and modification time
+    def compiler_id(self, cc):
+        path = self.which(cc)
+        try:
+            st = os.stat(path)
+            stamp = '%s:%i:%i' % (path, st.st_size, st.st_mtime)
+        except OSError:
+            stamp = path
+
+        cdir = os.path.join(self.path, 'compilers')
+        cfile = os.path.join(cdir, hashlib.sha1(stamp).hexdigest())
+        if os.path.isfile(cfile):
+            f = open(cfile, 'r')
+            cid = f.read()
+            f.close()
+            return cid
+
+        p = subprocess.Popen([cc, '-v'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        cid = hashlib.sha1(stamp + '\n' + out).hexdigest()
+
+        self.mkdir(cdir)
+        self.write_atomic(cfile, cid)
+        return cid
+
+    def write_atomic(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp, path)
+
+    def copy_atomic(self, src, dst):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst))
+        os.close(fd)
+        shutil.copyfile(src, tmp)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, dst)
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    # Parse the compiler arguments, it returns a dictionary with the source
+    # file, object and dependency file, or None if the command is not a
+    # single source compilation
+    def parse(self, args):
+        source = None
+        output = None
+        depfile = None
+        deps = False
+        compile = False
+        pp = []
+
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a in CCACHE_OPT_ARGS:
+                if i + 1 >= len(args):
+                    return None
+                v = args[i + 1]
+                if a == '-o':
+                    output = v
+                elif a == '-MF':
+                    depfile = v
+                elif not a.startswith('-M'):
+                    pp += [a, v]
+                i += 2
+                continue
+
+            if a == '-c':
+                compile = True
+            elif a in ['-E', '-M', '-MM', '-S', '-']:
+                return None
+            elif a in CCACHE_OPT_DEPS:
+                deps = True
+            elif a.startswith('-'):
+                pp.append(a)
+            elif a.endswith(CCACHE_SOURCES):
+                if source is not None:
+                    return None
+                source = a
+            else:
+                # object files or libraries, this is not a compilation
+                return None
+            i += 1
+
+        if compile is False or source is None:
+            return None
+
+        if output is None:
+            output = os.path.splitext(os.path.basename(source))[0] + '.o'
+
+        if deps is True and depfile is None:
+            depfile = os.path.splitext(output)[0] + '.d'
+
+        return {'source': source, 'output': output, 'depfile': depfile,
+                'pp': pp}
+
+    # Compose the cache key for a compilation, None if the source cannot
+    # be preprocessed (the compiler will report the error)
+    def key(self, cc, args, info):
+        h = hashlib.sha1()
+        h.update(self.compiler_id(cc) + '\n')
+        h.update('\0'.join(args) + '\n')
+
+        # Debug information contains the working directory
+        if '-g' in args or any(a.startswith('-g') for a in args):
+            h.update(os.getcwd() + '\n')
+
+        p = subprocess.Popen([cc] + info['pp'] + ['-E', info['source']],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            return None
+
+        h.update(out)
+        return h.hexdigest()
+
+    # Run a compiler command, use the cache when possible
+    def compile(self, argv):
+        cc = argv[0]
+        args = argv[1:]
+
+        info = self.parse(args)
+        if info is None:
+            return subprocess.call(argv)
+
+        key = self.key(cc, args, info)
+        if key is None:
+            return subprocess.call(argv)
+
+        entry = self.entry(key)
+        if os.path.isfile(entry + '.o'):
+            try:
+                self.copy_atomic(entry + '.o', info['output'])
+                if info['depfile'] is not None:
+                    self.copy_atomic(entry + '.d', info['depfile'])
+
+                if os.path.isfile(entry + '.err'):
+                    f = open(entry + '.err', 'r')
+                    sys.stderr.write(f.read())
+                    f.close()
+
+                # Refresh the entry for the LRU eviction
+                os.utime(entry + '.o', None)
+                self.record(True)
+                return 0
+            except (IOError, OSError):
+                pass
+
+        p = subprocess.Popen(argv, stderr=subprocess.PIPE)
+        err = p.communicate()[1]
+        sys.stderr.write(err)
+        if p.returncode != 0:
+            return p.returncode
+
+        # Store the results, the object goes at the end as it's what
+        # flags the entry as valid
+        try:
+            self.mkdir(os.path.dirname(entry))
+            if info['depfile'] is not None:
+                self.copy_atomic(info['depfile'], entry + '.d')
+            if len(err) > 0:
+                self.write_atomic(entry + '.err', err)
+            self.copy_atomic(info['output'], entry + '.o')
+        except (IOError, OSError):
+            pass
+
+        self.record(False)
+        return 0
+
+    # Remove the least recently used entries until the cache fits in
+    # the configured size
+    def evict(self):
+        entries = []
+        total = 0
+        if not os.path.isdir(self.path):
+            return
+
+        for d in os.listdir(self.path):
+            p = os.path.join(self.path, d)
+            if len(d) != 2 or not os.path.isdir(p):
+                continue
+
+            for name in os.listdir(p):
+                if not name.endswith('.o'):
+                    continue
+
+                base = os.path.join(p, name[:-2])
+                size = 0
+                for ext in ['.o', '.d', '.err']:
+                    try:
+                        size += os.path.getsize(base + ext)
+                    except OSError:
+                        pass
+
+                entries.append((os.path.getmtime(base + '.o'), size, base))
+                total += size
+
+        entries.sort()
+        for last, size, base in entries:
+            if total <= self.size:
+                break
+
+            # the object goes first, the entry is invalid without it
+            for ext in ['.o', '.d', '.err']:
+                try:
+                    os.unlink(base + ext)
+                except OSError:
+                    pass
+            total -= size
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: ccache.py COMPILER [ARGS]\n")
+        return 1
+
+    path = os.getenv('DUDAC_CCACHE_DIR')
+    if path is None:
+        return subprocess.call(sys.argv[1:])
+
+    cache = CompilerCache(path)
+    return cache.compile(sys.argv[1:])
+
+if __name__ == '__main__':
+    sys.exit(main())
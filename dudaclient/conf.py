@@ -0,0 +1,138 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Stage configuration
+# ===================
+# The Monkey configuration of the stage is edited on memory: every file is
+# read once when it's first used, all the changes are applied to its lines
+# and at the end each file is written once, only if its content changed.
+
+import os
+
+from utils import *
+
+# Indentation used by the Monkey configuration keys
+CONF_INDENT = '    '
+
+class ConfigFile:
+    def __init__(self, path):
+        self.path = path
+        self.original = None
+        self.lines = []
+
+        if os.path.isfile(path):
+            f = open(path, 'r')
+            self.original = f.read()
+            f.close()
+            self.lines = self.original.splitlines(True)
+
+    def content(self):
+        return ''.join(self.lines)
+
+    # A file that does not exist is only changed if it gets some content
+    def changed(self):
+        if self.original is None:
+            return len(self.lines) > 0
+        return self.content() != self.original
+
+    # Replace every line that starts with the prefix, returns the number of
+    # lines replaced
+    def replace(self, prefix, line):
+        count = 0
+        for i in range(len(self.lines)):
+            if self.lines[i].startswith(prefix):
+                self.lines[i] = line
+                count += 1
+
+        return count
+
+    # Drop everything from the first line that starts with the prefix
+    def truncate(self, prefix):
+        for i in range(len(self.lines)):
+            if self.lines[i].startswith(prefix):
+                del self.lines[i:]
+                return
+
+    def append(self, raw):
+        self.lines += raw.splitlines(True)
+
+    # Return the value of the first 'Key value' entry found, or None
+    def value(self, key):
+        for line in self.lines:
+            arr = line.split()
+            if len(arr) == 2 and arr[0] == key:
+                return arr[1]
+
+        return None
+
+    def set(self, raw):
+        self.lines = raw.splitlines(True)
+
+    def write(self):
+        if self.changed() is False:
+            return False
+
+        content = self.content()
+        write_if_changed(self.path, content, self.original)
+        self.original = content
+        return True
+
+class ConfigTree:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+
+    # Files are relative to the configuration directory of the stage
+    def get(self, name):
+        if name not in self.files:
+            self.files[name] = ConfigFile(os.path.join(self.path, name))
+
+        return self.files[name]
+
+    # Load a plugin on plugins.load, it uncomment the entry or adds a new one.
+    # The entry always points to the plugin of this stage, a stage seeded
+    # from another one still have the paths of the old one.
+    def enable_plugin(self, stage, name):
+        plugins = self.get('plugins.load')
+        plugin = 'monkey-%s.so' % (name)
+        entry = CONF_INDENT + 'Load %s/plugins/%s/%s\n' % (stage.rstrip('/'), name, plugin)
+
+        matched = False
+        for i in range(len(plugins.lines)):
+            line = plugins.lines[i]
+            if not line.strip().endswith(plugin):
+                continue
+
+            if line.startswith(CONF_INDENT + '# Load') or \
+                    line.startswith(CONF_INDENT + 'Load'):
+                plugins.lines[i] = entry
+                matched = True
+
+        if matched is False:
+            raw  = '\n'
+            raw += CONF_INDENT + '# Enabled by DudaC\n'
+            raw += CONF_INDENT + '# ================\n'
+            raw += entry
+            plugins.append(raw)
+
+    # Write the files that changed, returns the list of names written
+    def flush(self):
+        written = []
+        for name in sorted(self.files.keys()):
+            if self.files[name].write() is True:
+                written.append(name)
+
+        return written
@@ -0,0 +1,385 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# CPU profiles
+# ============
+# The running server is profiled with 'perf record -g' while a benchmark
+# runs. If perf is not available (or not allowed) the threads of the server
+# are sampled through /proc instead: it can not unwind the stacks, it only
+# tells what every thread is doing (running, or the system call and the
+# user function where it is blocked), but it needs nothing installed.
+#
+# The stacks are collapsed in the 'frame;frame;frame count' format and
+# rendered as a SVG flame graph, or a differential one between two
+# profiles.
+
+import os
+import re
+import time
+import zlib
+import signal
+import threading
+import commands
+import subprocess
+import heapprof
+
+from utils import *
+
+# Samples per second taken by perf
+CPUPROF_FREQUENCY = 99
+
+# Samples per second taken by the /proc sampler
+CPUPROF_SAMPLER_FREQUENCY = 49
+
+# Seconds perf gets to attach to the process
+CPUPROF_START = 0.5
+
+# Flame graph geometry
+FLAME_WIDTH = 1200
+FLAME_FRAME = 16
+FLAME_FONT = 12
+FLAME_MIN_WIDTH = 0.1
+
+# System calls names (x86_64) shown by the /proc sampler
+SYSCALLS_X86_64 = {0: 'read', 1: 'write', 7: 'poll', 20: 'writev', 23: 'select',
+                   35: 'nanosleep', 40: 'sendfile', 44: 'sendto', 45: 'recvfrom',
+                   202: 'futex', 230: 'clock_nanosleep', 232: 'epoll_wait',
+                   270: 'pselect6', 271: 'ppoll', 281: 'epoll_pwait', 288: 'accept4',
+                   43: 'accept', 17: 'pread64', 18: 'pwrite64', 441: 'epoll_pwait2'}
+
+# Profile with perf, it writes the samples to 'path' and collapses them
+# once stopped
+class PerfProfiler:
+    method = 'perf'
+
+    def __init__(self, pid, path, frequency=CPUPROF_FREQUENCY):
+        self.pid = pid
+        self.data = path + '.data'
+        self.frequency = frequency
+        self.process = None
+        self.log = None
+
+    def start(self):
+        self.log = open(self.data + '.log', 'w')
+        cmd = ['perf', 'record', '-g', '-F', str(self.frequency),
+               '-p', str(self.pid), '-o', self.data]
+        try:
+            self.process = subprocess.Popen(cmd, stdout=self.log,
+                                            stderr=subprocess.STDOUT)
+        except OSError:
+            self.log.close()
+            return False
+
+        # perf exits right away if it cannot attach
+        time.sleep(CPUPROF_START)
+        if self.process.poll() is not None:
+            self.log.close()
+            return False
+
+        return True
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+        self.process.wait()
+        self.log.close()
+
+        p = subprocess.Popen(['perf', 'script', '-i', self.data],
+                             stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        stacks = collapse_perf(p.stdout)
+        p.wait()
+        return stacks
+
+# Collapse the output of 'perf script': a header line for each sample and
+# its frames, the leaf first, until a blank line
+def collapse_perf(lines):
+    stacks = {}
+    comm = None
+    frames = []
+
+    for line in lines:
+        line = line.rstrip('\n')
+        if len(line) == 0:
+            if comm is not None:
+                frames.reverse()
+                key = ';'.join([comm] + frames)
+                stacks[key] = stacks.get(key, 0) + 1
+            comm = None
+            frames = []
+            continue
+
+        if line[0] not in ' \t':
+            m = re.match(r'^(.+?)\s+\d+(/\d+)?\s', line)
+            if m is not None:
+                comm = m.group(1).strip()
+            continue
+
+        m = re.match(r'^\s+[0-9a-f]+\s+(.+?)\s+\((.*)\)$', line)
+        if m is None:
+            continue
+
+        sym = re.sub(r'\+0x[0-9a-f]+$', '', m.group(1))
+        if sym == '[unknown]':
+            sym = '[%s]' % os.path.basename(m.group(2))
+        frames.append(sym.replace(';', ':'))
+
+    if comm is not None:
+        frames.reverse()
+        key = ';'.join([comm] + frames)
+        stacks[key] = stacks.get(key, 0) + 1
+
+    return stacks
+
+# Sample the threads state through /proc, a wall clock profile
+class ProcSampler:
+    method = 'proc'
+
+    def __init__(self, pid, path, frequency=CPUPROF_SAMPLER_FREQUENCY):
+        self.pid = pid
+        self.frequency = frequency
+        self.samples = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.syscalls = {}
+        if os.uname()[4] == 'x86_64':
+            self.syscalls = SYSCALLS_X86_64
+
+    def start(self):
+        if os.path.isdir('/proc/%i/task' % self.pid) is False:
+            return False
+
+        self.thread.start()
+        return True
+
+    def read(self, path):
+        try:
+            f = open(path, 'r')
+            data = f.read().strip()
+            f.close()
+        except IOError:
+            return None
+        return data
+
+    # Thread name, state, system call, program counter and kernel function
+    # of a thread
+    def sample(self, tid):
+        task = '/proc/%i/task/%s/' % (self.pid, tid)
+        stat = self.read(task + 'stat')
+        if stat is None:
+            return None
+
+        comm = stat[stat.find('(') + 1:stat.rfind(')')]
+        state = stat[stat.rfind(')') + 2:].split(' ')[0]
+        if state == 'R':
+            return (comm, None, None, None)
+
+        syscall = None
+        pc = None
+        info = self.read(task + 'syscall')
+        if info is not None and info != 'running':
+            arr = info.split()
+            if len(arr) > 2 and arr[0] != '-1':
+                syscall = self.syscalls.get(int(arr[0]), 'syscall_%s' % arr[0])
+                pc = int(arr[-1], 16)
+
+        wchan = self.read(task + 'wchan')
+        if wchan in ['0', '']:
+            wchan = None
+
+        return (comm, syscall, pc, wchan)
+
+    def run(self):
+        interval = 1.0 / self.frequency
+        while self.done.is_set() is False:
+            try:
+                tasks = os.listdir('/proc/%i/task' % self.pid)
+            except OSError:
+                return
+
+            for tid in tasks:
+                s = self.sample(tid)
+                if s is not None:
+                    self.samples[s] = self.samples.get(s, 0) + 1
+
+            self.done.wait(interval)
+
+    def stop(self):
+        self.done.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        maps = []
+        data = self.read('/proc/%i/maps' % self.pid)
+        if data is not None:
+            maps = heapprof.maps(data.split('\n'))
+
+        sym = heapprof.Symbolizer()
+        sym.lookup(maps, set([s[2] for s in self.samples if s[2] is not None]))
+
+        stacks = {}
+        for (comm, syscall, pc, wchan), count in self.samples.iteritems():
+            frames = [comm]
+            if syscall is None and pc is None and wchan is None:
+                frames.append('[running]')
+            if pc is not None:
+                frames.append(sym.name(maps, pc))
+            if syscall is not None:
+                frames.append('[sys] ' + syscall)
+            if wchan is not None:
+                frames.append('[k] ' + wchan)
+
+            key = ';'.join([f.replace(';', ':') for f in frames])
+            stacks[key] = stacks.get(key, 0) + count
+
+        return stacks
+
+# Attach the best profiler available to a process, None if none works
+def profiler(pid, path):
+    if commands.getstatusoutput('perf --version')[0] == 0:
+        p = PerfProfiler(pid, path)
+        if p.start() is True:
+            return p
+
+    p = ProcSampler(pid, path)
+    if p.start() is True:
+        return p
+
+    return None
+
+def save(path, stacks):
+    f = open(path, 'w')
+    for key in sorted(stacks.keys()):
+        f.write('%s %i\n' % (key, stacks[key]))
+    f.close()
+
+def load(path):
+    stacks = {}
+    f = open(path, 'r')
+    for line in f:
+        key, sep, count = line.rstrip('\n').rpartition(' ')
+        if len(key) > 0 and count.isdigit():
+            stacks[key] = stacks.get(key, 0) + int(count)
+    f.close()
+
+    return stacks
+
+# Tree of frames, every node is [samples, {name: node}]
+def tree(stacks):
+    root = [0, {}]
+    for key, count in stacks.iteritems():
+        node = root
+        node[0] += count
+        for frame in key.split(';'):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+
+    return root
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+# Warm colors, stable for every frame name
+def color(name):
+    h = zlib.crc32(name) & 0xffffffff
+    return 'rgb(%i,%i,%i)' % (205 + h % 50, 60 + (h >> 8) % 170, (h >> 16) % 55)
+
+# Red frames grew, blue ones shrunk, the stronger the more they changed
+def diff_color(change, scale):
+    if scale <= 0 or change == 0:
+        return 'rgb(220,220,220)'
+
+    v = int(200 * min(1.0, abs(change) / scale))
+    if change > 0:
+        return 'rgb(255,%i,%i)' % (220 - v, 220 - v)
+    return 'rgb(%i,%i,255)' % (220 - v, 220 - v)
+
+# Render the flame graph of 'stacks' as a SVG document. With 'base' it's a
+# differential flame graph: the frames are those of 'stacks', colored by
+# the change of their share of samples from 'base'.
+def flamegraph(stacks, title, base=None):
+    root = tree(stacks)
+    total = max(1, root[0])
+    scale = float(FLAME_WIDTH - 20) / total
+
+    base_root = None
+    max_change = 0.0
+    if base is not None:
+        base_root = tree(base)
+
+    # lay out the frames first, the depth sets the height of the graph
+    frames = []
+    pending = [(root, base_root, 10.0, 0)]
+    while len(pending) > 0:
+        node, bnode, x, depth = pending.pop()
+        for name in sorted(node[1].keys()):
+            child = node[1][name]
+            width = child[0] * scale
+            if width < FLAME_MIN_WIDTH:
+                x += width
+                continue
+
+            bchild = None
+            change = None
+            if base_root is not None:
+                if bnode is not None:
+                    bchild = bnode[1].get(name)
+                before = 0.0
+                if bchild is not None:
+                    before = bchild[0] * 100.0 / max(1, base_root[0])
+                change = child[0] * 100.0 / total - before
+                max_change = max(max_change, abs(change))
+
+            frames.append((name, child[0], x, width, depth, change))
+            pending.append((child, bchild, x, depth + 1))
+            x += width
+
+    depth = max([f[4] for f in frames] + [0]) + 1
+    height = depth * FLAME_FRAME + 60
+
+    out = []
+    out.append('<?xml version="1.0" standalone="no"?>')
+    out.append('<svg version="1.1" width="%i" height="%i" '
+               'xmlns="http://www.w3.org/2000/svg">' % (FLAME_WIDTH, height))
+    out.append('<rect x="0" y="0" width="%i" height="%i" fill="rgb(248,248,248)"/>' % \
+                   (FLAME_WIDTH, height))
+    out.append('<text x="%i" y="24" font-size="17" font-family="Verdana" '
+               'text-anchor="middle">%s</text>' % (FLAME_WIDTH / 2, escape(title)))
+
+    for name, count, x, width, d, change in frames:
+        y = height - 20 - (d + 1) * FLAME_FRAME
+        info = '%s (%i samples, %.2f%%)' % (name, count, count * 100.0 / total)
+        if change is None:
+            fill = color(name)
+        else:
+            fill = diff_color(change, max_change)
+            info += ' %+.2f%%' % change
+
+        label = ''
+        chars = int(width / (FLAME_FONT * 0.6))
+        if chars >= 3:
+            label = name
+            if len(name) > chars:
+                label = name[:chars - 2] + '..'
+
+        out.append('<g><title>%s</title><rect x="%.1f" y="%i" width="%.1f" '
+                   'height="%i" fill="%s" rx="2" ry="2"/><text x="%.1f" y="%i" '
+                   'font-size="%i" font-family="Verdana">%s</text></g>' % \
+                       (escape(info), x, y, width, FLAME_FRAME - 1, fill,
+                        x + 3, y + FLAME_FRAME - 4, FLAME_FONT, escape(label)))
+
+    out.append('</svg>')
+    return '\n'.join(out) + '\n'
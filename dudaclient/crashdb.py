@@ -0,0 +1,278 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Crash database
+# ==============
+# Every crash is stored on DUDAC_HOME/crashes.db (SQLite). A crash is
+# normalized into a signature: the signal and the top frames of the
+# crashing thread, without addresses, arguments or the frames of the
+# signal delivery and abort(). The frames come from gdb or, without a core
+# dump, from the '[stack trace]' Monkey prints when it gets the signal; a
+# crash with no frames at all is stored without signature. Crashes with
+# the same signature are counted together, and every occurrence keeps the
+# stack build it happened on, the fingerprint of the functions of all its
+# threads, the server output and gdb report.
+
+import re
+import time
+import sqlite3
+import hashlib
+
+# Frames that makes a signature
+CRASHDB_FRAMES = 5
+
+# Frames of the signal delivery and abort(), they say nothing about the
+# crash itself
+CRASHDB_SKIP = re.compile(r'^(__GI_|__pthread_kill|pthread_kill|raise|abort|'
+                          r'__assert_fail|__libc_message|__fortify_fail|'
+                          r'__stack_chk_fail|__kernel_vsyscall|'
+                          r'__restore_rt|_sigtramp)')
+
+CRASHDB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS signatures (
+    signature  TEXT PRIMARY KEY,
+    signal     TEXT,
+    frames     TEXT,
+    count      INTEGER,
+    first_seen REAL,
+    last_seen  REAL
+);
+
+CREATE TABLE IF NOT EXISTS crashes (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    signature   TEXT REFERENCES signatures(signature),
+    stack       TEXT,
+    fingerprint TEXT,
+    time        REAL,
+    pid         INTEGER,
+    command     TEXT,
+    core        TEXT,
+    log         TEXT,
+    output      TEXT,
+    backtrace   TEXT
+);
+
+CREATE INDEX IF NOT EXISTS crashes_signature ON crashes(signature);
+CREATE INDEX IF NOT EXISTS crashes_stack ON crashes(stack, signature);
+CREATE INDEX IF NOT EXISTS signatures_count ON signatures(count);
+'''
+
+# '#3  0x00007f in mk_http_send (cs=0x1, sr=...) at mk_http.c:120' or
+# '#0  mk_http_send (...) at mk_http.c:120', and from Monkey itself
+# '#1  0x00007f in mk_http_send() from /usr/lib/libmonkey.so'
+FRAME = re.compile(r'^#\d+\s+(?:0x[0-9a-f]+ in )?(.+?)(?: \(.*\))?(?: (?:at|from) (\S+))?$')
+
+# A frame that is only an address
+RAW_ADDRESS = re.compile(r'^0x[0-9a-fA-F]+$')
+
+# Printed by Monkey before the backtrace of the crashing thread, it's
+# taken from its signal handler
+STACK_TRACE = '[stack trace]'
+STACK_HANDLER = 'mk_signal_handler'
+
+# Function name of a backtrace line, None if it's not a frame
+def frame_name(line):
+    line = line.strip()
+    if not line.startswith('#'):
+        return None
+
+    if line.find('<signal handler called>') > 0:
+        return '<signal handler called>'
+
+    m = FRAME.match(line)
+    if m is None:
+        return None
+
+    name = m.group(1).split(' ')[0]
+    if name.endswith('()'):
+        name = name[:-2]
+    if name.strip('?') == '':
+        name = '??'
+    return name
+
+# Function names of the crashing thread backtrace, the innermost first
+def frames(backtrace):
+    ret = []
+    for line in backtrace.split('\n'):
+        name = frame_name(line)
+        if name is None:
+            # the backtrace of the crashing thread is the first one
+            if len(ret) > 0 and line.strip().startswith('Thread '):
+                break
+            continue
+        ret.append(name)
+
+    return ret
+
+# Function names of the '[stack trace]' of the server output, the signal
+# handler and the signal return frame after it are replaced as gdb does
+def output_frames(output):
+    pos = output.rfind(STACK_TRACE)
+    if pos < 0:
+        return []
+
+    ret = []
+    trampoline = False
+    for line in output[pos + len(STACK_TRACE):].strip().split('\n'):
+        name = frame_name(line)
+        if name is None:
+            break
+        if trampoline is True:
+            trampoline = False
+            continue
+
+        if name == STACK_HANDLER:
+            ret = ['<signal handler called>']
+            trampoline = True
+            continue
+        ret.append(name)
+
+    return ret
+
+# Fingerprint of the whole backtrace: the function names of every thread
+def fingerprint(backtrace):
+    names = []
+    for line in backtrace.split('\n'):
+        if line.strip().startswith('Thread '):
+            names.append('--')
+            continue
+        name = frame_name(line)
+        if name is not None:
+            names.append(name)
+
+    return digest(names)[:16]
+
+# The frames that identify the crash: what comes after the signal
+# delivery, without the abort() and assert() machinery. Frames without
+# symbol are dropped, they depend on the debug symbols at hand and on
+# where the backtrace comes from.
+def top_frames(names, count=CRASHDB_FRAMES):
+    if '<signal handler called>' in names:
+        names = names[names.index('<signal handler called>') + 1:]
+
+    names = [n for n in names if CRASHDB_SKIP.match(n) is None and
+             n != '??' and RAW_ADDRESS.match(n) is None]
+    return names[:count]
+
+def digest(values):
+    return hashlib.sha1('\n'.join(values)).hexdigest()
+
+class CrashDB:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(CRASHDB_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    # Store a crash, it returns its id, its signature and how many times
+    # it has been seen. Without frames the signature is None.
+    def add(self, sig, stack, pid, command, core, log, output, backtrace):
+        top = []
+        fprint = None
+        if backtrace is not None:
+            top = top_frames(frames(backtrace))
+            fprint = fingerprint(backtrace)
+
+        # no core dump or gdb could not read it, Monkey only tells the
+        # crashing thread
+        if len(top) == 0:
+            names = output_frames(output)
+            top = top_frames(names)
+            if len(top) > 0:
+                fprint = digest(names)[:16]
+
+        signature = None
+        if len(top) > 0:
+            signature = digest([sig] + top)[:16]
+        now = time.time()
+
+        c = self.db.cursor()
+        if signature is not None:
+            c.execute('UPDATE signatures SET count = count + 1, last_seen = ? '
+                      'WHERE signature = ?', (now, signature))
+            if c.rowcount == 0:
+                c.execute('INSERT INTO signatures VALUES (?, ?, ?, 1, ?, ?)',
+                          (signature, sig, '\n'.join(top), now, now))
+
+        c.execute('INSERT INTO crashes (signature, stack, fingerprint, time, pid, '
+                  'command, core, log, output, backtrace) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                  (signature, stack, fprint, now, pid, command, core,
+                   log, unicode(output, 'utf-8', 'replace'),
+                   None if backtrace is None else unicode(backtrace, 'utf-8', 'replace')))
+        crash_id = c.lastrowid
+        self.db.commit()
+
+        if signature is None:
+            return (crash_id, None, 0)
+
+        count = c.execute('SELECT count FROM signatures WHERE signature = ?',
+                          (signature,)).fetchone()[0]
+        return (crash_id, signature, count)
+
+    # The backtrace of a crash, once all the threads are analyzed
+    def update(self, crash_id, backtrace):
+        self.db.execute('UPDATE crashes SET backtrace = ?, fingerprint = ? '
+                        'WHERE id = ?', (unicode(backtrace, 'utf-8', 'replace'),
+                                         fingerprint(backtrace), crash_id))
+        self.db.commit()
+
+    # Signatures by frequency for every stack build
+    def top(self, stack=None, limit=10):
+        query = 'SELECT c.stack, c.signature, s.signal, s.frames, COUNT(*) AS count, ' \
+                'MIN(c.time) AS first_seen, MAX(c.time) AS last_seen, ' \
+                'COUNT(DISTINCT c.fingerprint) AS fingerprints ' \
+                'FROM crashes c JOIN signatures s ON s.signature = c.signature '
+        args = []
+        if stack is not None:
+            query += 'WHERE c.stack LIKE ? '
+            args.append(stack + '%')
+        query += 'GROUP BY c.stack, c.signature ORDER BY c.stack, count DESC'
+
+        ret = {}
+        for row in self.db.execute(query, args):
+            rows = ret.setdefault(row['stack'], [])
+            if len(rows) < limit:
+                rows.append(row)
+
+        return ret
+
+    # Crashes stored without signature for every stack build
+    def unsigned(self, stack=None):
+        query = 'SELECT stack, COUNT(*) AS count FROM crashes WHERE signature IS NULL '
+        args = []
+        if stack is not None:
+            query += 'AND stack LIKE ? '
+            args.append(stack + '%')
+        query += 'GROUP BY stack'
+
+        ret = {}
+        for row in self.db.execute(query, args):
+            ret[row['stack']] = row['count']
+
+        return ret
+
+    def signature(self, key):
+        return self.db.execute('SELECT * FROM signatures WHERE signature LIKE ?',
+                               (key + '%',)).fetchall()
+
+    def crashes(self, signature, limit=10):
+        return self.db.execute('SELECT * FROM crashes WHERE signature = ? '
+                               'ORDER BY time DESC LIMIT ?',
+                               (signature, limit)).fetchall()
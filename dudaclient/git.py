@@ -15,8 +15,10 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import re
 import sys
 import shutil
+import hashlib
 import commands
 
 from utils import *
@@ -24,6 +26,27 @@ from utils import *
 PROTOCOL_HTTPS = 0
 PROTOCOL_GIT   = 1
 
+# Partial clones (--filter=blob:none) are reliable since GIT 2.22
+GIT_PARTIAL_CLONE = (2, 22)
+
+# Cached GIT version
+git_version_info = None
+
+def git_version():
+    global git_version_info
+
+    if git_version_info is None:
+        git_version_info = (0, 0)
+        ret = commands.getstatusoutput('git --version')
+        if ret[0] == 0:
+            try:
+                v = ret[1].split()[2].split('.')
+                git_version_info = (int(v[0]), int(v[1]))
+            except (IndexError, ValueError):
+                pass
+
+    return git_version_info
+
 class GitProject(object):
     # Project and repository details
     project_name = None
@@ -36,10 +59,20 @@ class GitProject(object):
     recent_master   = False
     recent_snapshot = False
 
-    def __init__(self, project_name, https_repo, git_repo):
+    # Directory where the bare mirrors of every upstream are stored
+    mirrors_path = None
+
+    # Checked out tree of the current version, see snapshot()
+    _tree = None
+
+    # Commit pinned by a lock file, it's trusted as the version head
+    pinned = None
+
+    def __init__(self, project_name, https_repo, git_repo, mirrors_path=None):
         self.project_name = project_name
         self.https_repo = https_repo
         self.git_repo   = git_repo
+        self.mirrors_path = mirrors_path
 
     def set_protocol(self, protocol):
         if protocol == PROTOCOL_HTTPS:
@@ -58,21 +91,88 @@ class GitProject(object):
             self.git_repo = git_repo
 
     def clone(self, to):
-        cmd = "git clone " + self.protocol + " " + to
-        execute("%s: cloning source code" % (self.project_name), cmd)
+        header, cmd, cwd = self.fetch_job(to)
+        execute(header, cmd)
 
     def update(self, to):
         if self.recent_update is True:
             return
 
-        self.master()
-
+        header, cmd, cwd = self.fetch_job(to)
         cpath = os.getcwd()
-        os.chdir(to)
-        cmd = "git pull"
-        execute("GIT %-8s: updating" % (self.project_name), cmd)
+        os.chdir(cwd)
+        execute(header, cmd)
         os.chdir(cpath)
 
+        self.fetched()
+
+    # Every upstream have a persistent bare mirror, the sources in the home
+    # directory are cloned from it
+    def mirror(self):
+        if self.mirrors_path is None:
+            return None
+
+        h = hashlib.sha1(self.protocol).hexdigest()[:8]
+        name = '%s-%s.git' % (self.project_name.lower(), h)
+        return os.path.join(self.mirrors_path, name)
+
+    # Command to create or refresh the mirror from the upstream repository
+    def mirror_cmd(self):
+        mirror = self.mirror()
+        if os.path.exists(mirror) is False:
+            cmd  = "git clone --progress --mirror %s %s && " % (self.protocol, mirror)
+            cmd += "git --git-dir=%s config uploadpack.allowFilter true && " % mirror
+            cmd += "git --git-dir=%s config uploadpack.allowAnySHA1InWant true" % mirror
+            return cmd
+
+        return "git --git-dir=%s fetch --progress --prune origin" % (mirror)
+
+    # The mirror as the source for the local clones. Partial clones needs
+    # the file:// transport, otherwise a plain path makes GIT do a local
+    # copy of the objects.
+    def mirror_url(self):
+        if git_version() >= GIT_PARTIAL_CLONE:
+            return "file://" + self.mirror()
+
+        return self.mirror()
+
+    # Command to clone the sources from the mirror: the history comes as a
+    # local copy and, if GIT supports it, the file contents are only fetched
+    # when a version is checked out
+    def mirror_clone_cmd(self, to):
+        if git_version() >= GIT_PARTIAL_CLONE:
+            return "git clone --progress --filter=blob:none %s %s" % (self.mirror_url(), to)
+
+        return "git clone --progress %s %s" % (self.mirror_url(), to)
+
+    # Compose the job that clones or updates the sources, it's a tuple
+    # with the header, the command and the working directory, as expected
+    # by execute_many(). Nothing here changes the process state, so jobs
+    # of different projects can run at the same time.
+    def fetch_job(self, to):
+        mirror = self.mirror()
+        if mirror is None:
+            if os.path.exists(to) is False:
+                cmd = "git clone --progress %s %s" % (self.protocol, to)
+                return ("%s: cloning source code" % (self.project_name), cmd, None)
+
+            cmd = "git checkout master && git pull --progress"
+            return ("GIT %-8s: updating" % (self.project_name), cmd, to)
+
+        cmd = self.mirror_cmd()
+        if os.path.exists(to) is False:
+            cmd += " && " + self.mirror_clone_cmd(to)
+            return ("%s: cloning source code" % (self.project_name), cmd, None)
+
+        # Sources cloned from the upstream before mirrors were used are
+        # switched to the mirror
+        cmd += " && git remote set-url origin %s" % (self.mirror_url())
+        cmd += " && git checkout master && git pull --progress"
+        return ("GIT %-8s: updating" % (self.project_name), cmd, to)
+
+    # Flag the sources as updated once a fetch job finished
+    def fetched(self):
+        self.recent_master = True
         self.recent_update = True
 
     def remove(self, path):
@@ -80,6 +180,7 @@ class GitProject(object):
         print "[+] Deleting %s code..." % (self.project_name),
         try:
                 shutil.rmtree(path)
+                shutil.rmtree(self.worktrees_path(), True)
                 print "\t[OK]"
         except:
                 print "\t[FAILED]"
@@ -112,26 +213,215 @@ class GitProject(object):
 
         self.recent_master = True
 
+    # The directory that holds the checked out sources
+    def tree(self):
+        if self._tree is not None:
+            return self._tree
+
+        return self.home()
+
+    # Every version is checked out once in its own worktree, they are
+    # stored next to the home directory
+    def worktrees_path(self):
+        return os.path.normpath(self.home()) + '.worktrees'
+
+    def worktree(self):
+        name = re.sub('[^A-Za-z0-9._-]', '_', self.version)
+        return os.path.join(self.worktrees_path(), name)
+
+    # Read the commit a worktree points to, no need to fork GIT for this
+    def worktree_head(self, path):
+        try:
+            f = open(os.path.join(path, '.git'), 'r')
+            gitdir = f.read().strip()
+            f.close()
+
+            if gitdir.startswith('gitdir:') is False:
+                return None
+
+            f = open(os.path.join(gitdir[7:].strip(), 'HEAD'), 'r')
+            head = f.read().strip()
+            f.close()
+        except IOError:
+            return None
+
+        return head
+
+    # The manifest keeps the state of the files synced to a target path,
+    # every entry maps the file path to a tuple of GIT mode, blob hash, and
+    # the size and modification time the file got on the target.
+    def manifest_path(self, path):
+        return os.path.join(path, '.dudac-manifest')
+
+    def manifest_read(self, path):
+        entries = {}
+        try:
+            f = open(self.manifest_path(path), 'r')
+        except IOError:
+            return entries
+
+        for line in f.readlines():
+            arr = line.rstrip('\n').split(' ', 4)
+            if len(arr) != 5:
+                continue
+            entries[arr[4]] = (arr[0], arr[1], arr[2], arr[3])
+        f.close()
+
+        return entries
+
+    def manifest_write(self, path, entries):
+        raw = ''
+        for name in sorted(entries.keys()):
+            e = entries[name]
+            raw += '%s %s %s %s %s\n' % (e[0], e[1], e[2], e[3], name)
+
+        tmp = self.manifest_path(path) + '.tmp'
+        f = open(tmp, 'w')
+        f.write(raw)
+        f.close()
+        os.rename(tmp, self.manifest_path(path))
+
+    # List the files of the checked out tree as a dictionary of path:(mode, hash)
+    def tree_files(self):
+        cmd = 'cd %s && git ls-files -s -z' % (self.tree())
+        ret = commands.getstatusoutput(cmd)
+        if ret[0] != 0:
+            return None
+
+        files = {}
+        for entry in ret[1].split('\0'):
+            if len(entry) == 0:
+                continue
+
+            info, name = entry.split('\t', 1)
+            mode, blob, stage = info.split()
+
+            # Submodules are not part of the tree
+            if mode == '160000':
+                continue
+            files[name] = (mode, blob)
+
+        return files
+
+    # Sync the checked out sources into the target path. Only the files
+    # which differs from what the target holds are written, files that are
+    # not longer part of the sources are removed, the rest keeps their
+    # modification time so make do not consider them outdated.
     def archive_to(self, path):
-        cmd =  'git checkout-index -a -f --prefix=%s/' % (path)
+        header = '%-12s: sync' % ('GIT %s' % self.project_name)
+        src = self.tree()
 
-        if self.version:
-            v = self.version
-            if v.startswith('commit') or v.startswith('tag') or v.startswith('branch'):
-                arr = v.split('@')
-                cmd = 'git checkout %s' % (arr[1])
+        files = self.tree_files()
+        if files is None:
+            print_msg(header, 0)
+            sys.exit(1)
 
-        cpath = os.getcwd()
-        os.chdir(self.home())
-        execute('%-12s: archive' % ('GIT %s' % self.project_name), cmd)
+        prev = self.manifest_read(path)
+        entries = {}
+        updated = 0
+        removed = 0
+
+        for name, info in files.iteritems():
+            mode, blob = info
+            dst = os.path.join(path, name)
+
+            # Skip files that are the same blob and were not touched
+            old = prev.get(name)
+            if old is not None and old[0] == mode and old[1] == blob:
+                try:
+                    st = os.lstat(dst)
+                    if '%i' % st.st_size == old[2] and '%i' % st.st_mtime == old[3]:
+                        entries[name] = old
+                        continue
+                except OSError:
+                    pass
+
+            parent = os.path.dirname(dst)
+            if os.path.isdir(parent) is False:
+                os.makedirs(parent)
+
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+
+            if mode == '120000':
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                os.symlink(os.readlink(os.path.join(src, name)), dst)
+            else:
+                if os.path.islink(dst):
+                    os.unlink(dst)
+                clone_file(os.path.join(src, name), dst)
+                if mode == '100755':
+                    os.chmod(dst, 0755)
+                else:
+                    os.chmod(dst, 0644)
+
+            st = os.lstat(dst)
+            entries[name] = (mode, blob, '%i' % st.st_size, '%i' % st.st_mtime)
+            updated += 1
+
+        # Remove files that do not longer exists in the sources
+        for name in prev.keys():
+            if name in files:
+                continue
+
+            dst = os.path.join(path, name)
+            if os.path.lexists(dst) and not os.path.isdir(dst):
+                os.unlink(dst)
+                removed += 1
+
+            # and the directories that became empty
+            parent = os.path.dirname(dst)
+            while os.path.normpath(parent) != os.path.normpath(path):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+
+        self.manifest_write(path, entries)
+        print_msg('%s (%i updated, %i removed)' % (header, updated, removed), 1)
+
+    # Translate the 'version' key into a GIT reference
+    def reference(self):
+        v = self.version
+        if v.startswith('commit@') or v.startswith('tag@') or v.startswith('branch@'):
+            return v.split('@', 1)[1]
+
+        return v
+
+    # Return the commit hash the version points to. Branches are taken
+    # from the remote as local branches are not updated, then tags and
+    # commits are looked up.
+    def head(self):
+        if self.pinned is not None:
+            return self.pinned
 
-    def check_reference(self, ref):
-        cmd = 'git show-ref %s' % ref
+        home = self.home()
+        if home is None or os.path.exists(home) is False:
+            return None
+
+        ref = self.reference()
+        cmd = "cd %s && (git rev-parse -q --verify 'origin/%s^{commit}' || " \
+              "git rev-parse -q --verify '%s^{commit}')" % (home, ref, ref)
+        ret = commands.getstatusoutput(cmd)
+        if ret[0] != 0:
+            return None
+
+        return ret[1].strip()
+
+    # List the files that changed between two commits, None if the
+    # difference cannot be determined
+    def changed_files(self, old, new):
+        if old is None or new is None or old == 'None':
+            return None
+
+        cmd = "cd %s && git diff --name-only %s %s" % (self.home(), old, new)
         ret = commands.getstatusoutput(cmd)
-        if os.WEXITSTATUS(ret[0]) == 0:
-            return True
+        if ret[0] != 0:
+            return None
 
-        return False
+        return [l for l in ret[1].split('\n') if len(l) > 0]
 
     # A snapshot takes the value of the 'version' key and set the GIT repository
     # to the specified point, a few examples:
@@ -141,23 +431,39 @@ class GitProject(object):
     #    version = branch@my_devel_branch
     #    version = tag@v1.5
     #
+    # Each version lives in its own worktree: it's created the first time
+    # the version is requested and reused afterwards, it only moves when the
+    # version points to a different commit (e.g: a branch after an update).
+    # The home repository is never switched, so local changes are safe.
     def snapshot(self):
         if self.recent_snapshot is True:
             return
 
-        cmd = 'git checkout %s' % (self.version)
-        cpath = os.getcwd()
-        os.chdir(self.home())
-
         # Validate GIT reference
-        ref = self.check_reference(self.version)
-        if ref is False:
+        commit = self.head()
+        if commit is None:
             fail_msg("Error: invalid API level, aborting.")
             sys.exit(1)
 
-        cmd = 'git stash && git checkout master && %s' % (cmd)
         ghead = 'GIT %s' % self.project_name
-        execute("%-12s: switch HEAD to '%s'" % (ghead, self.version), cmd)
-        os.chdir(cpath)
-
+        wt = self.worktree()
+        if os.path.exists(wt) is False:
+            if self.pinned is not None:
+                cmd = "cd %s && git cat-file -e '%s^{commit}'" % (self.home(), commit)
+                if commands.getstatusoutput(cmd)[0] != 0:
+                    fail_msg("Error: %s commit %s pinned by dudac.lock is " \
+                             "not available, try: \n\n    $ dudac -s\n" \
+                             % (self.project_name, commit[:12]))
+                    sys.exit(1)
+
+            cmd  = 'cd %s && git worktree prune && ' % (self.home())
+            cmd += 'git worktree add --detach %s %s' % (wt, commit)
+            execute("%-12s: new worktree for '%s'" % (ghead, self.version), cmd)
+        elif self.worktree_head(wt) != commit:
+            cmd = 'cd %s && git checkout -q --detach %s' % (wt, commit)
+            execute("%-12s: move worktree '%s'" % (ghead, self.version), cmd)
+        else:
+            print_msg("%-12s: worktree '%s' (cached)" % (ghead, self.version), True)
+
+        self._tree = wt
         self.recent_snapshot = True
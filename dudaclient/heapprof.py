@@ -0,0 +1,397 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Jemalloc heap profiles
+# ======================
+# With -J every server instance writes its heap profiles into its own run
+# directory under DUDAC_HOME/jeprof/. The dumps (heap_v2 and the older
+# pprof compatible format) are parsed, the stacks are symbolized with
+# addr2line using the mappings stored at the end of each dump, and the
+# allocation sites are ranked by the memory still alive (leaks) or by the
+# memory growth between two dumps.
+
+import os
+import re
+import glob
+import math
+import struct
+import threading
+import subprocess
+
+from utils import *
+
+# Seconds between the dumps requested to the running server through gdb,
+# 0 disables: the server is stopped on every request and the call can
+# block on the jemalloc locks. The final dump is written at exit anyway.
+HEAPPROF_INTERVAL = 0
+
+# Allocation sites shown on the reports
+HEAPPROF_TOP = 15
+
+# Frames that belongs to the allocator or its wrappers, the allocation site
+# is the first frame that is not one of these
+HEAPPROF_ALLOC = re.compile(r'^(je_|prof_|imalloc|ialloc|iralloc|arena_|tcache_|'
+                            r'huge_|malloc|calloc|realloc|posix_memalign|'
+                            r'aligned_alloc|valloc|memalign|mk_mem_|__libc_|'
+                            r'operator new)')
+
+# Libraries of the allocator, their frames are skipped even without symbols
+HEAPPROF_ALLOC_LIBS = re.compile(r'^libjemalloc')
+
+# ELF types
+ET_EXEC = 2
+ET_DYN  = 3
+
+class Profile:
+    def __init__(self, path):
+        self.path = path
+        self.sample = 0
+        self.stacks = {}
+        self.maps = []
+
+    # Returns (live objects, live bytes, total objects, total bytes) of
+    # a stack, adjusted by the sampling rate like jeprof does
+    def unsample(self, counts):
+        if self.sample <= 0:
+            return counts
+
+        ret = []
+        for objs, size in [(counts[0], counts[1]), (counts[2], counts[3])]:
+            if objs > 0 and size > 0:
+                scale = 1.0 / (1.0 - math.exp(-(float(size) / objs) / self.sample))
+                ret += [objs * scale, size * scale]
+            else:
+                ret += [objs, size]
+
+        return ret
+
+    def add(self, stack, counts):
+        counts = self.unsample(counts)
+        prev = self.stacks.get(stack, [0, 0, 0, 0])
+        self.stacks[stack] = [prev[i] + counts[i] for i in range(4)]
+
+# Parse memory mappings in the /proc/PID/maps format, as (start, end,
+# permissions, offset, path)
+def maps(lines):
+    ret = []
+    for line in lines:
+        m = re.match(r'^([0-9a-f]+)-([0-9a-f]+)\s+(\S+)\s+([0-9a-f]+)\s+\S+\s+\d+\s*(.*)$', line)
+        if m is not None:
+            ret.append((int(m.group(1), 16), int(m.group(2), 16),
+                        m.group(3), int(m.group(4), 16), m.group(5).strip()))
+    return ret
+
+# Parse a heap profile, both the heap_v2 format and the older one
+def parse(path):
+    prof = Profile(path)
+    f = open(path, 'r')
+    lines = f.readlines()
+    f.close()
+
+    stack = None
+    mapped = False
+    for line in lines:
+        line = line.rstrip('\n')
+        if mapped is True:
+            prof.maps += maps([line])
+            continue
+
+        if line.startswith('MAPPED_LIBRARIES:'):
+            mapped = True
+            continue
+
+        # heap_v2/524288
+        m = re.match(r'^heap_v2/(\d+)', line)
+        if m is not None:
+            prof.sample = int(m.group(1))
+            continue
+
+        # heap profile: 1: 2 [ 0: 0] @ heap_v2/524288
+        if line.startswith('heap profile:'):
+            m = re.search(r'heap_v2/(\d+)', line)
+            if m is not None:
+                prof.sample = int(m.group(1))
+            continue
+
+        # heap_v2: '@ 0x1 0x2' followed by '  t*: objs: bytes [objs: bytes]'
+        if line.startswith('@ '):
+            stack = tuple([int(a, 16) for a in line[2:].split()])
+            continue
+
+        m = re.match(r'^\s*t\*:\s*(\d+):\s*(\d+)\s*\[\s*(\d+):\s*(\d+)\s*\]', line)
+        if m is not None:
+            if stack is not None:
+                prof.add(stack, [int(v) for v in m.groups()])
+                stack = None
+            continue
+
+        # older format: 'objs: bytes [objs: bytes] @ 0x1 0x2'
+        m = re.match(r'^\s*(\d+):\s*(\d+)\s*\[\s*(\d+):\s*(\d+)\s*\]\s*@(.*)$', line)
+        if m is not None:
+            stack = tuple([int(a, 16) for a in m.group(5).split()])
+            prof.add(stack, [int(v) for v in m.groups()[:4]])
+            stack = None
+
+    return prof
+
+def elf_type(path):
+    try:
+        f = open(path, 'rb')
+        header = f.read(18)
+        f.close()
+    except IOError:
+        return None
+
+    if len(header) < 18 or header[:4] != '\x7fELF':
+        return None
+
+    # e_type follows the 16 bytes of e_ident, endianness is on EI_DATA
+    if header[5] == '\x02':
+        return struct.unpack('>H', header[16:18])[0]
+    return struct.unpack('<H', header[16:18])[0]
+
+# Resolve addresses to 'function file:line' with addr2line, results are
+# cached by object file and address
+class Symbolizer:
+    def __init__(self):
+        self.cache = {}
+        self.types = {}
+
+    # Object file and the address to look up on it
+    def locate(self, maps, addr):
+        for start, end, perms, offset, path in maps:
+            if addr < start or addr >= end or len(path) == 0 or path.startswith('['):
+                continue
+
+            if path not in self.types:
+                self.types[path] = elf_type(path)
+
+            # executables are linked at their final address, shared objects
+            # (and PIE) are relative to the place they were mapped
+            if self.types[path] == ET_EXEC:
+                return (path, addr)
+            return (path, addr - start + offset)
+
+        return (None, addr)
+
+    def resolve(self, prof):
+        addrs = set()
+        for stack in prof.stacks:
+            for i, addr in enumerate(stack):
+                # return addresses points after the call instruction
+                if i > 0:
+                    addr -= 1
+                addrs.add(addr)
+
+        self.lookup(prof.maps, addrs)
+
+    # Run addr2line once per object file for the addresses not cached yet
+    def lookup(self, maps, addrs):
+        wanted = {}
+        for addr in addrs:
+            path, rel = self.locate(maps, addr)
+            if path is None or (path, rel) in self.cache:
+                continue
+            wanted.setdefault(path, set()).add(rel)
+
+        for path, addrs in wanted.iteritems():
+            addrs = sorted(addrs)
+            cmd = ['addr2line', '-C', '-f', '-e', path] + ['0x%x' % a for a in addrs]
+            try:
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out = p.communicate()[0].split('\n')
+            except OSError:
+                out = []
+
+            for i, a in enumerate(addrs):
+                func = '??'
+                where = '??:0'
+                if len(out) > i * 2 + 1:
+                    func = out[i * 2]
+                    where = out[i * 2 + 1]
+                if func == '??':
+                    func = '%s+0x%x' % (os.path.basename(path), a)
+                self.cache[(path, a)] = (func, os.path.basename(where.split(' ')[0]))
+
+    # Function name of an address looked up before
+    def name(self, maps, addr):
+        path, rel = self.locate(maps, addr)
+        if path is None:
+            return '0x%x' % addr
+        return self.cache.get((path, rel), ('0x%x' % addr, ''))[0]
+
+    # Function, source file and object file of an address
+    def frame(self, prof, addr, caller=True):
+        if caller is True:
+            addr -= 1
+        path, rel = self.locate(prof.maps, addr)
+        if path is None:
+            return ('0x%x' % addr, '??', '')
+        func, where = self.cache.get((path, rel), ('0x%x' % addr, '??'))
+        return (func, where, os.path.basename(path))
+
+    def allocator(self, frame):
+        return HEAPPROF_ALLOC.match(frame[0]) is not None or \
+            HEAPPROF_ALLOC_LIBS.match(frame[2]) is not None
+
+    # The allocation site of a stack: the first frame out of the allocator
+    # and its caller
+    def site(self, prof, stack):
+        frames = [self.frame(prof, a, i > 0) for i, a in enumerate(stack)]
+        for i, f in enumerate(frames):
+            if self.allocator(f) is False:
+                site = '%s (%s)' % f[:2]
+                if i + 1 < len(frames):
+                    site += ' <- %s' % frames[i + 1][0]
+                return site
+
+        if len(frames) > 0:
+            return '%s (%s)' % frames[0][:2]
+        return '??'
+
+# Group the stacks of a profile by allocation site
+def sites(prof, symbolizer):
+    symbolizer.resolve(prof)
+    ret = {}
+    for stack, counts in prof.stacks.iteritems():
+        s = symbolizer.site(prof, stack)
+        prev = ret.get(s, [0, 0, 0, 0])
+        ret[s] = [prev[i] + counts[i] for i in range(4)]
+
+    return ret
+
+def size(value):
+    if abs(value) >= 1048576:
+        return '%.1fM' % (value / 1048576.0)
+    if abs(value) >= 1024:
+        return '%.1fK' % (value / 1024.0)
+    return '%i' % value
+
+# Sites ranked by the memory alive when the dump was taken, on the final
+# dump that is what leaked
+def report(prof, symbolizer=None, top=HEAPPROF_TOP):
+    if symbolizer is None:
+        symbolizer = Symbolizer()
+
+    data = sites(prof, symbolizer)
+    live = sum([c[1] for c in data.values()])
+    total = sum([c[3] for c in data.values()])
+
+    lines = ['%s live in %i sites, %s allocated in total' % \
+                 (size(live), len(data), size(total))]
+    lines.append('%10s %8s %10s  %s' % ('live', 'objects', 'total', 'site'))
+    ranked = sorted(data.items(), key=lambda i: (i[1][1], i[1][3]), reverse=True)
+    for s, c in ranked[:top]:
+        lines.append('%10s %8i %10s  %s' % (size(c[1]), c[0], size(c[3]), s))
+
+    return lines
+
+# Sites ranked by the growth of live memory between two dumps
+def diff(old, new, symbolizer=None, top=HEAPPROF_TOP):
+    if symbolizer is None:
+        symbolizer = Symbolizer()
+
+    a = sites(old, symbolizer)
+    b = sites(new, symbolizer)
+
+    growth = {}
+    for s in set(a.keys()) | set(b.keys()):
+        ca = a.get(s, [0, 0, 0, 0])
+        cb = b.get(s, [0, 0, 0, 0])
+        growth[s] = (cb[1] - ca[1], cb[0] - ca[0])
+
+    total = sum([g[0] for g in growth.values()])
+    lines = ['%s -> %s: %s live memory growth' % \
+                 (os.path.basename(old.path), os.path.basename(new.path), size(total))]
+    lines.append('%10s %8s  %s' % ('growth', 'objects', 'site'))
+    ranked = sorted(growth.items(), key=lambda i: i[1][0], reverse=True)
+    for s, g in ranked[:top]:
+        if g[0] == 0:
+            break
+        lines.append('%10s %+8i  %s' % (size(g[0]), g[1], s))
+
+    return lines
+
+# Dumps of a run directory, in the order they were written
+def dumps(path):
+    files = glob.glob(os.path.join(path, '*.heap'))
+    files.sort(key=lambda f: os.path.getmtime(f))
+    return files
+
+# Server probe for -J
+class Probe:
+    def __init__(self, path, interval=None):
+        self.path = path
+        if interval is None:
+            try:
+                interval = int(os.getenv('DUDAC_JEPROF_INTERVAL', HEAPPROF_INTERVAL))
+            except ValueError:
+                interval = HEAPPROF_INTERVAL
+        self.interval = interval
+        self.run_path = None
+        self.done = None
+
+    # Every instance writes its dumps in its own directory
+    def attach(self, server):
+        self.run_path = run_directory(self.path)
+
+        opts = [o for o in os.getenv('JE_MALLOC_CONF', '').split(',')
+                if len(o) > 0 and o.split(':')[0] not in
+                ['prof_prefix', 'prof_final', 'prof_accum']]
+        opts += ['prof_final:true', 'prof_accum:true',
+                 'prof_prefix:' + os.path.join(self.run_path, 'duda.jeprof')]
+        server.env['JE_MALLOC_CONF'] = ','.join(opts)
+
+    def started(self, server):
+        self.done = threading.Event()
+        if self.interval <= 0:
+            return
+
+        t = threading.Thread(target=self.sampler, args=(server, self.done))
+        t.daemon = True
+        t.start()
+
+    # Ask the server for a dump through the prof.dump mallctl
+    def sampler(self, server, done):
+        while True:
+            done.wait(self.interval)
+            if done.is_set() or server.running() is False:
+                return
+
+            ret = gdb_call(server.pid(), '(int) je_mallctl("prof.dump", 0, 0, 0, 0)')
+            if ret is None:
+                fail_msg("Error: heap profile request did not return in %is" % \
+                             GDB_CALL_TIMEOUT)
+                return
+            if ret[0] != 0 or ret[1].find('No symbol') >= 0:
+                fail_msg("Error: cannot request a heap profile through gdb")
+                return
+
+    def finished(self, server):
+        self.done.set()
+
+        files = dumps(self.run_path)
+        if len(files) == 0:
+            return
+
+        print_info("HEAP        : %i profiles at %s" % (len(files), self.run_path))
+        try:
+            sym = Symbolizer()
+            last = parse(files[-1])
+            for line in report(last, sym, 5):
+                print "    " + line
+        except (IOError, OSError, ValueError):
+            fail_msg("Error: cannot parse the heap profile " + files[-1])
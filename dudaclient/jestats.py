@@ -0,0 +1,359 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Jemalloc statistics
+# ===================
+# With -X the server runs with JE_MALLOC_CONF=stats_print:true, jemalloc
+# prints its statistics on exit. If DUDAC_JEMALLOC_INTERVAL is set, dudac
+# also asks for a dump from time to time calling je_malloc_stats_print()
+# through gdb: the server is stopped while gdb is attached, and the call
+# can block if it was interrupted inside jemalloc, so it's off by default
+# and bounded by GDB_CALL_TIMEOUT. Every dump found on the server output is
+# parsed and appended to a JSON lines file.
+
+import os
+import re
+import json
+import time
+import threading
+
+from utils import *
+
+# Seconds between dumps requested to the running server, 0 disables
+JESTATS_INTERVAL = 0
+
+# Size classes shown on the report
+JESTATS_TOP = 10
+
+JESTATS_BEGIN = '___ Begin jemalloc statistics ___'
+JESTATS_END   = '--- End jemalloc statistics ---'
+
+# Symbol names, Monkey builds jemalloc with the je_ prefix
+JESTATS_SYMBOLS = ['je_malloc_stats_print', 'malloc_stats_print']
+
+def number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+# Parse the lines of a malloc_stats_print() dump
+def parse(lines):
+    snap = {'version': None, 'global': {}, 'arenas': {}}
+    arena = None
+    table = None
+    header = []
+
+    for line in lines:
+        s = line.strip()
+        row = s.split()
+
+        if s.startswith('Version:'):
+            snap['version'] = s.split(':', 1)[1].strip()
+            continue
+        elif s.startswith('Allocated:'):
+            for k, v in re.findall(r'([A-Za-z_]+): (\d+)', s):
+                snap['global'][k.lower()] = int(v)
+            continue
+
+        m = re.match(r'^(arenas\[(\d+)\]|Merged arenas stats):', s)
+        if m is not None:
+            name = m.group(2)
+            if name is None:
+                name = 'merged'
+            arena = {'bins': []}
+            snap['arenas'][name] = arena
+            table = None
+            continue
+
+        if arena is None:
+            continue
+
+        # The tables columns are taken from their header
+        if s.startswith('bins:'):
+            header = s[5:].split()
+            table = 'bins'
+            continue
+        elif s.startswith('large:') and len(row) > 1 and not row[1].isdigit():
+            table = 'large'
+            continue
+
+        if table is not None:
+            if len(row) > 0 and row[0].isdigit():
+                if table == 'bins':
+                    b = {}
+                    for k, v in zip(header, row):
+                        b[k] = number(v)
+                    arena['bins'].append(b)
+                continue
+            elif s.startswith('[') or s.startswith('---'):
+                continue
+            table = None
+
+        m = re.match(r'^(small|large|huge|total|active|mapped|resident|retained|metadata):\s+(\d+)', s)
+        if m is not None:
+            arena[m.group(1)] = int(m.group(2))
+
+    return snap
+
+# Allocated bytes of an arena
+def arena_allocated(a):
+    if 'total' in a:
+        return a['total']
+    return a.get('small', 0) + a.get('large', 0) + a.get('huge', 0)
+
+def fragmentation(allocated, active):
+    if active is None or active == 0:
+        return None
+    return 1.0 - float(allocated) / active
+
+# Size class summary: bytes allocated and how full its runs (slabs) are
+def bin_summary(b):
+    size = b.get('size', 0)
+    allocated = b.get('allocated', 0)
+    util = b.get('util')
+    if not isinstance(util, float):
+        util = None
+        runs = b.get('curruns', b.get('curslabs'))
+        if runs and b.get('regs') and size:
+            util = float(allocated) / (runs * b['regs'] * size)
+
+    return {'size'     : size,
+            'allocated': allocated,
+            'nmalloc'  : b.get('nmalloc', 0),
+            'ndalloc'  : b.get('ndalloc', 0),
+            'util'     : util}
+
+# Compose the structured record of a dump
+def summarize(snap):
+    g = snap['global']
+    record = {'version': snap['version'],
+              'global' : {'allocated': g.get('allocated'),
+                          'active'   : g.get('active'),
+                          'resident' : g.get('resident'),
+                          'mapped'   : g.get('mapped'),
+                          'metadata' : g.get('metadata'),
+                          'fragmentation': fragmentation(g.get('allocated', 0),
+                                                         g.get('active'))},
+              'arenas' : {}}
+
+    for name, a in snap['arenas'].iteritems():
+        allocated = arena_allocated(a)
+        record['arenas'][name] = {'allocated': allocated,
+                                  'active'   : a.get('active'),
+                                  'resident' : a.get('resident'),
+                                  'mapped'   : a.get('mapped'),
+                                  'fragmentation': fragmentation(allocated, a.get('active')),
+                                  'bins'     : [bin_summary(b) for b in a['bins']]}
+
+    return record
+
+def size(value):
+    if value is None:
+        return '-'
+    if value >= 1048576:
+        return '%.1fM' % (value / 1048576.0)
+    if value >= 1024:
+        return '%.1fK' % (value / 1024.0)
+    return '%i' % value
+
+def percent(value):
+    if value is None:
+        return '-'
+    return '%.1f%%' % (value * 100)
+
+# Report lines of a record
+def report(record, top=JESTATS_TOP):
+    g = record['global']
+    lines = []
+    lines.append('allocated %s, active %s, resident %s, mapped %s, fragmentation %s' % \
+                     (size(g['allocated']), size(g['active']), size(g['resident']),
+                      size(g['mapped']), percent(g['fragmentation'])))
+
+    lines.append('%-8s %10s %10s %10s %10s %6s' % \
+                     ('arena', 'allocated', 'active', 'resident', 'mapped', 'frag'))
+    for name in sorted(record['arenas'].keys()):
+        a = record['arenas'][name]
+        lines.append('%-8s %10s %10s %10s %10s %6s' % \
+                         (name, size(a['allocated']), size(a['active']),
+                          size(a['resident']), size(a['mapped']),
+                          percent(a['fragmentation'])))
+
+    # size classes of all the arenas, the merged stats are used only if
+    # jemalloc did not print each arena
+    arenas = record['arenas'].keys()
+    if len(arenas) > 1:
+        arenas = [a for a in arenas if a != 'merged']
+
+    bins = {}
+    for name in arenas:
+        a = record['arenas'][name]
+        for b in a['bins']:
+            entry = bins.setdefault(b['size'], {'allocated': 0, 'nmalloc': 0,
+                                                'ndalloc': 0, 'util': []})
+            entry['allocated'] += b['allocated']
+            entry['nmalloc'] += b['nmalloc']
+            entry['ndalloc'] += b['ndalloc']
+            if b['util'] is not None:
+                entry['util'].append(b['util'])
+
+    if len(bins) > 0:
+        lines.append('%-8s %10s %10s %10s %6s' % \
+                         ('size', 'allocated', 'nmalloc', 'ndalloc', 'util'))
+        ranked = sorted(bins.items(), key=lambda i: i[1]['allocated'], reverse=True)
+        for s, b in ranked[:top]:
+            util = None
+            if len(b['util']) > 0:
+                util = sum(b['util']) / len(b['util'])
+            lines.append('%-8s %10s %10i %10i %6s' % \
+                             (s, size(b['allocated']), b['nmalloc'], b['ndalloc'],
+                              percent(util)))
+
+    return lines
+
+# Collect the dumps from the server output
+class Collector:
+    def __init__(self, path):
+        self.path = path
+        self.lines = None
+        self.requested = 0
+        self.records = []
+        self.lock = threading.Lock()
+
+    def feed(self, line):
+        if line.find(JESTATS_BEGIN) >= 0:
+            self.lines = []
+            return
+
+        if self.lines is None:
+            return
+
+        if line.find(JESTATS_END) < 0:
+            self.lines.append(line)
+            return
+
+        record = summarize(parse(self.lines))
+        self.lines = None
+
+        self.lock.acquire()
+        if self.requested > 0:
+            self.requested -= 1
+            record['kind'] = 'periodic'
+        else:
+            record['kind'] = 'exit'
+        self.lock.release()
+
+        record['time'] = time.time()
+        self.records.append(record)
+        self.save(record)
+
+    def save(self, record):
+        if os.path.isdir(os.path.dirname(self.path)) is False:
+            os.makedirs(os.path.dirname(self.path))
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.write(fd, json.dumps(record, sort_keys=True) + '\n')
+        os.close(fd)
+
+    # Ask the process for a dump, the output arrives through feed()
+    def request(self, pid):
+        for symbol in JESTATS_SYMBOLS:
+            self.lock.acquire()
+            self.requested += 1
+            self.lock.release()
+
+            ret = gdb_call(pid, '(void) %s(0, 0, 0)' % symbol)
+            if ret is None:
+                fail_msg("Error: jemalloc statistics call did not return in %is" % \
+                             GDB_CALL_TIMEOUT)
+                self.lock.acquire()
+                self.requested -= 1
+                self.lock.release()
+                return False
+
+            if ret[0] == 0 and ret[1].find('No symbol') < 0:
+                return True
+
+            self.lock.acquire()
+            self.requested -= 1
+            self.lock.release()
+
+        return False
+
+# Request dumps periodically while the server runs
+class Sampler:
+    def __init__(self, collector, server, interval=JESTATS_INTERVAL):
+        self.collector = collector
+        self.server = server
+        self.interval = interval
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.interval > 0:
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.done.wait(self.interval)
+            if self.done.is_set() or self.server.running() is False:
+                return
+
+            if self.collector.request(self.server.pid()) is False:
+                fail_msg("Error: cannot get jemalloc statistics through gdb")
+                return
+
+    def stop(self):
+        self.done.set()
+
+# Server probe for -X
+class Probe:
+    def __init__(self, path, interval=None):
+        self.path = path
+        if interval is None:
+            try:
+                interval = int(os.getenv('DUDAC_JEMALLOC_INTERVAL', JESTATS_INTERVAL))
+            except ValueError:
+                interval = JESTATS_INTERVAL
+        self.interval = interval
+        self.collector = None
+        self.sampler = None
+
+    def attach(self, server):
+        self.collector = Collector(None)
+        server.listeners.append(self.collector.feed)
+
+    def started(self, server):
+        name = 'stats-%s-%i.jsonl' % (time.strftime('%Y%m%d-%H%M%S'), server.pid())
+        self.collector.path = os.path.join(self.path, name)
+        self.sampler = Sampler(self.collector, server, self.interval)
+        self.sampler.start()
+
+    def finished(self, server):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+        records = self.collector.records
+        if len(records) == 0:
+            return
+
+        print_info("JEMALLOC    : %i dumps at %s" % (len(records), self.collector.path))
+        for line in report(records[-1]):
+            print "    " + line
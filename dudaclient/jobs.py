@@ -0,0 +1,204 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import multiprocessing
+
+from utils import *
+
+# Memory that a single compiler job may need (MB)
+JOB_MEMORY = 256
+
+# make supports --jobserver-auth since 4.2, before it was --jobserver-fds
+MAKE_JOBSERVER_AUTH = (4, 2)
+
+def read_file(path):
+    try:
+        f = open(path, 'r')
+        data = f.read().strip()
+        f.close()
+    except IOError:
+        return None
+
+    return data
+
+# Find a control file of the cgroup this process belongs to, it looks up
+# the unified hierarchy (v2) and the controller specific one (v1)
+def cgroup_file(controller, v2_name, v1_name):
+    paths = {}
+    data = read_file('/proc/self/cgroup')
+    if data is not None:
+        for line in data.split('\n'):
+            arr = line.split(':', 2)
+            if len(arr) != 3:
+                continue
+            if arr[1] == '':
+                paths['v2'] = arr[2]
+            elif controller in arr[1].split(','):
+                paths['v1'] = arr[2]
+
+    candidates = []
+    if 'v2' in paths:
+        candidates.append('/sys/fs/cgroup/%s/%s' % (paths['v2'], v2_name))
+    candidates.append('/sys/fs/cgroup/%s' % v2_name)
+    if 'v1' in paths:
+        candidates.append('/sys/fs/cgroup/%s/%s/%s' % (controller, paths['v1'], v1_name))
+    candidates.append('/sys/fs/cgroup/%s/%s' % (controller, v1_name))
+
+    for c in candidates:
+        c = os.path.normpath(c)
+        if os.path.isfile(c):
+            return c
+
+    return None
+
+# Number of CPUs in the affinity mask of the process
+def cpu_affinity():
+    data = read_file('/proc/self/status')
+    if data is None:
+        return None
+
+    for line in data.split('\n'):
+        if not line.startswith('Cpus_allowed_list:'):
+            continue
+
+        count = 0
+        for r in line.split(':', 1)[1].strip().split(','):
+            if r.find('-') > 0:
+                a, b = r.split('-')
+                count += int(b) - int(a) + 1
+            elif len(r) > 0:
+                count += 1
+        return count
+
+    return None
+
+# CPUs allowed by the cgroup quota
+def cpu_quota():
+    path = cgroup_file('cpu', 'cpu.max', 'cpu.cfs_quota_us')
+    if path is None:
+        return None
+
+    try:
+        if path.endswith('cpu.max'):
+            quota, period = read_file(path).split()
+            if quota == 'max':
+                return None
+        else:
+            quota = read_file(path)
+            period = read_file(os.path.join(os.path.dirname(path), 'cpu.cfs_period_us'))
+
+        quota = int(quota)
+        period = int(period)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    if quota <= 0 or period <= 0:
+        return None
+
+    return max(1, (quota + period - 1) / period)
+
+def cpu_count():
+    cpus = cpu_affinity()
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+
+    return max(1, cpus)
+
+# Available memory in bytes, considering the cgroup limit
+def memory_available():
+    available = None
+    data = read_file('/proc/meminfo')
+    if data is not None:
+        for line in data.split('\n'):
+            if line.startswith('MemAvailable:'):
+                available = int(line.split()[1]) * 1024
+
+    path = cgroup_file('memory', 'memory.max', 'memory.limit_in_bytes')
+    if path is not None:
+        limit = read_file(path)
+        if path.endswith('memory.max'):
+            usage = read_file(os.path.join(os.path.dirname(path), 'memory.current'))
+        else:
+            usage = read_file(os.path.join(os.path.dirname(path), 'memory.usage_in_bytes'))
+
+        try:
+            free = int(limit) - int(usage)
+            if available is None or free < available:
+                available = free
+        except (TypeError, ValueError):
+            pass
+
+    return available
+
+# Number of build jobs for this machine
+def job_count():
+    jobs = cpu_count()
+
+    try:
+        per_job = int(os.getenv('DUDAC_JOB_MEMORY', JOB_MEMORY)) * 1024 * 1024
+    except ValueError:
+        per_job = JOB_MEMORY * 1024 * 1024
+
+    mem = memory_available()
+    if mem is not None:
+        jobs = min(jobs, max(1, mem / per_job))
+
+    return jobs
+
+def make_version():
+    ret = commands.getstatusoutput('make --version')
+    if ret[0] != 0:
+        return (0, 0)
+
+    try:
+        v = ret[1].split('\n')[0].split()[-1].split('.')
+        return (int(v[0]), int(v[1]))
+    except (IndexError, ValueError):
+        return (0, 0)
+
+# A GNU make jobserver owned by dudac. Every make started by dudac joins it
+# through MAKEFLAGS, so the stack and web service builds share the same
+# job slots. dudac itself can take slots for its own concurrent work.
+class JobServer:
+    def __init__(self, jobs, load=None):
+        self.jobs = max(1, jobs)
+        if load is None:
+            load = max(self.jobs, cpu_count())
+        self.load = load
+
+        # every make has an implicit slot, the pipe holds the rest
+        self.rfd, self.wfd = os.pipe()
+        os.write(self.wfd, '+' * (self.jobs - 1))
+
+    def makeflags(self):
+        if make_version() >= MAKE_JOBSERVER_AUTH:
+            flags = '-j%i --jobserver-auth=%i,%i' % (self.jobs, self.rfd, self.wfd)
+        else:
+            flags = '-j --jobserver-fds=%i,%i' % (self.rfd, self.wfd)
+
+        return '%s -l%.1f' % (flags, self.load)
+
+    # Take a job slot, it blocks until one is available
+    def acquire(self):
+        return os.read(self.rfd, 1)
+
+    def release(self, token='+'):
+        os.write(self.wfd, token)
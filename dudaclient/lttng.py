@@ -0,0 +1,363 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Linux Trace Toolkit
+# ===================
+# With -T Monkey is built with its LTTng tracepoints. dudac creates a user
+# space session around every server instance, recording only the events
+# of its process (two instances run together during a handoff), the trace
+# is written under DUDAC_HOME/lttng/<time>-<pid>/. Once the server exits
+# the trace is read from babeltrace line by line, in the background so
+# the restart is not delayed: every event is assigned to a request stage and
+# the time between the stages of a connection (a fd of the process) is
+# recorded on histograms, and the events of every worker thread on a
+# timeline.
+
+import os
+import re
+import json
+import sys
+import commands
+import threading
+import subprocess
+
+from utils import *
+from bench import Histogram
+
+# Events enabled on the session
+LTTNG_EVENTS = 'monkey:*'
+
+# Request stages, matched in order against 'event message'
+LTTNG_STAGES = [('accept',   re.compile(r'accept', re.I)),
+                ('handler',  re.compile(r'(request|handler|plugin|stage|duda)', re.I)),
+                ('response', re.compile(r'(response|send|write|close)', re.I))]
+
+# Latencies measured between the stages of a connection
+LTTNG_LATENCIES = [('accept', 'handler'), ('handler', 'response'),
+                   ('accept', 'response')]
+
+# Seconds of every bucket of the workers timeline
+LTTNG_TIMELINE = 1
+
+# Seconds shown per worker on the report
+LTTNG_TIMELINE_SHOWN = 20
+
+# [12:34:56.123456789] or [1400000000.123456789] with --clock-seconds
+TRACE_TIME = re.compile(r'^\[(?:(\d+):(\d+):)?(\d+\.\d+)\]')
+TRACE_EVENT = re.compile(r'\s([A-Za-z0-9_]+:[A-Za-z0-9_]+):\s')
+TRACE_FIELD = re.compile(r'(\w+) = ("(?:[^"\\]|\\.)*"|[^,}\s]+)')
+TRACE_FD = re.compile(r'\b(?:fd|socket)\s*[=:]?\s*\[?(\d+)', re.I)
+
+def available():
+    return commands.getstatusoutput('lttng --version')[0] == 0
+
+# The babeltrace command to read a trace
+def reader():
+    for cmd in ['babeltrace', 'babeltrace2']:
+        if commands.getstatusoutput(cmd + ' --help')[0] == 0:
+            return cmd
+    return None
+
+class Session:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.created = False
+        self.active = False
+
+    def lttng(self, args):
+        return commands.getstatusoutput('lttng ' + args + ' 2>&1')
+
+    def create(self):
+        ret = self.lttng('create %s --output=%s' % (self.name, self.path))
+        if ret[0] != 0:
+            fail_msg("Error: lttng create: %s" % ret[1].strip())
+            return False
+
+        self.created = True
+        return True
+
+    # Record the events of the process 'vpid' only
+    def start(self, vpid):
+        steps = ['enable-event -u -s %s "%s" --filter \'$ctx.vpid == %i\'' % \
+                     (self.name, LTTNG_EVENTS, vpid),
+                 'add-context -u -s %s -t vpid -t vtid -t procname' % self.name,
+                 'start ' + self.name]
+
+        for s in steps:
+            ret = self.lttng(s)
+            if ret[0] != 0:
+                fail_msg("Error: lttng %s: %s" % (s.split(' ')[0], ret[1].strip()))
+                self.stop()
+                return False
+
+        self.active = True
+        return True
+
+    def stop(self):
+        if self.created is False:
+            return
+        if self.active is True:
+            self.lttng('stop ' + self.name)
+        self.created = False
+        self.active = False
+        self.lttng('destroy ' + self.name)
+
+# Parse a line of babeltrace, it returns (time, event, fields) or None
+def parse_line(line, day=0):
+    m = TRACE_TIME.match(line)
+    if m is None:
+        return None
+
+    ts = float(m.group(3))
+    if m.group(1) is not None:
+        ts += int(m.group(1)) * 3600 + int(m.group(2)) * 60 + day
+
+    e = TRACE_EVENT.search(line)
+    if e is None:
+        return None
+
+    fields = {}
+    for k, v in TRACE_FIELD.findall(line[e.end():]):
+        if v.startswith('"'):
+            v = v[1:-1]
+        fields[k] = v
+
+    return (ts, e.group(1), fields)
+
+# Stage of an event, None if it's not part of a request
+def stage(event, fields):
+    text = event + ' ' + ' '.join([str(v) for k, v in fields.iteritems()
+                                   if k not in ['procname', 'vpid', 'vtid', 'cpu_id']])
+    for name, regex in LTTNG_STAGES:
+        if regex.search(text) is not None:
+            return name
+    return None
+
+# Streaming analysis of the events
+class Analyzer:
+    def __init__(self):
+        self.events = 0
+        self.first = None
+        self.last = None
+        self.day = 0
+        self.latency = {}
+        for a, b in LTTNG_LATENCIES:
+            self.latency['%s-%s' % (a, b)] = Histogram()
+        self.stages = {}
+        self.conns = {}
+        self.workers = {}
+
+    def feed(self, line):
+        ev = parse_line(line, self.day)
+        if ev is None:
+            return
+
+        ts, event, fields = ev
+
+        # time of day stamps wrap at midnight
+        if self.last is not None and ts < self.last - 43200:
+            self.day += 86400
+            ts += 86400
+
+        if self.first is None:
+            self.first = ts
+        self.last = ts
+        self.events += 1
+
+        worker = fields.get('vtid', fields.get('cpu_id', '-'))
+        st = stage(event, fields)
+
+        # timeline: events of every stage per worker and bucket
+        w = self.workers.setdefault(worker, {'events': 0, 'requests': 0, 'timeline': {}})
+        w['events'] += 1
+        bucket = int((ts - self.first) / LTTNG_TIMELINE)
+        slot = w['timeline'].setdefault(bucket, {})
+        slot[st or 'other'] = slot.get(st or 'other', 0) + 1
+
+        if st is None:
+            return
+        self.stages[st] = self.stages.get(st, 0) + 1
+
+        # the connection is the file descriptor on its process: Monkey may
+        # accept on a thread and serve the request on a worker. If the
+        # events do not tell the fd, the worker is the connection.
+        fd = fields.get('fd')
+        if fd is None:
+            m = TRACE_FD.search(fields.get('message', fields.get('text', '')))
+            if m is not None:
+                fd = m.group(1)
+        if fd is not None:
+            key = (fields.get('vpid'), fd)
+        else:
+            key = (fields.get('vpid'), 'worker', worker)
+
+        if st == 'accept':
+            self.conns[key] = {'accept': ts}
+            return
+
+        conn = self.conns.setdefault(key, {})
+        if st not in conn:
+            conn[st] = ts
+        for a, b in LTTNG_LATENCIES:
+            if b == st and a in conn:
+                self.latency['%s-%s' % (a, b)].record(ts - conn[a])
+
+        if st == 'response':
+            w['requests'] += 1
+            del self.conns[key]
+
+    def summary(self):
+        latency = {}
+        for name, h in self.latency.iteritems():
+            latency[name] = {'count' : h.total,
+                             'mean'  : h.mean() / 1000.0,
+                             'p50'   : h.percentile(50) / 1000.0,
+                             'p90'   : h.percentile(90) / 1000.0,
+                             'p99'   : h.percentile(99) / 1000.0,
+                             'max'   : (h.max or 0) / 1000.0,
+                             'histogram': h.export()}
+
+        workers = {}
+        span = 0
+        if self.first is not None:
+            span = int((self.last - self.first) / LTTNG_TIMELINE) + 1
+        for name, w in self.workers.iteritems():
+            timeline = []
+            for i in range(span):
+                timeline.append(w['timeline'].get(i, {}))
+            workers[str(name)] = {'events': w['events'], 'requests': w['requests'],
+                                  'timeline': timeline}
+
+        duration = 0.0
+        if self.first is not None:
+            duration = self.last - self.first
+
+        return {'events': self.events, 'duration': duration,
+                'stages': self.stages, 'latency': latency, 'workers': workers}
+
+# Read a trace with babeltrace, the output is parsed while it's read
+def analyze(path):
+    cmd = reader()
+    if cmd is None:
+        fail_msg("Error: babeltrace is required to read the trace")
+        return None
+
+    a = Analyzer()
+    p = subprocess.Popen([cmd, '--clock-seconds', path], stdout=subprocess.PIPE,
+                         stderr=open(os.devnull, 'w'))
+    for line in iter(p.stdout.readline, ''):
+        a.feed(line)
+    p.wait()
+
+    return a.summary()
+
+def report(summary):
+    lines = ['%i events in %.2fs, stages: %s' % \
+                 (summary['events'], summary['duration'],
+                  ', '.join(['%s %i' % (s, summary['stages'].get(s, 0))
+                             for s, r in LTTNG_STAGES]))]
+
+    lines.append('%-18s %8s %10s %10s %10s %10s %10s' % \
+                     ('latency ms', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for a, b in LTTNG_LATENCIES:
+        name = '%s-%s' % (a, b)
+        l = summary['latency'][name]
+        if l['count'] == 0:
+            continue
+        lines.append('%-18s %8i %10.3f %10.3f %10.3f %10.3f %10.3f' % \
+                         (name, l['count'], l['mean'], l['p50'], l['p90'],
+                          l['p99'], l['max']))
+
+    # events per second of every worker, the busiest first
+    workers = sorted(summary['workers'].items(), key=lambda w: w[1]['events'],
+                     reverse=True)
+    if len(workers) > 0:
+        lines.append('%-10s %8s %8s  %s' % ('worker', 'events', 'requests',
+                                             'events per %is' % LTTNG_TIMELINE))
+    for name, w in workers:
+        counts = [str(sum(slot.values())) for slot in w['timeline'][:LTTNG_TIMELINE_SHOWN]]
+        more = ''
+        if len(w['timeline']) > LTTNG_TIMELINE_SHOWN:
+            more = ' ...'
+        lines.append('%-10s %8i %8i  %s%s' % (name, w['events'], w['requests'],
+                                              ' '.join(counts), more))
+
+    return lines
+
+def save(path, summary):
+    f = open(os.path.join(path, 'summary.json'), 'w')
+    json.dump(summary, f, indent=2, sort_keys=True)
+    f.write('\n')
+    f.close()
+
+# Traces directories, the oldest first
+def traces(path):
+    if os.path.isdir(path) is False:
+        return []
+    return sorted([os.path.join(path, d) for d in os.listdir(path)
+                   if os.path.isdir(os.path.join(path, d))])
+
+# Server probe for -T
+class Probe:
+    def __init__(self, path):
+        self.path = path
+        self.session = None
+
+    def attach(self, server):
+        if available() is False:
+            fail_msg("Error: lttng is not installed, the server runs without tracing")
+            return
+
+        path = run_directory(self.path)
+        self.session = Session('dudac-' + os.path.basename(path).replace('.', '-'), path)
+        if self.session.create() is False:
+            self.session = None
+
+    # The pid is known once the process is running, the few events it
+    # emits before are lost
+    def started(self, server):
+        if self.session is None:
+            return
+
+        if self.session.start(server.pid()) is False:
+            self.session = None
+            return
+        print_info("TRACE       : " + self.session.path)
+
+    # Reading the trace takes a while on a busy server: it's done on its
+    # own thread, dudac does not exit before it's reported
+    def finished(self, server):
+        if self.session is None:
+            return
+
+        self.session.stop()
+        t = threading.Thread(target=self.report, args=(self.session.path,))
+        t.start()
+        self.session = None
+
+    def report(self, path):
+        summary = analyze(path)
+        if summary is None:
+            return
+
+        save(path, summary)
+        print_lock.acquire()
+        print_info("TRACE       : %i events at %s" % (summary['events'], path))
+        for line in report(summary):
+            print "    " + line
+        sys.stdout.flush()
+        print_lock.release()
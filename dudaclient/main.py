@@ -18,12 +18,34 @@
 
 import os
 import sys
+import json
+import time
+import signal
+import socket
 import shutil
 import getopt
-import datetime
+import hashlib
 import ConfigParser
 
+import bench
+import watch
+import jestats
+import heapprof
+import cpuprof
+import lttng
+import crashdb
+import results
+import timing
+import unitstat
+
 from git import GitProject
+from stage import StageCache
+from ccache import CompilerCache
+from jobs import JobServer, job_count
+from units import ServiceUnits
+from conf import ConfigTree
+from server import *
+from results import ResultsStore
 from utils import *
 
 # Version
@@ -53,6 +75,7 @@ class DudaConfig(ConfigParser.ConfigParser):
 
 class Monkey:
     opts = ''
+    make_args = ''
     recent_configure = False
     recent_build = False
     recent_clean = False
@@ -68,33 +91,90 @@ class Monkey:
         cpath = os.getcwd()
         os.chdir(self.mk_path)
 
+        # Run the configure script
+        with timing.phase('configure'):
+            execute("Monkey      : prepare build", self.configure_cmd())
+
+        # Remember which options generated the current Makefiles
+        f = open(self.configure_stamp(), 'w')
+        f.write(self.configure_fingerprint() + '\n')
+        f.close()
+
+        # Revert to original path
+        os.chdir(cpath)
+        self.recent_configure = True
+
+    def configure_stamp(self):
+        return os.path.join(self.mk_path, 'configure.dudac')
+
+    # The configure result depends on the command line, the Jemalloc
+    # options, the configure script itself and where the stage is: the
+    # Makefiles and configuration carry its absolute path, a stage seeded
+    # from another one must be configured again
+    def configure_fingerprint(self):
+        h = hashlib.sha1()
+        h.update(os.path.abspath(self.mk_path) + '\n')
+        h.update(self.configure_cmd() + '\n')
+        h.update(os.getenv('JEMALLOC_OPTS', '').strip() + '\n')
+
+        script = os.path.join(self.mk_path, 'configure')
+        if os.path.isfile(script):
+            f = open(script, 'r')
+            h.update(f.read())
+            f.close()
+
+        return h.hexdigest()
+
+    # Check if the configure script needs to run again for the sources
+    # and options in the stage
+    def configure_needed(self):
+        if os.path.exists(self.mk_path + '/Makefile') is False:
+            return True
+
+        stamp = self.configure_stamp()
+        if os.path.isfile(stamp) is False:
+            return True
+
+        f = open(stamp, 'r')
+        fp = f.read().strip()
+        f.close()
+
+        return fp != self.configure_fingerprint()
+
+    # Compose the configure command line for the current options
+    def configure_cmd(self):
         # Specify the plugins
         plugins = "liana,duda,auth"
 
-                # If we have SSL enable, we have to replace the transport layer, that means
+        # If we have SSL enable, we have to replace the transport layer, that means
         # disable Liana and enable the new PolarSSL, later we need to generate
         # certificates and configure everything to make it work properly
         if self.SSL is True:
             plugins += ',polarssl'
 
-        configure = "./configure --debug --disable-plugins='*' --enable-plugins='%s' %s"  % (plugins, self.opts)
-
-        # Run the configure script
-        execute("Monkey      : prepare build", configure)
-
-        # Revert to original path
-        os.chdir(cpath)
-        self.recent_configure = True
+        return "./configure --debug --disable-plugins='*' --enable-plugins='%s' %s"  % (plugins, self.opts)
 
     def make_build(self):
         if self.recent_build is True:
             return
 
-        cmd = "make -C %s" % (self.mk_path)
-        execute("Monkey      : building", cmd)
+        cmd = "make -C %s %s" % (self.mk_path, self.make_args)
+        with timing.phase('make_build'):
+            execute("Monkey      : building", cmd)
 
         self.recent_build = True
 
+    # Rebuild only one plugin, used when the rest of the stack is up to date
+    def make_plugin(self, name):
+        path = os.path.join(self.mk_path, 'plugins', name)
+        if os.path.exists(path + '/Makefile') is False:
+            return
+
+        with timing.phase('make_build'):
+            execute("Monkey      : cleaning plugin %s" % name, "make -C %s clean" % path)
+            execute("Monkey      : building plugin %s" % name,
+                    "make -C %s %s" % (path, self.make_args))
+
     def make_clean(self):
         if self.recent_clean is True:
             return
@@ -103,7 +183,8 @@ class Monkey:
             return
 
         cmd = "make -C %s clean" % (self.mk_path)
-        execute("Monkey      : cleaning", cmd)
+        with timing.phase('make_clean'):
+            execute("Monkey      : cleaning", cmd)
 
         self.recent_clean = True
 
@@ -126,21 +207,21 @@ class Monkey:
         return ".".join(version.split()[3].split(".")[0:2])
 
 class MonkeyGIT (GitProject):
-    def __init__(self, home_path):
+    def __init__(self, home_path, mirrors_path=None):
         self._home = home_path
         https_repo = 'https://github.com/monkey/monkey.git'
         git_repo   = 'git@github.com:monkey/monkey.git'
-        GitProject.__init__(self, 'Monkey', https_repo, git_repo)
+        GitProject.__init__(self, 'Monkey', https_repo, git_repo, mirrors_path)
 
     def home(self):
         return self._home
 
 class DudaGIT(GitProject):
-    def __init__(self, home_path):
+    def __init__(self, home_path, mirrors_path=None):
         self._home = home_path
         https_repo = 'https://github.com/monkey/duda.git'
         git_repo   = 'git@github.com:monkey/duda.git'
-        GitProject.__init__(self, 'Duda', https_repo, git_repo)
+        GitProject.__init__(self, 'Duda', https_repo, git_repo, mirrors_path)
 
     def home(self):
         return self._home
@@ -174,6 +255,10 @@ class Duda:
         self.SSL = False
         self.SSL_default = False
         self.output_stdout = False
+        self.watch = False
+        self.service_urls = []
+        self.stage_info = {}
+        self.conf_overrides = {}
         self.api_level = DEFAULT_API_LEVEL
         self.linux_malloc = False
         self.linux_trace = False
@@ -181,6 +266,10 @@ class Duda:
         self.jemalloc_prof  = False
         self.rebuild_monkey = False
         self.reset_environment = False
+        self.build_jobs = None
+        self.jobserver = None
+        self.trace_file = None
+        self.trace_history = None
         self.load_makefile()
 
         # Load Environment variables
@@ -193,22 +282,51 @@ class Duda:
         if self.dudac_home_path[-1] != '/':
             self.dudac_home_path += '/'
 
-        # Sanitize paths: DUDAC_STAGE
+        # Sanitize paths: DUDAC_STAGE. If it's not set, the stage area is
+        # selected from the stages cache once the build options are known
+        self.stage_fixed = self.dudac_stage_path is not None
         if self.dudac_stage_path is None:
             self.dudac_stage_path = self.dudac_home_path + 'stage/'
         if self.dudac_stage_path[-1] != '/':
             self.dudac_stage_path += '/'
 
+        self.stages   = StageCache(self.dudac_home_path + 'stages/')
+        self.stage_id = None
+
         # Set Source paths for Monkey and Duda
         self.mk_home   = self.dudac_home_path + 'monkey/'
         self.duda_home = self.dudac_home_path + 'duda/'
 
+        # Bare mirrors of the upstream repositories, they are shared by
+        # every DUDAC_HOME of the user and survive a reset
+        self.dudac_mirrors_path = os.getenv('DUDAC_MIRRORS')
+        if self.dudac_mirrors_path is None:
+            self.dudac_mirrors_path = '%s/.dudac/mirrors/' % (os.getenv('USERPROFILE') or os.getenv('HOME'))
+
         # Initialize GIT handlers
-        self.mk_git   = MonkeyGIT(self.mk_home)
-        self.duda_git = DudaGIT(self.duda_home)
+        self.mk_git   = MonkeyGIT(self.mk_home, self.dudac_mirrors_path)
+        self.duda_git = DudaGIT(self.duda_home, self.dudac_mirrors_path)
 
         # Instance Monkey handler
         self.monkey  = Monkey(self.dudac_stage_path + 'monkey/')
+
+        # Full output of the commands goes to DUDAC_HOME/logs
+        set_log_path(self.dudac_home_path + 'logs/')
+
+        # gdb caches the symbols index there, and the cores taken from the
+        # system core dump handler are stored there
+        set_crash_path(self.dudac_home_path)
+
+        # Compiler cache, it wraps $(CC) for the stack and web service
+        # builds unless DUDAC_CCACHE=0
+        self.ccache = None
+        self.ccache_begun = False
+        self.ccache_evicted = False
+        if os.getenv('DUDAC_CCACHE', '1') != '0':
+            self.ccache = CompilerCache(self.dudac_home_path + 'ccache/')
+            os.environ['DUDAC_CCACHE_DIR'] = self.ccache.path
+            self.monkey.make_args = "CC='%s'" % self.ccache.wrapper()
+
         self.get_arguments()
 
         exit(0)
@@ -268,137 +386,232 @@ class Duda:
         self.mk_git.setup(mk_version, mk_https_repo, mk_git_repo)
         self.duda_git.setup(duda_version, duda_https_repo, duda_git_repo)
 
+        # Pin the commits resolved on a previous run
+        self.read_lock()
+
+    # The dudac.lock file is stored next to the web service dudac.conf, it
+    # pins the exact commits used to build the stack. As long as the
+    # requested versions do not change, the commits are trusted and nothing
+    # is resolved again unless an update is requested (-s or -g).
+    def lock_file(self):
+        return os.path.abspath("%s/dudac.lock" % (self.service))
+
+    def read_lock(self):
+        lock = self.lock_file()
+        if os.path.isfile(lock) is False:
+            return
+
+        config = DudaConfig()
+        config.open(lock)
+
+        for h, git in [('MONKEY', self.mk_git), ('DUDA', self.duda_git)]:
+            version = config.get_key(h, 'version')
+            commit  = config.get_key(h, 'commit')
+            if version == git.version and commit is not None:
+                git.pinned = commit
+            else:
+                git.pinned = None
+
+    def write_lock(self):
+        raw  = "# Autogenerated by Duda Client Manager, it pins the stack\n"
+        raw += "# commits, use 'dudac -s' to update it\n"
+        for h, git in [('MONKEY', self.mk_git), ('DUDA', self.duda_git)]:
+            commit = git.head()
+            if commit is None:
+                return
+
+            raw += "\n[%s]\n" % (h)
+            raw += "version = %s\n" % (git.version)
+            raw += "commit  = %s\n" % (commit)
+
+        if write_if_changed(self.lock_file(), raw) is True:
+            print_info("LOCK        : " + self.lock_file())
+
     def update_framework(self, protocol):
         self.mk_git.set_protocol(protocol)
         self.duda_git.set_protocol(protocol)
 
-        if os.path.exists(self.mk_home):
-            self.mk_git.update(self.mk_home)
-        else:
-            self.mk_git.clone(self.mk_home)
+        # Fetch both repositories at the same time, the snapshot and stage
+        # merge waits for both of them
+        jobs = [self.mk_git.fetch_job(self.mk_home),
+                self.duda_git.fetch_job(self.duda_home)]
+        with timing.phase('git fetch'):
+            execute_many(jobs)
 
-        if os.path.exists(self.duda_home):
-            self.duda_git.update(self.duda_home)
-        else:
-            self.duda_git.clone(self.duda_home)
+        self.mk_git.fetched()
+        self.duda_git.fetched()
 
-        # Cleanup and rebuild Monkey
-        cpath = os.getcwd()
-        os.chdir(self.mk_home)
+        # The sources were updated, resolve the versions again
+        self.mk_git.pinned = None
+        self.duda_git.pinned = None
 
         self.mk_git.version = self.api_level
-        self.mk_git.snapshot()
-
         self.duda_git.version = self.api_level
-        self.duda_git.snapshot()
-
-        self.merge_on_stage()
-        self.monkey.configure()
-
-        if os.path.exists("./Makefile"):
-            self.monkey.make_clean()
 
-        self.monkey.make_build()
-        os.chdir(cpath)
+        # Build the stage for the updated sources, unless it was built
+        # before and is still in the cache
+        self.select_stage()
+        if self.stages.is_built(self.dudac_stage_path, self.stage_id) is False:
+            self.build_stage()
+        else:
+            print_msg("Stage       : %s (cached)" % self.stage_id[:16], True)
 
     def merge_on_stage(self):
         # Create archives from repos
-        self.mk_git.archive_to(self.dudac_stage_path + '/monkey')
-        self.duda_git.archive_to(self.dudac_stage_path + '/monkey/plugins/duda')
+        with timing.phase('archive_to'):
+            self.mk_git.archive_to(self.dudac_stage_path + '/monkey')
+            self.duda_git.archive_to(self.dudac_stage_path + '/monkey/plugins/duda')
+
+    # The keys which identify a stage build, any change on them requires
+    # a different stage
+    def stage_keys(self):
+        keys = {}
+        keys['monkey']    = self.mk_git.head()
+        keys['duda']      = self.duda_git.head()
+        keys['configure'] = self.monkey.configure_cmd().strip()
+        keys['jemalloc']  = os.getenv('JEMALLOC_OPTS', '').strip()
+        keys['defs']      = os.getenv('DEFS', '').strip()
+        return keys
+
+    # Lookup the stage area that matches the current sources and options
+    def select_stage(self):
+        keys = self.stage_keys()
+        self.stage_info = keys
+        self.stage_id = self.stages.fingerprint(keys)
+        set_crash_stack(self.stage_id)
+
+        if self.stage_fixed is False:
+            self.dudac_stage_path = self.stages.path(self.stage_id)
+
+        self.monkey.mk_path = self.dudac_stage_path + 'monkey/'
+        print_info("STAGE       : " + self.dudac_stage_path)
 
-        # Tag the content with branch used
-        f = open(self.dudac_stage_path + '/monkey/api_level.dudac', 'w')
-        f.write(self.mk_git.version + '\n')
-        f.close()
+        if self.service:
+            self.write_lock()
+
+    # A new stage do not need to start from scratch: a cached stage built
+    # with the same options only differs on the sources, copy it and let the
+    # build process work on what changed
+    def seed_stage(self):
+        path = self.dudac_stage_path
+        if self.stage_fixed is True or os.path.exists(path):
+            return
 
+        same = ['configure', 'jemalloc', 'defs']
+        for last, p in reversed(self.stages.stages()):
+            keys = self.stages.info(p)
+            if keys is None:
+                continue
+
+            match = True
+            for k in same:
+                if keys.get(k) != self.stage_info[k]:
+                    match = False
+                    break
+
+            if match is True:
+                cmd = "cp -a %s %s" % (p.rstrip('/'), path.rstrip('/'))
+                with timing.phase('stage seed'):
+                    execute("Stage       : seed from %s" % os.path.basename(p.rstrip('/')), cmd)
+                return
+
+    # Compare what the stage holds against the new sources, it returns
+    # the set of plugins that needs a rebuild or None if the whole stack
+    # must be built again
+    def stage_changes(self, prev):
+        if prev is None:
+            return None
 
-    # Enable a plugin on plugins.load file, if the line is commented, it
-    # change the status, if it do not exist, it create a new entry at the
-    # end
-    def enable_plugin(self, monkey_stage, name):
-        matched = False
-        plugins = monkey_stage + "/conf/plugins.load"
-        f = open(plugins, "r")
-        lines = f.readlines()
-        f.close()
+        for k in ['configure', 'jemalloc', 'defs']:
+            if prev.get(k) != self.stage_info[k]:
+                return None
 
-        plugin = 'monkey-%s.so' % (name)
+        changes = set()
+        if prev.get('monkey') != self.stage_info['monkey']:
+            files = self.mk_git.changed_files(prev.get('monkey'),
+                                              self.stage_info['monkey'])
+            if files is None:
+                return None
 
-        raw = ""
-        for line in lines:
-            if line.startswith('    # Load') and line.strip().endswith(plugin):
-                line = "    " + line[6:]
-                matched = True
-            elif line.startswith('    Load') and line.strip().endswith(plugin):
-                matched = True
-
-            raw += line
-
-        if matched is False:
-            raw += '\n'
-            raw += '    # Enabled by DudaC\n'
-            raw += '    # ================\n'
-            raw += '    Load %s/plugins/%s/%s\n' % (monkey_stage, name, plugin)
-
-        f = open(plugins, "w")
-        f.write(raw)
-        f.close()
+            for name in files:
+                parts = name.split('/')
+                if len(parts) < 3 or parts[0] != 'plugins':
+                    return None
+                changes.add(parts[1])
 
-    def run_webservice(self, schema=None):
-        ws = os.path.abspath(self.service)
+        if prev.get('duda') != self.stage_info['duda']:
+            changes.add('duda')
+
+        return changes
+
+    # Populate the stage area with the sources snapshot and build the stack
+    def build_stage(self, force=False):
+        # Backup our original path
+        cpath = os.getcwd()
         monkey_stage = self.monkey.mk_path
 
-        # Check if the web service was staged and built previously, we
-        # this check to make sure the service is updated as the user needs/want
-        stage_level = self.dudac_stage_path + '/monkey/api_level.dudac'
-        if os.path.isfile(stage_level):
-            f = open(stage_level, 'r')
-            level = f.read().replace('\n', '')
-            f.close()
+        # On rebuild, check that stack sources are in place
+        if os.path.exists(self.mk_home) is False or \
+           os.path.exists(self.duda_home) is False:
+            fail_msg("Error: the stack components are missing, try: \n\n" \
+                     "    $ dudac -s\n")
+            sys.exit(1)
 
-            if level != self.mk_git.version:
-                self.rebuild_monkey = True
-        else:
-            self.rebuild_monkey = True
+        self.ccache_begin()
+        self.seed_stage()
 
-        # Check if SSL is required and the Stack was built with SSL on it
-        if self.monkey.SSL is True:
-            polarssl = self.dudac_stage_path + '/monkey/plugins/polarssl/monkey-polarssl.so'
-            if not os.path.isfile(polarssl):
-                self.rebuild_monkey = True
+        # What the stage was built from before, if anything
+        if force is True:
+            changes = None
+        else:
+            changes = self.stage_changes(self.stages.info(self.dudac_stage_path))
 
-        if self.rebuild_monkey is True:
-            # Backup our original path
-            cpath = os.getcwd()
-
-            # On rebuild, check that stack sources are in place
-            if os.path.exists(self.mk_home) is False or \
-               os.path.exists(self.duda_home) is False:
-                fail_msg("Error: the stack components are missing, try: \n\n" \
-                         "    $ dudac -s\n")
-                sys.exit(1)
-
-            # Make sure Monkey sources match the snapshot
-            if not os.getenv('DUDAC_STAGE'):
+        # Make sure Monkey sources match the snapshot
+        if self.stage_fixed is False:
+            with timing.phase('git snapshot'):
                 self.mk_git.snapshot()
                 self.duda_git.snapshot()
-                self.merge_on_stage()
+            self.merge_on_stage()
 
-            # Cleanup and rebuild Monkey
-            os.chdir(monkey_stage)
+        os.chdir(monkey_stage)
 
+        if changes is None or self.monkey.configure_needed() is True:
+            # Cleanup and rebuild Monkey
             if os.path.exists("./Makefile"):
                 self.monkey.make_clean()
 
             self.monkey.configure()
             self.monkey.make_build()
+        else:
+            # Only the plugins sources changed
+            print_msg("Monkey      : prepare build (cached)", True)
+            for name in sorted(changes):
+                self.monkey.make_plugin(name)
 
-            f = open(self.dudac_stage_path + '/monkey/api_level.dudac', 'w')
-            f.write(self.mk_git.version + '\n')
-            f.close()
+        # Tag the stage as built
+        self.stages.save(self.dudac_stage_path, self.stage_id, self.stage_info)
+        if self.stage_fixed is False:
+            self.stages.evict(self.dudac_stage_path)
+
+        # Restore path
+        os.chdir(cpath)
 
-            # Restore path
-            os.chdir(cpath)
+
+    def run_webservice(self, schema=None):
+        ws = os.path.abspath(self.service)
+
+        # Check if the stage for the requested sources and options was built
+        # previously, every combination lives in its own stage area so
+        # switching back to a known stack do not require a rebuild
+        if self.stage_id is None:
+            self.select_stage()
+
+        if self.rebuild_monkey is True:
+            self.build_stage(True)
+        elif self.stages.is_built(self.dudac_stage_path, self.stage_id) is False:
+            self.build_stage()
+
+        monkey_stage = self.monkey.mk_path
 
         makefile = "%s/Makefile" % (ws)
         makefile_in = "%s/Makefile.in" % (ws)
@@ -406,20 +619,267 @@ class Duda:
             print "Error: Invalid web service directory " + ws
             exit(1)
 
+        units = ServiceUnits(ws, self.dudac_home_path + 'cache/')
+        with timing.phase('makefiles'):
+            self.service_makefiles(units)
+
+        # Build the web service, make takes care of what is outdated
+        with timing.phase('service build'):
+            self.service_build(units)
+
+        services = self.service_list(ws)
+
+        # check that services exists
+        if len(services) == 0:
+            print "Error: i could not find Duda services under", ws
+            exit(1)
+
+        self.service_configure(services, schema)
+        conf_schema = schema
+        self.conf_overrides = schema or {}
+
+        http = monkey_stage + "bin/monkey"
+
+        if self.SSL is True:
+            http += " --transport polarssl"
+        else:
+            http += " --transport liana"
+
+        try:
+            if self.SSL_default is True:
+                prot = "https"
+            else:
+                prot = "http"
+
+            d = 0
+            domain = prot + "://localhost:%s/" % str(self.port)
+            schema = ""
+            self.service_urls = []
+            for s in services:
+                if d > 0:
+                    schema += "                                   "
+                schema += domain + services[d]['name'] + '/' + "\n"
+                self.service_urls.append(domain + services[d]['name'] + '/')
+                d += 1
+
+            # The server runs until it's stopped, report the timing now
+            timing.mark('server start')
+            self.timing_report()
+
+            # Do not trap the output of the server, just print everything
+            # to STDOUT
+            sc = ANSI_RESET + ANSI_CYAN + schema + ANSI_RESET
+            header = "%s Service Up  : %s" % (MSG_NEW, sc)
+            if self.watch is True:
+                self.watch_webservice(units, header, http, conf_schema)
+            else:
+                self.serve(units, header, http)
+
+        except (RuntimeError, TypeError, NameError):
+            print "\nDone!"
+            raise
+
+    # Start a new instance of the server. If another one is serving the
+    # same port (our 'old' server or one started by another dudac) the new
+    # instance starts beside it and takes over once it accepts connections,
+    # clients never see the port closed. If the listener of the old
+    # instance does not use SO_REUSEPORT it's stopped first, the service is
+    # down until the new one listens.
+    def server_start(self, server, units, old=None):
+        run = RunFile(self.dudac_home_path + 'run/', self.port)
+        old_pid = None
+        if old is not None:
+            old_pid = old.pid()
+        else:
+            info = run.read()
+            if info is not None:
+                old_pid = info['pid']
+
+        replaced = False
+        if old_pid is not None:
+            if listener_reuseport(self.port) is False:
+                print_info("HANDOFF     : port %s is not shared (no SO_REUSEPORT), " \
+                               "the service is down until the new instance " \
+                               "listens" % str(self.port))
+            elif server.handoff(old_pid, self.port) is True:
+                replaced = True
+            else:
+                print_info("HANDOFF     : the new instance did not get ready, the " \
+                               "service is down until it's restarted")
+
+        if replaced is True:
+            print_info("HANDOFF     : instance %i replaced by %i" % \
+                           (old_pid, server.pid()))
+            if old is not None:
+                old.wait()
+        else:
+            if old_pid is not None:
+                print_info("HANDOFF     : stopping instance %i" % old_pid)
+            if old is not None:
+                old.stop()
+            elif old_pid is not None:
+                try:
+                    os.kill(old_pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+                end = time.time() + SERVER_STOP_TIMEOUT
+                while pid_alive(old_pid) and time.time() < end:
+                    time.sleep(0.05)
+            server.start()
+
+        objects = json.dumps(self.service_objects(units), sort_keys=True)
+        run.write({'pid'        : server.pid(),
+                   'stage'      : self.stage_id,
+                   'fingerprint': hashlib.sha1(objects).hexdigest(),
+                   'urls'       : self.service_urls,
+                   'stack'      : self.stack_info()})
+        return run
+
+    # The server handler with the probes requested on the command line
+    def new_server(self, http):
+        server = Server(http, self.output_stdout)
+        server.probes.append(InstanceConf(self.monkey.mk_path + 'conf/',
+                                          self.dudac_home_path + 'run/instances/'))
+        if self.jemalloc_stats is True and self.linux_malloc is False:
+            server.probes.append(jestats.Probe(self.dudac_home_path + 'jemalloc/'))
+        if self.jemalloc_prof is True and self.linux_malloc is False:
+            server.probes.append(heapprof.Probe(self.dudac_home_path + 'jeprof/'))
+        if self.linux_trace is True:
+            server.probes.append(lttng.Probe(self.dudac_home_path + 'lttng/'))
+
+        return server
+
+    # What the running server is made of, benchmarks are stored with it
+    def stack_info(self):
+        info = dict(self.stage_info)
+        info['api_level'] = self.api_level
+        info['ssl']       = self.SSL
+        info['malloc']    = 'libc' if self.linux_malloc is True else 'jemalloc'
+        info['conf']      = self.conf_overrides
+        return info
+
+    # Run the server until it exits
+    def serve(self, units, header, http):
+        server = self.new_server(http)
+        print header
+        run = self.server_start(server, units)
+
+        # dudac script exits on SIGINT, the server gets it too
+        try:
+            status = server.wait()
+        finally:
+            if server.running() is True:
+                server.stop()
+            run.remove(server.pid())
+
+        if server.stopped(status) is False:
+            server.failed()
+
+    # Watch mode: the server keeps running while the web service files are
+    # watched. Sources changes rebuild the affected units and the server is
+    # restarted only if a .duda object changed, static content under html/
+    # is served as is.
+    def watch_webservice(self, units, header, http, schema=None):
+        ws = units.ws
+        services = self.service_list(ws)
+        watcher = watch.watcher(ws, ['data', 'logs'])
+        server = self.new_server(http)
+
+        print header
+        run = self.server_start(server, units)
+        print_info("WATCH       : %s (%s)" % (ws, watcher.__class__.__name__))
+
+        try:
+            while True:
+                changes = watcher.wait(1.0)
+                if server.running() is False:
+                    if server.stopped(server.wait()) is True:
+                        break
+                    server.failed()
+
+                if len(changes) == 0:
+                    continue
+
+                restart = False
+                sources = set()
+                for c in changes:
+                    if c.startswith(ws + '/html/'):
+                        continue
+                    elif c.startswith(ws + '/conf/'):
+                        restart = True
+                    else:
+                        sources.add(c)
+
+                if len(sources) > 0:
+                    # The queue of events overflowed, check everything
+                    only = units.affected(sources)
+                    if ws in sources:
+                        only = None
+
+                    if ws in sources or \
+                            len([c for c in sources if c.endswith('Makefile.in')]) > 0:
+                        self.service_makefiles(units)
+
+                    before = self.service_objects(units)
+                    if self.service_build(units, only, False) is False:
+                        print_info("WATCH       : build failed, waiting for changes")
+                        continue
+
+                    if self.service_objects(units) != before:
+                        restart = True
+
+                    # New or removed services requires a new configuration
+                    current = self.service_list(ws)
+                    if current != services and len(current) > 0:
+                        services = current
+                        self.service_configure(services, schema)
+                        restart = True
+
+                if restart is False:
+                    print_info("WATCH       : %i files changed, no restart needed" % \
+                                   len(changes))
+                    continue
+
+                # The new instance takes over the port of the current one
+                old = server
+                server = self.new_server(http)
+                run = self.server_start(server, units, old)
+                print_info("WATCH       : %i files changed, server restarted" % \
+                               len(changes))
+
+        except KeyboardInterrupt:
+            print
+        finally:
+            server.stop()
+            run.remove(server.pid())
+            watcher.close()
+
+    # Checksum of the objects built by every unit
+    def service_objects(self, units):
+        objects = {}
+        for u in units.discover():
+            for entry in os.listdir(u):
+                if not entry.endswith('.duda'):
+                    continue
+
+                path = os.path.join(u, entry)
+                f = open(path, 'rb')
+                objects[path] = hashlib.sha1(f.read()).hexdigest()
+                f.close()
+
+        return objects
+
+    # Generate the Makefile of every unit from its Makefile.in
+    def service_makefiles(self, units):
+        monkey_stage = self.monkey.mk_path
+
         # Monkey headers
         mk_inc      = monkey_stage + "/include/ -I" + monkey_stage + "/src/include"
         mk_duda     = monkey_stage + "/plugins/duda/src"
         mk_packages = monkey_stage + "/plugins/duda/"
 
-        # Read the Makefile.in file
-        mk_ins = []
-        for root, dirs, files in os.walk(ws):
-            for file in files:
-                if file == 'Makefile.in':
-                    path = "%s/%s" % (root, file)
-                    mk_ins.append(root)
-
-        for mk in mk_ins:
+        for mk in units.discover():
             mk_in = "%s/Makefile.in" % (mk)
 
             CC_SET = None
@@ -442,52 +902,62 @@ class Duda:
                     raw += line
             raw += "\n"
 
-            makefile = "%s/Makefile" % (mk)
-            f_mk = open(makefile, "w")
-            f_mk.write("# Autogenerated by Duda Client Manager\n")
-            f_mk.write("# ====================================\n")
-
-            today = datetime.datetime.now()
-            f_mk.write("# Date      : " + today.strftime('%a %d, %b %Y at %H:%M') + "\n")
-            f_mk.write("# Stage Path: " + monkey_stage + "\n\n")
-
-            f_mk.write(raw)
-            f_mk.write(self.dudac_makefile)
-            f_mk.close()
-
-        # Cleanup web service and rebuild
-        execute("WebService  : clean", "make -C " + ws + " clean")
-        execute("WebService  : build", "make -C " + ws)
+            # The content must be stable across runs: objects depends on the
+            # Makefile, so it's only written when something really changed
+            content  = "# Autogenerated by Duda Client Manager\n"
+            content += "# ====================================\n"
+            content += "# Stage ID  : " + self.stage_id[:16] + "\n"
+            content += "# Stage Path: " + monkey_stage + "\n\n"
+            content += raw
+            content += self.dudac_makefile
 
-        # Get services
+            makefile = "%s/Makefile" % (mk)
+            write_if_changed(makefile, content)
+
+    # Build the units of the web service (all of them if 'only' is None).
+    # Every compile and link is recorded to report the slowest units.
+    def service_build(self, units, only=None, fatal=True):
+        self.ccache_begin()
+        units_file = self.dudac_home_path + 'units.json'
+        unitstat.reset(units_file)
+        os.environ['DUDAC_UNITSTAT'] = unitstat.wrapper()
+        os.environ['DUDAC_UNITSTAT_FILE'] = units_file
+
+        # Independent units are built at the same time, all of them share
+        # the jobserver slots
+        ret = units.build(lambda u: "make -C %s %s" % (u, self.monkey.make_args),
+                          self.jobserver, only, fatal)
+        self.build_report()
+        self.units_report(units_file, units.ws)
+        return ret
+
+    # Get services
+    def service_list(self, ws):
         services = []
-        list = os.listdir(ws)
+        list = sorted(os.listdir(ws))
         for entry in list:
             p = ws + "/" + entry
             if os.path.isfile(p) and entry.endswith(".duda"):
                 e = {'name': entry[:-5], 'filename': entry}
                 services.append(e)
 
-        # check that services exists
-        if len(services) == 0:
-            print "Error: i could not find Duda services under", ws
-            exit(1)
+        return services
 
-        # Setting up virtual host
-        vhost = monkey_stage + "/conf/sites/default"
-        f = open(vhost, "r")
-        lines = f.readlines()
-        f.close()
+    # Setting up virtual host. All the configuration changes are done
+    # on memory and every file is written once at the end.
+    def service_configure(self, services, schema=None):
+        ws = os.path.abspath(self.service)
+        monkey_stage = self.monkey.mk_path
+
+        t = timing.begin('config')
+        conf = ConfigTree(monkey_stage + "/conf/")
+        vhost = conf.get("sites/default")
 
         # Setting up web services
         print "%s %-70s" % (MSG_NEW, "Monkey      : configure HTTP Server"),
-        raw = ""
-        for line in lines:
-            if line.startswith('[WEB_'):
-                break
-            else:
-                raw += line
+        vhost.truncate('[WEB_')
 
+        raw = ""
         for s in services:
             raw += "[WEB_SERVICE]\n"
             raw += "    Name " + s['name'] + "\n"
@@ -511,71 +981,35 @@ class Duda:
 
             raw += "\n"
 
-        f = open(vhost, "w")
-        f.write(raw)
-        f.close()
+        vhost.append(raw)
 
         # Make sure Duda plugin is enabled on plugins.load
-        self.enable_plugin(monkey_stage, 'duda')
-        self.enable_plugin(monkey_stage, 'auth')
+        conf.enable_plugin(monkey_stage, 'duda')
+        conf.enable_plugin(monkey_stage, 'auth')
 
         if self.monkey.SSL is True:
-            self.enable_plugin(monkey_stage, 'polarssl')
+            conf.enable_plugin(monkey_stage, 'polarssl')
 
         # Setting up Duda plugin configuration
-        duda = monkey_stage + "/conf/plugins/duda/duda.conf"
-        f = open(duda, "r")
-        lines = f.readlines()
-        f.close()
-
-        raw = ""
-        for line in lines:
-            if line.startswith("    ServicesRoot"):
-                raw += "    ServicesRoot " + ws + "\n"
-            else:
-                raw += line
-
-        f = open(duda, "w")
-        f.write(raw)
-        f.close()
+        duda = conf.get("plugins/duda/duda.conf")
+        duda.replace("    ServicesRoot", "    ServicesRoot " + ws + "\n")
 
         # Setting up Monkey
-        monkey = monkey_stage + "/conf/monkey.conf"
-        f = open(monkey, "r")
-        lines = f.readlines()
-        f.close()
+        monkey = conf.get("monkey.conf")
 
         # Get Monkey version
         mk_version = self.monkey.version()
-        raw = ""
-        for line in lines:
-            if mk_version == '1.6':
-                if line.startswith("    Listen"):
-                    raw += "    Listen " + str(self.port) + "\n"
-                    continue
-            elif mk_version == '1.5' or mk_version == '1.4':
-                if line.startswith("    Port"):
-                    raw += "    Port " + str(self.port) + "\n"
-                    continue
+        if mk_version == '1.6':
+            monkey.replace("    Listen", "    Listen " + str(self.port) + "\n")
+        elif mk_version == '1.5' or mk_version == '1.4':
+            monkey.replace("    Port", "    Port " + str(self.port) + "\n")
 
-            if line.startswith("    User"):
-                raw += "    # User  Inactivated by DudaC\n"
-            elif line.startswith("    TransportLayer"):
-                if self.SSL is True:
-                    raw += "    TransportLayer polarssl\n"
-                    self.SSL_default = True
-                else:
-                    raw += "    TransportLayer liana\n"
-                    self.SSL_default = False
-            elif line.startswith("    TransportLayer") and line.find('polarssl') > 0:
+        monkey.replace("    User", "    # User  Inactivated by DudaC\n")
+        if self.SSL is True:
+            if monkey.replace("    TransportLayer", "    TransportLayer polarssl\n") > 0:
                 self.SSL_default = True
-                raw += line
-            else:
-                raw += line
-
-        f = open(monkey, "w")
-        f.write(raw)
-        f.close()
+        elif monkey.replace("    TransportLayer", "    TransportLayer liana\n") > 0:
+            self.SSL_default = False
 
         print MSG_OK
 
@@ -589,138 +1023,117 @@ class Duda:
             if 'Port' in schema:
                 self.port = schema['Port']
 
-            # open the file and read it content
-            f = open(monkey, "r")
-            lines = f.readlines()
-            f.close()
+            for i in range(len(monkey.lines)):
+                line = monkey.lines[i]
+                if not line.startswith("    "):
+                    continue
 
-            # compose a new buffer
-            raw = ""
-            for line in lines:
-                row = line
-                key = None
-                val = None
-                kv  = []
-                if line.startswith("    "):
-                    # strip the indentation
-                    row = line[4:]
-
-                    # Lets see if this line can belong to a commented key/value
-                    if row[:2] == '# ':
-                        arr = row[2:].split()
-                        if len(arr) == 2 and arr[0][-1] != ':':
-                            if arr[0] in self.MCONF_KNOWN:
-                                # ok, its a known key and is commented, now lets check
-                                # if this key is bein overriden through the schema
-                                if not arr[0] in schema:
-                                    raw += line
-                                else:
-                                    raw += "    %s %s\n" % (arr[0], schema[arr[0]])
-
-                                continue
-
-                    kv = row.split()
-                    if len(kv) != 2:
-                        raw += line
-                        continue
-                    else:
-                        # Start replacing
-                        key = kv[0]
-                        val = kv[1]
-                        if key in schema:
-                            raw += "    %s %s\n" % (key, schema[key])
+                # strip the indentation
+                row = line[4:]
+
+                # Lets see if this line can belong to a commented key/value
+                if row[:2] == '# ':
+                    arr = row[2:].split()
+                    if len(arr) == 2 and arr[0][-1] != ':':
+                        if arr[0] in self.MCONF_KNOWN:
+                            # ok, its a known key and is commented, now lets check
+                            # if this key is bein overriden through the schema
+                            if arr[0] in schema:
+                                monkey.lines[i] = "    %s %s\n" % (arr[0], schema[arr[0]])
                             continue
 
+                kv = row.split()
+                if len(kv) == 2 and kv[0] in schema:
+                    monkey.lines[i] = "    %s %s\n" % (kv[0], schema[kv[0]])
 
-                raw += line
-
-            # Flush our new content
-            f = open(monkey, "w")
-            f.write(raw)
-            f.close()
+        timing.end(t)
 
         # Configure Transport Layer for SSL
         if self.SSL_default is True:
-            self.SSL_configure(monkey_stage)
+            with timing.phase('ssl'):
+                self.SSL_configure(monkey_stage, conf)
 
+        # Only the files with new content are written
+        with timing.phase('config write'):
+            conf.flush()
 
-        http = monkey_stage + "bin/monkey"
-
-        if self.SSL is True:
-            http += " --transport polarssl"
-        else:
-            http += " --transport liana"
+    # Export the phases timing of this run
+    def timing_report(self):
+        path = self.trace_file
+        if path is None:
+            path = self.dudac_home_path + 'trace.json'
 
         try:
-            if self.SSL_default is True:
-                prot = "https"
-            else:
-                prot = "http"
+            timing.write(path)
+        except IOError:
+            fail_msg("Error: cannot write trace file " + path)
 
-            d = 0
-            domain = prot + "://localhost:%s/" % str(self.port)
-            schema = ""
-            for s in services:
-                if d > 0:
-                    schema += "                                   "
-                schema += domain + services[d]['name'] + '/' + "\n"
-                d += 1
+        print_info("TIMING      : " + timing.summary())
 
-            # Do not trap the output of the server, just print everything
-            # to STDOUT
-            sc = ANSI_RESET + ANSI_CYAN + schema + ANSI_RESET
-            if self.output_stdout is True:
-                execute_stdout("%s Service Up  : %s" \
-                                   % (MSG_NEW, sc), http, False)
-            else:
-                execute("%s Service Up  : %s" \
-                            % (MSG_NEW, sc), \
-                            http, False, True, False)
+        if self.trace_history is not None:
+            info = {'stage': self.stage_id, 'service': self.service}
+            timing.append_history(self.trace_history, info)
 
-        except (RuntimeError, TypeError, NameError):
-            print "\nDone!"
-            raise
+    # Print the slowest compile and link steps of the web service build
+    def units_report(self, path, ws):
+        lines = unitstat.report(unitstat.read(path), ws)
+        if len(lines) == 0:
+            return
 
-    def SSL_configure(self, monkey_stage):
-        plgs = monkey_stage + "/conf/plugins.load"
-        f = open(plgs, "r")
-        lines = f.readlines()
-        f.close()
+        print_info("UNITS       : " + lines[-1])
+        for l in lines[:-1]:
+            print "    " + l
 
-        raw = ""
-        for line in lines:
-            if line.find('monkey-polarssl') > 0 and self.SSL is True:
-                raw += line.replace("# Load", "Load")
-            else:
-                raw += line
+    # The compiler cache statistics are reset when this run starts to
+    # build, once: the commands that do not build must not clear the ones
+    # of a build running on another dudac
+    def ccache_begin(self):
+        if self.ccache is None or self.ccache_begun is True:
+            return
 
-        f = open(plgs, "w")
-        f.write(raw)
-        f.close()
+        self.ccache_begun = True
+        self.ccache.reset_stats()
+
+    # Print the build statistics for this run. The cache is trimmed once
+    # per run, walking it on every watch mode rebuild is not worth it.
+    def build_report(self):
+        if self.ccache is None:
+            return
+
+        hits, misses = self.ccache.stats()
+        total = hits + misses
+        if total > 0:
+            print_info("CCACHE      : %i/%i hits (%.1f%%)" % \
+                           (hits, total, (hits * 100.0) / total))
+
+        if self.ccache_evicted is False:
+            self.ccache_evicted = True
+            self.ccache.evict()
+
+    def SSL_configure(self, monkey_stage, conf):
+        plgs = conf.get("plugins.load")
+        if self.SSL is True:
+            for i in range(len(plgs.lines)):
+                if plgs.lines[i].find('monkey-polarssl') > 0:
+                    plgs.lines[i] = plgs.lines[i].replace("# Load", "Load")
 
         # Check if SSL certificates exists
-        sslconf = monkey_stage + "/conf/plugins/polarssl/polarssl.conf"
-        f = open(sslconf, "r")
-        lines = f.readlines()
-        f.close()
+        sslconf = conf.get("plugins/polarssl/polarssl.conf")
 
         certificate_file = None
         rsa_key_file = None
         dh_param_file = None
-        for line in lines:
-            row = line.strip()
-            if row.startswith('CertificateFile'):
-                key, val = row.split()
-                if os.path.exists(val):
-                    certificate_file = val
-            elif row.startswith('RSAKeyFile'):
-                key, val = row.split()
-                if os.path.exists(val):
-                    rsa_key_file = val
-            elif row.startswith('DHParameterFile'):
-                key, val = row.split()
-                if os.path.exists(val):
-                    dh_param_file = val
+        for key in ['CertificateFile', 'RSAKeyFile', 'DHParameterFile']:
+            val = sslconf.value(key)
+            if val is None or not os.path.exists(val):
+                continue
+
+            if key == 'CertificateFile':
+                certificate_file = val
+            elif key == 'RSAKeyFile':
+                rsa_key_file = val
+            else:
+                dh_param_file = val
 
         # Generate Certificates if they dont exists
         p = monkey_stage + "/conf/plugins/polarssl/"
@@ -751,15 +1164,13 @@ class Duda:
         raw += "    CertificateFile " + certificate_file + "\n"
         raw += "    RSAKeyFile      " + rsa_key_file + "\n"
         raw += "    DHParameterFile " + dh_param_file + "\n\n"
-
-        f = open(sslconf, "w")
-        f.write(raw)
-        f.close()
+        sslconf.set(raw)
 
     def reset(self):
         if os.getenv('DUDAC_HOME') is None or self.reset_force is True:
             self.mk_git.remove(self.mk_home)
             self.duda_git.remove(self.duda_home)
+            self.stages.remove()
             try:
                 shutil.rmtree(self.dudac_stage_path)
             except:
@@ -773,13 +1184,20 @@ class Duda:
         print_color("http://monkey-project.com\n", ANSI_YELLOW, True)
 
     def print_help(self):
-        print "Usage: dudac [-g|-s] [-V] [-S] [-h] [-v] [-A] [-J] [-T] -w WEB_SERVICE_PATH\n"
+        print "Usage: dudac [-g|-s] [-V] [-S] [-h] [-v] [-A] [-J] [-T] [-j] -w WEB_SERVICE_PATH"
+        print "       dudac bench [-c CONN] [-d SECS] [-n REQS] [-r RATE] [-K] [-P] [-p PORT] [-o FILE] [URL ...]"
+        print "       dudac compare [-t PCT] [-a ALPHA] [-l] [BASE [HEAD]]"
+        print "       dudac flame [-o FILE] [-l] [BASE] [HEAD]"
+        print "       dudac heap [-n TOP] [-l] [RUN|DUMP [DUMP]]"
+        print "       dudac trace [-l] [TRACE]"
+        print "       dudac crashes [-n TOP] [-s STAGE] [SIGNATURE]\n"
         print ANSI_BOLD + ANSI_WHITE + "Stack Build Options" + ANSI_RESET
         print "  -V\t\t\tAPI level (default: %i)" % DEFAULT_API_LEVEL
         print "  -s\t\t\tGet stack sources using HTTPS"
         print "  -g\t\t\tGet stack sources using GIT protocol (SSH)"
         print "  -F\t\t\tForce mode, rebuild the Stage area"
-        print "  -r\t\t\tRemove stack sources"
+        print "  -j JOBS\t\tNumber of build jobs (default: based on CPUs and memory)"
+        print "  -r\t\t\tRemove stack sources (mirrors are kept)"
         print "  -R\t\t\tRemove stack sources even if $DUDAC_HOME is set"
         print
 
@@ -795,19 +1213,549 @@ class Duda:
         print "  -w WEB_SERVICE\tSpecify web service source path"
         print "  -S\t\t\tWeb Service will run with SSL mode enabled"
         print "  -M 'k1=v1,kn=vn'\tOverride some web server config key/value"
+        print "  --watch\t\tRebuild and restart the web service when its files change"
 
         print
         print ANSI_BOLD + ANSI_WHITE + "Others" + ANSI_RESET
         print "  -h\t\t\tPrint this help"
         print "  -u\t\t\tRedirect server output to STDOUT"
         print "  -v\t\t\tPrint version"
+        print "  --trace=FILE\t\tWrite the phases timing trace (default: ~/.dudac/trace.json)"
+        print "  --trace-history=FILE\tAppend the phases timing to a history file"
+        print
+
+        print ANSI_BOLD + ANSI_WHITE + "Bench Options" + ANSI_RESET
+        print "  -c CONN\t\tConcurrent connections (default: %i)" % bench.BENCH_CONNECTIONS
+        print "  -d SECS\t\tDuration of the test for each URL (default: %i)" % bench.BENCH_DURATION
+        print "  -n REQS\t\tStop after a number of requests"
+        print "  -r RATE\t\tRequests per second, latency is measured from the schedule"
+        print "  -K\t\t\tDisable keep-alive"
+        print "  -P\t\t\tProfile the server (perf, or /proc sampling) and write a flame graph"
+        print "  -p PORT\t\tUse the services of the instance running on a port (default 2001)"
+        print "  -o FILE\t\tWrite the results as JSON (default: ~/.dudac/bench/last.json)"
+        print
+
+        print ANSI_BOLD + ANSI_WHITE + "Compare Options" + ANSI_RESET
+        print "  BASE HEAD\t\tRun or stack ids (default: the last two runs)"
+        print "  -t PCT\t\tRegression threshold (default: %.1f%%)" % results.COMPARE_THRESHOLD
+        print "  -a ALPHA\t\tSignificance level of the t-test (default: %.2f)" % results.COMPARE_ALPHA
+        print "  -l\t\t\tList the stored runs"
+        print
+
+        print ANSI_BOLD + ANSI_WHITE + "Flame Options" + ANSI_RESET
+        print "  BASE HEAD\t\tProfiled bench runs, two gives a differential graph (default: the last two)"
+        print "  -o FILE\t\tWrite the SVG to a file (default: ~/.dudac/profile/BASE-HEAD.svg)"
+        print "  -l\t\t\tList the profiles"
+        print
+
+        print ANSI_BOLD + ANSI_WHITE + "Heap Options" + ANSI_RESET
+        print "  RUN\t\t\tRun directory of -J, it reports its last dump (default: the last run)"
+        print "  DUMP [DUMP]\t\tReport a heap profile, or the growth between two"
+        print "  -n TOP\t\tAllocation sites shown (default: %i)" % heapprof.HEAPPROF_TOP
+        print "  -l\t\t\tList the runs and their dumps"
+        print
+
+        print ANSI_BOLD + ANSI_WHITE + "Trace Options" + ANSI_RESET
+        print "  TRACE\t\t\tTrace directory of -T to analyze (default: the last one)"
+        print "  -l\t\t\tList the traces"
+        print
+
+        print ANSI_BOLD + ANSI_WHITE + "Crashes Options" + ANSI_RESET
+        print "  SIGNATURE\t\tShow a crash signature and its last occurrences"
+        print "  -n TOP\t\tSignatures shown for each stack build (default: 10)"
+        print "  -s STAGE\t\tOnly the crashes of a stack build (stage id)"
         print
 
         print ANSI_BOLD + ANSI_WHITE + "Environment Variables" + ANSI_RESET
         print "  DUDAC_HOME\t\tSet where to store the stack sources (default: ~/.dudac)"
-        print "  DUDAC_STAGE\t\tSet the stage build area (default: ~/.dudac/stage)"
+        print "  DUDAC_STAGE\t\tSet a fixed stage build area (default: ~/.dudac/stages/ID)"
+        print "  DUDAC_MIRRORS\t\tSet where to store the repositories mirrors (default: ~/.dudac/mirrors)"
+        print "  DUDAC_STAGE_BUDGET\tDisk budget in MB for cached stages (default: 2048)"
+        print "  DUDAC_JOB_MEMORY\tMemory in MB reserved for each build job (default: 256)"
+        print "  DUDAC_CCACHE\t\tSet to 0 to disable the compiler cache (default: 1)"
+        print "  DUDAC_CCACHE_SIZE\tCompiler cache size in MB (default: 1024)"
+        print "  DUDAC_JEMALLOC_INTERVAL\tSeconds between jemalloc stats dumps through gdb with -X,"
+        print "\t\t\tit stops the server on every dump, 0 disables (default: %i)" % jestats.JESTATS_INTERVAL
+        print "  DUDAC_JEPROF_INTERVAL\tSeconds between heap profile dumps through gdb with -J,"
+        print "\t\t\tit stops the server on every dump, 0 disables (default: %i)" % heapprof.HEAPPROF_INTERVAL
         print
 
+    # dudac bench [options] [URL ...]
+    # If no URL is given, the services of the instance running on the port
+    # are used.
+    def bench(self, argv):
+        connections = bench.BENCH_CONNECTIONS
+        duration = bench.BENCH_DURATION
+        rate = 0
+        requests = 0
+        keepalive = True
+        output = None
+        profile = False
+
+        try:
+            optlist, urls = getopt.getopt(argv, 'c:d:n:r:p:o:KPh')
+        except getopt.GetoptError:
+            self.print_help()
+            sys.exit(2)
+
+        for op, arg in optlist:
+            if op == '-h':
+                self.print_help()
+                sys.exit(0)
+            elif op == '-o':
+                output = arg
+            elif op == '-K':
+                keepalive = False
+            elif op == '-P':
+                profile = True
+            elif not str(arg).replace('.', '', 1).isdigit():
+                self.print_help()
+                exit(1)
+            elif op == '-c':
+                connections = max(1, int(arg))
+            elif op == '-d':
+                duration = float(arg)
+            elif op == '-n':
+                requests = int(arg)
+            elif op == '-r':
+                rate = float(arg)
+            elif op == '-p':
+                self.port = arg
+
+        # The stack is known only for the instance started by dudac
+        info = RunFile(self.dudac_home_path + 'run/', self.port).read()
+        if len(urls) == 0:
+            if info is None or len(info.get('urls', [])) == 0:
+                fail_msg("Error: no web service running on port %s, give the URLs" % \
+                             str(self.port))
+                exit(1)
+            urls = info['urls']
+
+        stack = {}
+        if info is not None and len(set(urls) - set(info.get('urls', []))) == 0:
+            stack = info.get('stack', {})
+
+        # The server is profiled for the length of the benchmark
+        prof = None
+        if profile is True:
+            if info is None:
+                fail_msg("Error: no web service running on port %s to profile" % \
+                             str(self.port))
+                exit(1)
+
+            prof_path = self.dudac_home_path + 'profile/'
+            if os.path.isdir(prof_path) is False:
+                os.makedirs(prof_path)
+            prof = cpuprof.profiler(info['pid'], prof_path + 'current')
+            if prof is None:
+                fail_msg("Error: cannot profile the instance %i" % info['pid'])
+                exit(1)
+            print_info("PROFILE     : instance %i (%s)" % (info['pid'], prof.method))
+
+        runs = []
+        for url in urls:
+            try:
+                b = bench.Bench(url, connections, duration, rate, requests, keepalive)
+            except (ValueError, socket.error), e:
+                if prof is not None:
+                    prof.stop()
+                fail_msg("Error: %s: %s" % (url, str(e)))
+                exit(1)
+
+            print "%s %-70s" % (MSG_NEW, "Bench       : " + url),
+            sys.stdout.flush()
+            r = b.run()
+            if r['requests'] > 0:
+                print MSG_OK
+            else:
+                print MSG_FAIL
+            runs.append(r)
+
+            for line in bench.report(r):
+                print "    " + line
+
+        if output is None:
+            output = self.dudac_home_path + 'bench/last.json'
+        if os.path.isdir(os.path.dirname(os.path.abspath(output))) is False:
+            os.makedirs(os.path.dirname(os.path.abspath(output)))
+
+        f = open(output, 'w')
+        json.dump({'time': time.time(), 'stack': stack, 'results': runs}, f, indent=2)
+        f.write('\n')
+        f.close()
+
+        entry = ResultsStore(self.dudac_home_path + 'bench/results/').save(stack, runs)
+        print_info("BENCH       : results at %s (id %s, stack %s)" % \
+                       (output, entry['id'], entry['stack_id']))
+
+        if prof is not None:
+            stacks = prof.stop()
+            base = self.dudac_home_path + 'profile/' + entry['id']
+            cpuprof.save(base + '.folded', stacks)
+            title = 'dudac bench %s - stage %s, service %s (%s)' % \
+                (entry['id'], info.get('stage', '-'), info.get('fingerprint', '-')[:12],
+                 prof.method)
+            write_if_changed(base + '.svg', cpuprof.flamegraph(stacks, title))
+            print_info("PROFILE     : %i samples, flame graph at %s.svg" % \
+                           (sum(stacks.values()), base))
+
+        for r in runs:
+            if r['requests'] == 0:
+                exit(1)
+
+    # dudac compare [options] [BASE [HEAD]]
+    # BASE and HEAD are run ids or stack ids, all the runs of a stack are
+    # pooled. By default the last two runs are compared.
+    def compare(self, argv):
+        threshold = results.COMPARE_THRESHOLD
+        alpha = results.COMPARE_ALPHA
+        store = ResultsStore(self.dudac_home_path + 'bench/results/')
+
+        try:
+            optlist, args = getopt.getopt(argv, 't:a:lh')
+        except getopt.GetoptError:
+            self.print_help()
+            sys.exit(2)
+
+        for op, arg in optlist:
+            if op == '-h':
+                self.print_help()
+                sys.exit(0)
+            elif op == '-l':
+                for e in store.entries():
+                    urls = len(e['results'])
+                    print "%s  stack %s  %i URLs  %s" % \
+                        (e['id'], e['stack_id'], urls,
+                         ' '.join(['%s=%s' % (k, str(v)[:10]) for k, v in
+                                   sorted(e['stack'].items()) if k in ['monkey', 'duda']]))
+                sys.exit(0)
+
+            try:
+                if op == '-t':
+                    threshold = float(arg)
+                elif op == '-a':
+                    alpha = float(arg)
+            except ValueError:
+                self.print_help()
+                exit(1)
+
+        entries = store.entries()
+        if len(args) == 0:
+            if len(entries) < 2:
+                fail_msg("Error: at least two benchmark runs are needed")
+                exit(1)
+            base = [entries[-2]]
+            head = [entries[-1]]
+        elif len(args) == 1:
+            base = store.find(args[0])
+            head = entries[-1:]
+        else:
+            base = store.find(args[0])
+            head = store.find(args[1])
+
+        for key, runs in [('base', base), ('head', head)]:
+            if len(runs) == 0:
+                fail_msg("Error: no benchmark runs found for the %s" % key)
+                exit(1)
+
+        print_info("BASE        : %s (%i runs)" % (base[-1]['stack_id'], len(base)))
+        print_info("HEAD        : %s (%i runs)" % (head[-1]['stack_id'], len(head)))
+        for line in results.stack_diff(base[-1]['stack'], head[-1]['stack']):
+            print "    " + line
+
+        rows = results.compare(base, head, threshold, alpha)
+        if len(rows) == 0:
+            fail_msg("Error: the runs have no URLs in common")
+            exit(1)
+
+        regressions = 0
+        for r in rows:
+            if r['regression'] is True:
+                regressions += 1
+                print "%s %s" % (MSG_FAIL, r['url'])
+            else:
+                print "%s %s" % (MSG_OK, r['url'])
+
+            print "    req/s      %10.1f -> %10.1f  %+6.1f%%  p=%.4f" % r['rps']
+            print "    latency ms %10.3f -> %10.3f  %+6.1f%%  p=%.4f" % r['latency']
+            print "    p99 ms     %10.3f -> %10.3f  %+6.1f%%" % r['p99']
+            if r['short'] is True:
+                print "    run too short for the throughput t-test, use -d %i or more" % \
+                    (results.COMPARE_WARMUP + results.COMPARE_MIN_SAMPLES)
+
+        if regressions > 0:
+            fail_msg("%i regressions (threshold %.1f%%, alpha %.3f)" % \
+                         (regressions, threshold, alpha))
+            exit(1)
+
+    # dudac heap [options] [RUN|DUMP [DUMP]]
+    # Without arguments the last dump of the last -J run is reported, two
+    # dumps report the live memory growth between them.
+    def heap(self, argv):
+        top = heapprof.HEAPPROF_TOP
+        path = self.dudac_home_path + 'jeprof/'
+
+        try:
+            optlist, args = getopt.getopt(argv, 'n:lh')
+        except getopt.GetoptError:
+            self.print_help()
+            sys.exit(2)
+
+        runs = []
+        if os.path.isdir(path):
+            runs = sorted([os.path.join(path, d) for d in os.listdir(path)
+                           if os.path.isdir(os.path.join(path, d))])
+
+        for op, arg in optlist:
+            if op == '-h':
+                self.print_help()
+                sys.exit(0)
+            elif op == '-l':
+                for r in runs:
+                    print "%s  %i dumps" % (r, len(heapprof.dumps(r)))
+                    for d in heapprof.dumps(r):
+                        print "    " + os.path.basename(d)
+                sys.exit(0)
+            elif op == '-n':
+                try:
+                    top = int(arg)
+                except ValueError:
+                    self.print_help()
+                    exit(1)
+
+        if len(args) == 0:
+            if len(runs) == 0:
+                fail_msg("Error: no heap profiles found, run the web service with -J")
+                exit(1)
+            args = [runs[-1]]
+
+        files = []
+        for a in args[:2]:
+            if os.path.isdir(a):
+                dumps = heapprof.dumps(a)
+                if len(dumps) == 0:
+                    fail_msg("Error: no heap profiles found at " + a)
+                    exit(1)
+                files.append(dumps[-1])
+            elif os.path.isfile(a):
+                files.append(a)
+            else:
+                fail_msg("Error: cannot find " + a)
+                exit(1)
+
+        try:
+            profiles = [heapprof.parse(f) for f in files]
+        except IOError, e:
+            fail_msg("Error: cannot read the heap profile: " + str(e))
+            exit(1)
+
+        sym = heapprof.Symbolizer()
+        if len(profiles) == 1:
+            print_info("HEAP        : " + files[0])
+            lines = heapprof.report(profiles[0], sym, top)
+        else:
+            print_info("HEAP        : %s -> %s" % (files[0], files[1]))
+            lines = heapprof.diff(profiles[0], profiles[1], sym, top)
+
+        for line in lines:
+            print "    " + line
+
+    # dudac flame [options] [BASE] [HEAD]
+    # BASE and HEAD are benchmark run ids (or .folded files) profiled with
+    # 'dudac bench -P'. One profile renders its flame graph again, two a
+    # differential flame graph. By default the last two profiles are used.
+    def flame(self, argv):
+        output = None
+        path = self.dudac_home_path + 'profile/'
+
+        try:
+            optlist, args = getopt.getopt(argv, 'o:lh')
+        except getopt.GetoptError:
+            self.print_help()
+            sys.exit(2)
+
+        profiles = []
+        if os.path.isdir(path):
+            profiles = sorted([os.path.join(path, f) for f in os.listdir(path)
+                               if f.endswith('.folded')])
+
+        for op, arg in optlist:
+            if op == '-h':
+                self.print_help()
+                sys.exit(0)
+            elif op == '-o':
+                output = arg
+            elif op == '-l':
+                for p in profiles:
+                    print os.path.basename(p)[:-7]
+                sys.exit(0)
+
+        files = []
+        for a in args[:2]:
+            if os.path.isfile(a):
+                files.append(a)
+                continue
+
+            match = [p for p in profiles if os.path.basename(p).startswith(a)]
+            if len(match) == 0:
+                fail_msg("Error: no profile found for " + a)
+                exit(1)
+            files.append(match[-1])
+
+        if len(files) == 0:
+            if len(profiles) < 2:
+                fail_msg("Error: at least two profiles are needed, use 'dudac bench -P'")
+                exit(1)
+            files = profiles[-2:]
+
+        try:
+            stacks = [cpuprof.load(f) for f in files]
+        except IOError, e:
+            fail_msg("Error: cannot read the profile: " + str(e))
+            exit(1)
+
+        names = [os.path.basename(f).rsplit('.', 1)[0] for f in files]
+        if len(files) == 1:
+            title = 'Profile %s' % names[0]
+            svg = cpuprof.flamegraph(stacks[0], title)
+        else:
+            title = 'Differential profile %s -> %s' % (names[0], names[1])
+            svg = cpuprof.flamegraph(stacks[1], title, stacks[0])
+
+        if output is None:
+            output = os.path.join(path, '-'.join(names) + '.svg')
+        write_if_changed(output, svg)
+        print_info("FLAME       : " + output)
+
+    # dudac trace [options] [TRACE]
+    # Analyze again a trace recorded with -T, by default the last one
+    def trace(self, argv):
+        path = self.dudac_home_path + 'lttng/'
+
+        try:
+            optlist, args = getopt.getopt(argv, 'lh')
+        except getopt.GetoptError:
+            self.print_help()
+            sys.exit(2)
+
+        traces = lttng.traces(path)
+        for op, arg in optlist:
+            if op == '-h':
+                self.print_help()
+                sys.exit(0)
+            elif op == '-l':
+                for t in traces:
+                    print t
+                sys.exit(0)
+
+        if len(args) > 0:
+            target = args[0]
+            if os.path.isdir(target) is False:
+                target = os.path.join(path, args[0])
+        elif len(traces) > 0:
+            target = traces[-1]
+        else:
+            fail_msg("Error: no traces found, run the web service with -T")
+            exit(1)
+
+        if os.path.isdir(target) is False:
+            fail_msg("Error: cannot find the trace " + args[0])
+            exit(1)
+
+        summary = lttng.analyze(target)
+        if summary is None:
+            exit(1)
+
+        lttng.save(target, summary)
+        print_info("TRACE       : %i events at %s" % (summary['events'], target))
+        for line in lttng.report(summary):
+            print "    " + line
+
+    # dudac crashes [options] [SIGNATURE]
+    # The most frequent crash signatures of every stack build, or the
+    # details of a signature
+    def crashes(self, argv):
+        top = 10
+        stack = None
+        path = self.dudac_home_path + 'crashes.db'
+
+        try:
+            optlist, args = getopt.getopt(argv, 'n:s:h')
+        except getopt.GetoptError:
+            self.print_help()
+            sys.exit(2)
+
+        for op, arg in optlist:
+            if op == '-h':
+                self.print_help()
+                sys.exit(0)
+            elif op == '-s':
+                stack = arg
+            elif op == '-n':
+                try:
+                    top = int(arg)
+                except ValueError:
+                    self.print_help()
+                    exit(1)
+
+        if os.path.isfile(path) is False:
+            print_info("CRASHES     : no crashes recorded")
+            return
+
+        db = crashdb.CrashDB(path)
+        fmt = '%Y/%m/%d %H:%M:%S'
+
+        if len(args) > 0:
+            sigs = db.signature(args[0])
+            if len(sigs) == 0:
+                fail_msg("Error: no crash signature " + args[0])
+                exit(1)
+
+            for s in sigs:
+                print_info("SIGNATURE   : %s, %s, seen %i times" % \
+                               (s['signature'], s['signal'], s['count']))
+                print "    first %s, last %s" % \
+                    (time.strftime(fmt, time.localtime(s['first_seen'])),
+                     time.strftime(fmt, time.localtime(s['last_seen'])))
+                for f in s['frames'].split('\n'):
+                    print "    " + f
+
+                crashes = db.crashes(s['signature'], top)
+                for c in crashes:
+                    print "    %s  stage %s  pid %i  fingerprint %s  core %s" % \
+                        (time.strftime(fmt, time.localtime(c['time'])),
+                         c['stack'], c['pid'], c['fingerprint'], c['core'])
+
+                if len(crashes) > 0 and crashes[0]['backtrace'] is not None:
+                    print
+                    print crashes[0]['backtrace'].encode('utf-8')
+            db.close()
+            return
+
+        rows = db.top(stack, top)
+        unsigned = db.unsigned(stack)
+        db.close()
+        if len(rows) == 0 and len(unsigned) == 0:
+            print_info("CRASHES     : no crashes recorded")
+            return
+
+        for s in sorted(set(rows.keys() + unsigned.keys())):
+            stage = rows.get(s, [])
+            print_info("STAGE       : %s (%i crashes)" % \
+                           (s, sum([r['count'] for r in stage]) + unsigned.get(s, 0)))
+            if len(stage) > 0:
+                print "    %-16s %6s %12s %-8s %-19s %-19s  %s" % \
+                    ('signature', 'count', 'fingerprints', 'signal', 'first', 'last',
+                     'top frames')
+            for r in stage:
+                print "    %-16s %6i %12i %-8s %-19s %-19s  %s" % \
+                    (r['signature'], r['count'], r['fingerprints'], r['signal'],
+                     time.strftime(fmt, time.localtime(r['first_seen'])),
+                     time.strftime(fmt, time.localtime(r['last_seen'])),
+                     ' <- '.join(r['frames'].split('\n')[:3]))
+            if s in unsigned:
+                print "    %i crashes without backtrace, no signature" % unsigned[s]
+
     # it creates a configuration schema to override the values of the main
     # Monkey configuration file
     def conf_schema(self, value):
@@ -842,9 +1790,30 @@ class Duda:
         if 'DEFS' not in os.environ:
             os.environ['DEFS'] = ''
 
+        # Commands
+        if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+            self.bench(sys.argv[2:])
+            return
+        elif len(sys.argv) > 1 and sys.argv[1] == 'compare':
+            self.compare(sys.argv[2:])
+            return
+        elif len(sys.argv) > 1 and sys.argv[1] == 'flame':
+            self.flame(sys.argv[2:])
+            return
+        elif len(sys.argv) > 1 and sys.argv[1] == 'trace':
+            self.trace(sys.argv[2:])
+            return
+        elif len(sys.argv) > 1 and sys.argv[1] == 'crashes':
+            self.crashes(sys.argv[2:])
+            return
+        elif len(sys.argv) > 1 and sys.argv[1] == 'heap':
+            self.heap(sys.argv[2:])
+            return
+
         # Reading command line arguments
         try:
-            optlist, args = getopt.getopt(sys.argv[1:], 'DV:sgFrRhvSuw:p:AXJTM:')
+            optlist, args = getopt.getopt(sys.argv[1:], 'DV:sgFrRhvSuw:p:AXJTM:j:',
+                                          ['trace=', 'trace-history=', 'watch'])
         except getopt.GetoptError:
             self.print_help()
             sys.exit(2)
@@ -884,6 +1853,17 @@ class Duda:
                 self.jemalloc_prof = True
             elif op == '-M':
                 monkey_conf = arg
+            elif op == '--trace':
+                self.trace_file = arg
+            elif op == '--trace-history':
+                self.trace_history = arg
+            elif op == '--watch':
+                self.watch = True
+            elif op == '-j':
+                if not str(arg).isdigit() or int(arg) == 0:
+                    self.print_help()
+                    exit(1)
+                self.build_jobs = int(arg)
             elif op == '-D':
                 self.service_macros = arg
             elif op == '-T':
@@ -904,7 +1884,6 @@ class Duda:
                 sys.exit(0)
 
         print_info("HOME        : " + self.dudac_home_path)
-        print_info("STAGE       : " + self.dudac_stage_path)
 
         # Reset environment
         if self.reset_environment is True:
@@ -923,8 +1902,14 @@ class Duda:
             os.environ['JEMALLOC_OPTS']  += '--enable-prof'
             os.environ['JE_MALLOC_CONF']  = 'prof_leak:true,prof:true,prof_prefix:duda.jeprof'
 
-        # More environment vars: make will use 8 jobs
-        os.environ['MAKEFLAGS'] = '-j 8'
+        # More environment vars: every make joins our jobserver, the number
+        # of jobs depends on the CPUs and memory available
+        if self.build_jobs is None:
+            self.build_jobs = job_count()
+
+        self.jobserver = JobServer(self.build_jobs)
+        os.environ['MAKEFLAGS'] = self.jobserver.makeflags()
+        print_info("JOBS        : %i" % self.build_jobs)
 
         # Linux Trace Toolkit
         if self.linux_trace is True:
@@ -939,6 +1924,12 @@ class Duda:
             os.environ['JEMALLOC_OPTS'] += ' --enable-stats'
             os.environ['DEFS'] += ' -DJEMALLOC_STATS'
 
+            # jemalloc prints the statistics when the server exits
+            conf = os.getenv('JE_MALLOC_CONF', '')
+            if len(conf) > 0:
+                conf += ','
+            os.environ['JE_MALLOC_CONF'] = conf + 'stats_print:true'
+
         # Rebuild the stack ?
         if update is not None:
             if self.rebuild_monkey is True:
@@ -946,6 +1937,9 @@ class Duda:
                 exit(1)
 
             self.update_framework(update)
+            if not self.service:
+                self.build_report()
+                self.timing_report()
 
         # Override Monkey configuration. It will create the configuration
         # schema which is used later by the run_webservice() method.
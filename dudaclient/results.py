@@ -0,0 +1,271 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Benchmark results store
+# =======================
+# Every 'dudac bench' run is stored as a JSON file together with the stack
+# it measured: Monkey and Duda commits, configure options, allocator, SSL
+# and monkey.conf overrides. Two runs (or two stacks, pooling all their
+# runs) are compared with a Welch's t-test over the throughput per second
+# and the request latency.
+
+import os
+import json
+import math
+import time
+import hashlib
+
+# Relative change (%) considered a regression
+COMPARE_THRESHOLD = 5.0
+
+# Significance level of the tests
+COMPARE_ALPHA = 0.05
+
+# Seconds of every run discarded as warm up
+COMPARE_WARMUP = 1
+
+# Throughput samples (seconds) needed from a run for the t-test
+COMPARE_MIN_SAMPLES = 2
+
+def stack_id(stack):
+    return hashlib.sha1(json.dumps(stack, sort_keys=True)).hexdigest()[:12]
+
+class ResultsStore:
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, stack, results):
+        if os.path.isdir(self.path) is False:
+            os.makedirs(self.path)
+
+        now = time.time()
+        rid = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        rid += '-' + stack_id(stack)[:6]
+
+        entry = {'id'      : rid,
+                 'time'    : now,
+                 'stack'   : stack,
+                 'stack_id': stack_id(stack),
+                 'results' : results}
+
+        f = open(os.path.join(self.path, rid + '.json'), 'w')
+        json.dump(entry, f, indent=2, sort_keys=True)
+        f.write('\n')
+        f.close()
+
+        return entry
+
+    # All the stored runs, the oldest first
+    def entries(self):
+        entries = []
+        if os.path.isdir(self.path) is False:
+            return entries
+
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+
+            try:
+                f = open(os.path.join(self.path, name), 'r')
+                entries.append(json.load(f))
+                f.close()
+            except (IOError, ValueError):
+                continue
+
+        entries.sort(key=lambda e: e['time'])
+        return entries
+
+    # Runs matching a run id or a stack id (or their prefix)
+    def find(self, key):
+        return [e for e in self.entries() if e['id'].startswith(key) or
+                e['stack_id'].startswith(key)]
+
+# Regularized incomplete beta function I_x(a, b), continued fraction
+# evaluation (Numerical Recipes, betacf)
+def betacf(a, b, x):
+    tiny = 1e-30
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    if abs(d) < tiny:
+        d = tiny
+    d = 1.0 / d
+    h = d
+
+    for m in range(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        h *= d * c
+
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-12:
+            break
+
+    return h
+
+def betainc(a, b, x):
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+
+    lbeta = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + \
+        a * math.log(x) + b * math.log(1.0 - x)
+    front = math.exp(lbeta)
+
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * betacf(a, b, x) / a
+    return 1.0 - front * betacf(b, a, 1.0 - x) / b
+
+# Welch's t-test from the summary of two samples, it returns the two sided
+# p-value (1.0 when there is not enough data)
+def welch(mean1, var1, n1, mean2, var2, n2):
+    if n1 < 2 or n2 < 2:
+        return 1.0
+
+    se = var1 / n1 + var2 / n2
+    if se <= 0:
+        if mean1 == mean2:
+            return 1.0
+        return 0.0
+
+    t = (mean1 - mean2) / math.sqrt(se)
+    df = se * se / ((var1 / n1) ** 2 / (n1 - 1) + (var2 / n2) ** 2 / (n2 - 1))
+    return betainc(df / 2.0, 0.5, df / (df + t * t))
+
+def summary(values):
+    n = len(values)
+    if n == 0:
+        return (0.0, 0.0, 0)
+
+    mean = float(sum(values)) / n
+    if n < 2:
+        return (mean, 0.0, n)
+
+    var = sum([(v - mean) ** 2 for v in values]) / (n - 1)
+    return (mean, var, n)
+
+# Pool the results of the same URL over many runs: the throughput samples
+# per second and the latency mean/variance of every request
+def pool(entries, url):
+    rps = []
+    n = 0
+    total = 0.0
+    total_sq = 0.0
+    p99 = []
+    short = False
+    for e in entries:
+        for r in e['results']:
+            if r['url'] != url:
+                continue
+
+            # the warm up is discarded only if enough samples are left, a
+            # run under a second has only its average throughput
+            timeline = r['timeline']
+            if len(timeline) - COMPARE_WARMUP >= COMPARE_MIN_SAMPLES:
+                timeline = timeline[COMPARE_WARMUP:]
+            elif len(timeline) == 0:
+                timeline = [r['rps']]
+            if len(timeline) < COMPARE_MIN_SAMPLES:
+                short = True
+
+            rps += timeline
+            lat = r['latency']
+            count = r['requests']
+            if count == 0:
+                continue
+
+            # rebuild the sums from mean and standard deviation
+            total += lat['mean'] * count
+            total_sq += lat['stddev'] ** 2 * (count - 1) + lat['mean'] ** 2 * count
+            n += count
+            p99.append(lat['p99'])
+
+    if n > 1:
+        mean = total / n
+        var = max(0.0, (total_sq - n * mean * mean) / (n - 1))
+    else:
+        mean = total
+        var = 0.0
+
+    return {'rps': summary(rps), 'latency': (mean, var, n),
+            'p99': summary(p99)[0], 'short': short}
+
+def delta(old, new):
+    if old == 0:
+        return 0.0
+    return (new - old) * 100.0 / old
+
+# Compare two sets of runs. It returns a list of rows, one per URL with the
+# deltas, p-values, if it's a regression and if a run was too short to
+# test its throughput.
+def compare(base, head, threshold=COMPARE_THRESHOLD, alpha=COMPARE_ALPHA):
+    urls = []
+    for e in base:
+        for r in e['results']:
+            if r['url'] not in urls:
+                urls.append(r['url'])
+
+    rows = []
+    for url in urls:
+        a = pool(base, url)
+        b = pool(head, url)
+        if a['rps'][2] == 0 or b['rps'][2] == 0:
+            continue
+
+        rps_delta = delta(a['rps'][0], b['rps'][0])
+        rps_p = welch(*(a['rps'] + b['rps']))
+        lat_delta = delta(a['latency'][0], b['latency'][0])
+        lat_p = welch(*(a['latency'] + b['latency']))
+
+        regression = (rps_delta < -threshold and rps_p < alpha) or \
+            (lat_delta > threshold and lat_p < alpha)
+
+        rows.append({'url'       : url,
+                     'rps'       : (a['rps'][0], b['rps'][0], rps_delta, rps_p),
+                     'latency'   : (a['latency'][0], b['latency'][0], lat_delta, lat_p),
+                     'p99'       : (a['p99'], b['p99'], delta(a['p99'], b['p99'])),
+                     'short'     : a['short'] or b['short'],
+                     'regression': regression})
+
+    return rows
+
+# Lines describing the differences between two stacks
+def stack_diff(a, b):
+    lines = []
+    for k in sorted(set(a.keys()) | set(b.keys())):
+        if a.get(k) != b.get(k):
+            lines.append('%-10s %s -> %s' % (k, a.get(k), b.get(k)))
+
+    return lines
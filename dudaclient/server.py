@@ -0,0 +1,338 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import shutil
+import socket
+import threading
+import subprocess
+
+from utils import *
+from conf import ConfigTree
+
+# Seconds to wait for the server to exit after SIGTERM
+SERVER_STOP_TIMEOUT = 5
+
+# Seconds to wait for a new instance to listen on the port
+SERVER_READY_TIMEOUT = 10
+
+# Seconds the old instance keeps running once the new one accepts
+# connections, so the requests in progress can finish
+SERVER_DRAIN = 0.5
+
+# Linux value, Python 2 do not always export it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# TCP state of a listening socket on /proc/net/tcp
+TCP_LISTEN = '0A'
+
+# Check if the server listening on the TCP port allows another socket on
+# it, what's needed to run the new instance beside the old one: a socket
+# with SO_REUSEPORT can only be bound if the listener set it too. The
+# socket is never listening, it does not get any connection.
+def listener_reuseport(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            s.bind(('', int(port)))
+        except socket.error:
+            return False
+    finally:
+        s.close()
+
+    return True
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+
+    return True
+
+# Check if the process has a listening socket on the TCP port
+def pid_listening(pid, port):
+    inodes = set()
+    fd_path = '/proc/%i/fd' % pid
+    try:
+        for fd in os.listdir(fd_path):
+            try:
+                link = os.readlink(os.path.join(fd_path, fd))
+            except OSError:
+                continue
+            if link.startswith('socket:['):
+                inodes.add(link[8:-1])
+    except OSError:
+        return False
+
+    for table in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            f = open(table, 'r')
+            lines = f.readlines()[1:]
+            f.close()
+        except IOError:
+            continue
+
+        for line in lines:
+            arr = line.split()
+            if len(arr) < 10 or arr[3] != TCP_LISTEN:
+                continue
+            if int(arr[1].split(':')[1], 16) == port and arr[9] in inodes:
+                return True
+
+    return False
+
+# The server instance serving a port. The run file is shared by every
+# dudac process so a new one can find the instance it must replace.
+class RunFile:
+    def __init__(self, path, port):
+        self.path = path
+        self.file = os.path.join(path, '%s.json' % str(port))
+
+    # Return the information of the running instance, None if there is no
+    # instance alive
+    def read(self):
+        try:
+            f = open(self.file, 'r')
+            info = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return None
+
+        pid = info.get('pid')
+        if pid is None or pid_alive(pid) is False:
+            return None
+
+        # the pid may belong to another process now
+        try:
+            f = open('/proc/%i/cmdline' % pid, 'r')
+            cmdline = f.read()
+            f.close()
+        except IOError:
+            return None
+
+        if cmdline.find('monkey') < 0:
+            return None
+
+        return info
+
+    def write(self, info):
+        if os.path.isdir(self.path) is False:
+            os.makedirs(self.path)
+        write_if_changed(self.file, json.dumps(info) + '\n')
+
+    # Remove the file only if it still describes our instance
+    def remove(self, pid):
+        try:
+            f = open(self.file, 'r')
+            info = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return
+
+        if info.get('pid') == pid:
+            os.unlink(self.file)
+
+# The HTTP server running in background. Its output goes to the log file
+# and the last lines are kept in memory for the crash report, unless it's
+# printed directly to STDOUT.
+class Server:
+    def __init__(self, command, output_stdout=False):
+        self.command = command
+        self.output_stdout = output_stdout
+        self.process = None
+        self.reader = None
+        self.buf = OutputBuffer()
+
+        # Functions that gets every line printed by the server
+        self.listeners = []
+
+        # Probes attached to every instance: they can watch the output once
+        # attached, and are notified when the process starts and finish
+        self.probes = []
+        self.finished = False
+        self.started = None
+
+        # Environment variables and command line arguments set by the
+        # probes for this instance
+        self.env = {}
+        self.args = []
+
+    def start(self):
+        self.buf = OutputBuffer()
+        self.listeners = []
+        self.env = {}
+        self.args = []
+        self.finished = False
+        self.started = time.time()
+        for p in self.probes:
+            p.attach(self)
+
+        if self.output_stdout is True and len(self.listeners) == 0:
+            out = None
+        else:
+            out = subprocess.PIPE
+
+        # exec: the signals must reach the server, not the shell
+        env = dict(os.environ)
+        env.update(self.env)
+        command = ' '.join([self.command] + self.args)
+        self.process = subprocess.Popen("exec " + command, shell=True,
+                                        stdout=out, stderr=subprocess.STDOUT,
+                                        env=env)
+        if out is not None:
+            self.reader = threading.Thread(target=self.read)
+            self.reader.daemon = True
+            self.reader.start()
+
+        for p in self.probes:
+            p.started(self)
+
+    def read(self):
+        log = log_open()
+        if log is not None:
+            log.write('\n$ %s\n' % self.command)
+
+        for line in iter(self.process.stdout.readline, ''):
+            if log is not None:
+                log.write(line)
+            self.buf.append(line)
+
+            if self.output_stdout is True:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+
+            for l in self.listeners:
+                l(line)
+
+        self.process.stdout.close()
+        if log is not None:
+            log.flush()
+
+    def pid(self):
+        return self.process.pid
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    # Wait for the server to exit, it returns the wait() status or None if
+    # it's still running after the timeout
+    def wait(self, timeout=None):
+        if timeout is None:
+            self.process.wait()
+        else:
+            end = time.time() + timeout
+            while self.process.poll() is None:
+                if time.time() >= end:
+                    return None
+                time.sleep(0.05)
+
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+
+        if self.finished is False:
+            self.finished = True
+            for p in self.probes:
+                p.finished(self)
+
+        return wait_status(self.process.returncode)
+
+    def stop(self, timeout=SERVER_STOP_TIMEOUT):
+        if self.running() is False:
+            return self.wait()
+
+        self.process.send_signal(signal.SIGTERM)
+        status = self.wait(timeout)
+        if status is None:
+            self.process.kill()
+            status = self.wait()
+
+        return status
+
+    def output(self):
+        return self.buf.value()
+
+    # Start beside the instance 'old_pid' listening on the same port, once
+    # this one accepts connections the old one is stopped. It returns False
+    # if the new instance could not get ready, it's not running then.
+    def handoff(self, old_pid, port, timeout=SERVER_READY_TIMEOUT):
+        self.start()
+
+        end = time.time() + timeout
+        while pid_listening(self.pid(), int(port)) is False:
+            if self.running() is False or time.time() >= end:
+                self.stop()
+                return False
+            time.sleep(0.05)
+
+        time.sleep(SERVER_DRAIN)
+        try:
+            os.kill(old_pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+        return True
+
+    # The server was stopped by a signal we (or a new dudac) sent, or by
+    # the user from the terminal
+    def stopped(self, status):
+        return os.WEXITSTATUS(status) in [0, 128 + signal.SIGTERM,
+                                          128 + signal.SIGINT]
+
+    # The server exited by itself, report it as any other command
+    def failed(self, crash_debug=True):
+        status = self.wait()
+        command_failed(self.command, (status, self.output()), crash_debug,
+                       self.pid(), self.started)
+
+# Every instance runs with its own copy of the stage configuration, where
+# the PidFile is its own: during a handoff the old and the new instance
+# live together, with a shared PidFile the new one could not register or
+# the old one would remove it on exit.
+class InstanceConf:
+    def __init__(self, confdir, path):
+        self.confdir = confdir
+        self.path = path
+        self.target = None
+
+    def attach(self, server):
+        self.target = run_directory(self.path)
+        conf = os.path.join(self.target, 'conf')
+        shutil.copytree(self.confdir, conf, symlinks=True)
+
+        tree = ConfigTree(conf)
+        monkey = tree.get('monkey.conf')
+        entry = '    PidFile %s\n' % os.path.join(self.target, 'monkey.pid')
+        if monkey.replace('    PidFile', entry) == 0:
+            monkey.replace('    # PidFile', entry)
+        tree.flush()
+
+        server.args += ['-c', conf]
+
+    def started(self, server):
+        pass
+
+    def finished(self, server):
+        if self.target is not None:
+            shutil.rmtree(self.target, True)
+            self.target = None
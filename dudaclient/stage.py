@@ -0,0 +1,157 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import shutil
+import hashlib
+
+from utils import *
+
+# Name of the marker file stored on every built stage
+STAGE_MARKER = 'stage.dudac'
+
+# Default disk budget for all cached stages (MB)
+STAGE_BUDGET = 2048
+
+# The StageCache keeps many stage areas side by side under the same root
+# directory. Each stage is named after a fingerprint of everything that
+# affects the build result: Monkey and Duda commits, configure flags,
+# plugins and allocator options. A stage is considered built once its
+# marker file exists with the same fingerprint.
+class StageCache:
+    def __init__(self, root, budget=None):
+        self.root = root
+        if budget is None:
+            budget = os.getenv('DUDAC_STAGE_BUDGET')
+
+        try:
+            self.budget = int(budget) * 1024 * 1024
+        except (TypeError, ValueError):
+            self.budget = STAGE_BUDGET * 1024 * 1024
+
+    # Compose a fingerprint from a dictionary of keys
+    def fingerprint(self, keys):
+        h = hashlib.sha1()
+        for k in sorted(keys.keys()):
+            h.update('%s=%s\n' % (k, keys[k]))
+
+        return h.hexdigest()
+
+    # Absolute path for the stage of a given fingerprint
+    def path(self, fp):
+        return os.path.join(self.root, fp[:16]) + '/'
+
+    # Read the marker of a stage, it returns a dictionary with the keys
+    # used to compose the fingerprint or None if the stage is not built
+    def info(self, stage_path):
+        marker = os.path.join(stage_path, STAGE_MARKER)
+        if not os.path.isfile(marker):
+            return None
+
+        keys = {}
+        f = open(marker, 'r')
+        for line in f.readlines():
+            if line.find('=') <= 0:
+                continue
+            key, val = line.split('=', 1)
+            keys[key.strip()] = val.strip()
+        f.close()
+
+        return keys
+
+    def is_built(self, stage_path, fp):
+        keys = self.info(stage_path)
+        if keys is None or keys.get('fingerprint') != fp:
+            return False
+
+        self.touch(stage_path)
+        return True
+
+    # Update the last time the stage was used, this is what the LRU
+    # eviction looks at
+    def touch(self, stage_path):
+        marker = os.path.join(stage_path, STAGE_MARKER)
+        try:
+            os.utime(marker, None)
+        except OSError:
+            pass
+
+    # Flag a stage as built
+    def save(self, stage_path, fp, keys):
+        raw = 'fingerprint = %s\n' % fp
+        for k in sorted(keys.keys()):
+            raw += '%s = %s\n' % (k, keys[k])
+
+        f = open(os.path.join(stage_path, STAGE_MARKER), 'w')
+        f.write(raw)
+        f.close()
+
+    # List the cached stages as tuples of (last used, path)
+    def stages(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+
+        for name in os.listdir(self.root):
+            p = os.path.join(self.root, name) + '/'
+            marker = os.path.join(p, STAGE_MARKER)
+            if os.path.isfile(marker):
+                last = os.path.getmtime(marker)
+            else:
+                # unfinished build, consider it the oldest one
+                last = 0
+            entries.append((last, p))
+
+        entries.sort()
+        return entries
+
+    def disk_usage(self, path):
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                total += st.st_blocks * 512
+
+        return total
+
+    # Remove the least recently used stages until the whole cache fits
+    # in the disk budget. The stage in use is never evicted.
+    def evict(self, keep):
+        entries = self.stages()
+        usage = {}
+        total = 0
+        for last, p in entries:
+            usage[p] = self.disk_usage(p)
+            total += usage[p]
+
+        keep = os.path.normpath(keep)
+        for last, p in entries:
+            if total <= self.budget:
+                break
+
+            if os.path.normpath(p) == keep:
+                continue
+
+            shutil.rmtree(p, True)
+            total -= usage[p]
+            print_info("STAGE       : evicted %s" % p)
+
+    def remove(self):
+        shutil.rmtree(self.root, True)
@@ -0,0 +1,122 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Timing trace
+# ============
+# Every phase of a dudac run is recorded with its wall and CPU time, the
+# later includes the child processes (compilers, GIT, etc). The result can
+# be exported in the Chrome trace event format (chrome://tracing) and as a
+# one line summary.
+
+import os
+import time
+import json
+from contextlib import contextmanager
+
+# Recorded events and the time the run started
+events     = []
+start_time = time.time()
+
+def cpu_times():
+    t = os.times()
+    return (t[0] + t[1], t[2] + t[3])
+
+# Start a phase, it returns the token that finish it through end()
+def begin(name):
+    cpu, children = cpu_times()
+    return (name, time.time(), cpu, children)
+
+def end(token):
+    name, wall, cpu, children = token
+    end_cpu, end_children = cpu_times()
+    events.append({'name'    : name,
+                   'ts'      : wall,
+                   'dur'     : time.time() - wall,
+                   'cpu'     : end_cpu - cpu,
+                   'children': end_children - children})
+
+@contextmanager
+def phase(name):
+    token = begin(name)
+    try:
+        yield
+    finally:
+        end(token)
+
+# An instant event, e.g: the server start
+def mark(name):
+    events.append({'name': name, 'ts': time.time(), 'dur': None})
+
+def total():
+    return time.time() - start_time
+
+# Events in the Chrome trace event format, times are in microseconds
+def chrome():
+    pid = os.getpid()
+    trace = []
+    for e in events:
+        ev = {'name': e['name'], 'cat': 'dudac', 'pid': pid, 'tid': 1,
+              'ts': int((e['ts'] - start_time) * 1000000)}
+        if e['dur'] is None:
+            ev['ph'] = 'i'
+            ev['s'] = 'p'
+        else:
+            ev['ph'] = 'X'
+            ev['dur'] = int(e['dur'] * 1000000)
+            ev['args'] = {'cpu_ms': int(e['cpu'] * 1000),
+                          'children_cpu_ms': int(e['children'] * 1000)}
+        trace.append(ev)
+
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+def write(path):
+    f = open(path, 'w')
+    json.dump(chrome(), f)
+    f.close()
+
+# Wall time per phase name, in the order they first happened
+def phases():
+    names = []
+    times = {}
+    for e in events:
+        if e['dur'] is None:
+            continue
+        if e['name'] not in times:
+            names.append(e['name'])
+            times[e['name']] = 0.0
+        times[e['name']] += e['dur']
+
+    return [(n, times[n]) for n in names]
+
+def summary():
+    raw = ''
+    for name, t in phases():
+        raw += '%s %.2fs | ' % (name, t)
+
+    raw += 'total %.2fs' % total()
+    return raw
+
+# Append the run to a history file, one JSON document per line
+def append_history(path, info=None):
+    entry = {'time'  : int(start_time),
+             'total' : round(total(), 3),
+             'phases': [[n, round(t, 3)] for n, t in phases()]}
+    if info is not None:
+        entry.update(info)
+
+    f = open(path, 'a')
+    f.write(json.dumps(entry, sort_keys=True) + '\n')
+    f.close()
@@ -0,0 +1,251 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Web service build units
+# =======================
+# Every directory of a web service that contains a Makefile.in is a build
+# unit. A unit is built after the units in its subdirectories and after the
+# ones listed on the DEPENDS key of its Makefile.in, e.g:
+#
+#    DEPENDS = ../common
+#
+# Units that do not depend on each other are built at the same time.
+
+import os
+import json
+import Queue
+import hashlib
+import threading
+
+from utils import *
+
+# Directories that never contains sources
+UNITS_PRUNE = ['html', 'data', 'logs', 'conf', 'node_modules']
+
+class ServiceUnits:
+    def __init__(self, ws, cache_path):
+        self.ws = os.path.abspath(ws)
+        h = hashlib.sha1(self.ws).hexdigest()[:16]
+        self.cache_file = os.path.join(cache_path, 'units-%s.json' % h)
+
+    # The cache holds the units found and the modification time of every
+    # directory visited, if none of them changed the walk is skipped
+    def cache_read(self):
+        try:
+            f = open(self.cache_file, 'r')
+            cache = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return None
+
+        for d, mtime in cache['dirs'].iteritems():
+            try:
+                if os.stat(d).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+
+        return [str(u) for u in cache['units']]
+
+    def cache_write(self, units, dirs):
+        try:
+            if os.path.isdir(os.path.dirname(self.cache_file)) is False:
+                os.makedirs(os.path.dirname(self.cache_file))
+            f = open(self.cache_file, 'w')
+            json.dump({'units': units, 'dirs': dirs}, f)
+            f.close()
+        except (IOError, OSError):
+            pass
+
+    # Return the list of directories that contains a Makefile.in
+    def discover(self):
+        units = self.cache_read()
+        if units is not None:
+            return units
+
+        units = []
+        dirs = {}
+        for root, subdirs, files in os.walk(self.ws):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            if root == self.ws:
+                subdirs[:] = [d for d in subdirs if d not in UNITS_PRUNE]
+
+            dirs[root] = os.stat(root).st_mtime
+            if 'Makefile.in' in files:
+                units.append(root)
+
+        units.sort()
+        self.cache_write(units, dirs)
+        return units
+
+    # Map every unit to the set of units it depends on
+    def dependencies(self, units):
+        deps = {}
+        for u in units:
+            deps[u] = set()
+            for other in units:
+                if other != u and other.startswith(u + '/'):
+                    deps[u].add(other)
+
+            f = open(os.path.join(u, 'Makefile.in'), 'r')
+            for line in f.readlines():
+                if not line.startswith('DEPENDS'):
+                    continue
+
+                for d in line.split('=', 1)[-1].split():
+                    path = os.path.normpath(os.path.join(u, d))
+                    if path in units and path != u:
+                        deps[u].add(path)
+            f.close()
+
+        return deps
+
+    def name(self, unit):
+        return os.path.relpath(unit, self.ws)
+
+    # The units that must be built again when the given files changed: the
+    # closest unit of every file and all the units depending on them
+    def affected(self, paths):
+        units = self.discover()
+        deps = self.dependencies(units)
+
+        found = set()
+        for p in paths:
+            owner = None
+            for u in units:
+                if (p == u or p.startswith(u + '/')) and \
+                        (owner is None or len(u) > len(owner)):
+                    owner = u
+            if owner is not None:
+                found.add(owner)
+
+        while True:
+            more = set([u for u in units if len(deps[u] & found) > 0]) - found
+            if len(more) == 0:
+                break
+            found |= more
+
+        return found
+
+    # Build the units in dependency order. The first running unit uses the
+    # job slot dudac owns, every other concurrent unit takes a slot from the
+    # jobserver so the total number of jobs is kept.
+    # When 'only' is set, just those units are built. If 'fatal' is False a
+    # failure is reported and False is returned instead of exit.
+    def build(self, command, jobserver=None, only=None, fatal=True):
+        units = self.discover()
+        deps = self.dependencies(units)
+        if only is not None:
+            units = [u for u in units if u in only]
+            for u in units:
+                deps[u] &= set(units)
+
+        pending = set(units)
+        done = set()
+        running = 0
+        tokens = []
+        events = Queue.Queue()
+        failed = []
+        waiting_token = [False]
+
+        def run(unit, token):
+            header = "WebService  : build %s" % self.name(unit)
+            cmd = command(unit)
+            status, out = execute_job(header, cmd, tag=self.name(unit))
+            events.put(('done', unit, token, (cmd, status, out)))
+
+        def take_token():
+            events.put(('token', jobserver.acquire(), None, None))
+
+        slots = 1
+        while len(pending) > 0 or running > 0:
+            ready = []
+            if len(failed) == 0:
+                ready = sorted([u for u in pending if deps[u] <= done])
+
+            while len(ready) > 0 and (slots > 0 or len(tokens) > 0):
+                unit = ready.pop(0)
+                pending.discard(unit)
+
+                token = None
+                if slots > 0:
+                    slots -= 1
+                else:
+                    token = tokens.pop()
+
+                running += 1
+                t = threading.Thread(target=run, args=(unit, token))
+                t.daemon = True
+                t.start()
+
+            # Keep only the slots the ready units needs, the rest goes back
+            # to the sub-makes
+            if len(ready) == 0:
+                while len(tokens) > 0:
+                    jobserver.release(tokens.pop())
+            elif jobserver is not None and waiting_token[0] is False:
+                waiting_token[0] = True
+                t = threading.Thread(target=take_token)
+                t.daemon = True
+                t.start()
+
+            if running == 0 and not waiting_token[0]:
+                if len(pending) > 0 and len(failed) == 0:
+                    fail_msg("Error: circular dependency between units: %s" % \
+                                 ', '.join([self.name(u) for u in pending]))
+                    exit(1)
+                break
+
+            ev, data, token, result = events.get()
+            if ev == 'token':
+                waiting_token[0] = False
+                tokens.append(data)
+                continue
+
+            running -= 1
+            if token is None:
+                slots += 1
+            else:
+                tokens.append(token)
+
+            cmd, status, out = result
+            if os.WEXITSTATUS(status) != 0:
+                failed.append((cmd, status, out))
+            else:
+                done.add(data)
+
+            if len(failed) > 0 and running == 0:
+                break
+
+        # A slot request still waiting: give one back to the pool so it
+        # completes, the slot it gets is never returned
+        if waiting_token[0] is True:
+            jobserver.release()
+            ev = events.get()
+            while ev[0] != 'token':
+                ev = events.get()
+
+        for t in tokens:
+            jobserver.release(t)
+
+        if len(failed) > 0:
+            for cmd, status, out in failed:
+                execute_failed(cmd, status, out)
+            if fatal is True:
+                exit(1)
+            return False
+
+        return True
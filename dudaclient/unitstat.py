@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Build units statistics
+# ======================
+# The generated Makefiles run every compile and link step through this
+# script when DUDAC_UNITSTAT is set:
+#
+#    python2 unitstat.py cc foo.o gcc -c foo.c -o foo.o
+#
+# it runs the command and appends a record with the start and end time,
+# the peak RSS and the size of the target to the DUDAC_UNITSTAT_FILE file.
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+# Number of units printed on the report
+UNITSTAT_TOP = 5
+
+# The command that the Makefiles use as a prefix for the compiler
+def wrapper():
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unitstat.py')
+    return "%s %s" % (sys.executable, script)
+
+def reset(path):
+    f = open(path, 'w')
+    f.close()
+
+def read(path):
+    records = []
+    try:
+        f = open(path, 'r')
+    except IOError:
+        return records
+
+    for line in f.readlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    f.close()
+
+    return records
+
+# Compose the report lines: the slowest units and the serial vs parallel
+# time of the whole build
+def report(records, base='.', top=UNITSTAT_TOP):
+    if len(records) == 0:
+        return []
+
+    lines = []
+    units = sorted(records, key=lambda r: r['end'] - r['start'], reverse=True)
+    for r in units[:top]:
+        target = os.path.relpath(os.path.join(r['cwd'], r['target']), base)
+        lines.append('%-4s %-40s %7.2fs %8i KB RSS %8i KB' % \
+                         (r['kind'], target, r['end'] - r['start'],
+                          r['rss'], r['size'] / 1024))
+
+    serial = sum([r['end'] - r['start'] for r in records])
+    parallel = max([r['end'] for r in records]) - min([r['start'] for r in records])
+    lines.append('%i units, serial %.2fs, parallel %.2fs (x%.1f)' % \
+                     (len(records), serial, parallel,
+                      serial / max(parallel, 0.001)))
+    return lines
+
+def main():
+    if len(sys.argv) < 4:
+        sys.stderr.write("Usage: unitstat.py KIND TARGET COMMAND [ARGS]\n")
+        return 1
+
+    kind = sys.argv[1]
+    target = sys.argv[2]
+    cmd = sys.argv[3:]
+
+    start = time.time()
+    ret = subprocess.call(cmd)
+    end = time.time()
+
+    path = os.getenv('DUDAC_UNITSTAT_FILE')
+    if path is None:
+        return ret
+
+    # ru_maxrss is the largest waited descendant, in KB on Linux
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    try:
+        size = os.path.getsize(target)
+    except OSError:
+        size = 0
+
+    record = {'kind': kind, 'target': target, 'cwd': os.getcwd(),
+              'start': start, 'end': end, 'rss': rss, 'size': size,
+              'status': ret}
+
+    # Many units are built at the same time, it's a single write()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    os.write(fd, json.dumps(record) + '\n')
+    os.close(fd)
+
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
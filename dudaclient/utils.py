@@ -15,9 +15,26 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import re
 import sys
+import glob
 import time
+import errno
+import fcntl
+import shlex
+import signal
+import socket
+import sqlite3
+import shutil
 import commands
+import threading
+import tempfile
+import subprocess
+import collections
+from multiprocessing.pool import ThreadPool
+from distutils.spawn import find_executable
+
+import crashdb
 
 # BUILD: Set the default branch to dst-1 (Duda Stable API Level 1)
 DEFAULT_API_LEVEL = 1
@@ -42,10 +59,227 @@ MSG_INFO     = '[' + ANSI_GREEN + 'i' + ANSI_RESET + ']'
 
 DEBUG_MODE = False
 
+# Linux ioctl to share the data blocks of two files (reflink)
+FICLONE = 0x40049409
+
+# Output lines of a command kept in memory: the first ones (where the HTTP
+# server prints its details) and the most recent ones. Everything else is
+# only stored in the log file.
+EXEC_HEAD_LINES = 200
+EXEC_TAIL_LINES = 1000
+
+# Directory for the log files and number of them to keep
+LOG_PATH  = None
+LOG_FILES = 20
+log_file  = None
+
+# Set the directory where the full output of the commands is spooled, every
+# run gets its own log file
+def set_log_path(path):
+    global LOG_PATH
+
+    LOG_PATH = path
+    try:
+        if os.path.isdir(path) is False:
+            os.makedirs(path)
+    except OSError:
+        LOG_PATH = None
+        return
+
+    # Remove the oldest logs
+    logs = sorted([f for f in os.listdir(path) if f.endswith('.log')])
+    for f in logs[:-LOG_FILES]:
+        try:
+            os.unlink(os.path.join(path, f))
+        except OSError:
+            pass
+
+def log_open():
+    global log_file
+
+    if log_file is None and LOG_PATH is not None:
+        name = 'dudac-%s-%i.log' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        log_file = open(os.path.join(LOG_PATH, name), 'a')
+
+    return log_file
+
+def log_name():
+    if log_file is None:
+        return None
+
+    return log_file.name
+
+# Keeps the first and last lines of a stream
+class OutputBuffer:
+    def __init__(self, head=EXEC_HEAD_LINES, tail=EXEC_TAIL_LINES):
+        self.head = []
+        self.head_max = head
+        self.tail = collections.deque(maxlen=tail)
+        self.lines = 0
+
+    def append(self, line):
+        self.lines += 1
+        if len(self.head) < self.head_max:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+
+    def dropped(self):
+        return self.lines - len(self.head) - len(self.tail)
+
+    def value(self):
+        raw = ''.join(self.head)
+        if self.dropped() > 0:
+            raw += '[... %i lines, see %s ...]\n' % (self.dropped(), log_name())
+        raw += ''.join(self.tail)
+        return raw.rstrip('\n')
+
+# Convert a subprocess return code to a wait() status, a process killed by
+# a signal is reported as the shell does: 128 + signal number
+def wait_status(returncode):
+    if returncode < 0:
+        return (128 - returncode) << 8
+
+    return returncode << 8
+
+# Seconds between the progress lines printed for every concurrent job
+JOB_PROGRESS = 1.0
+
+# A line of output, progress meters end their lines with a carriage return
+OUTPUT_LINE = re.compile(r'[^\r\n]*(?:\r\n|\r|\n)')
+
+# Lines of a command output as they arrive
+def output_lines(stream):
+    pending = ''
+    while True:
+        data = os.read(stream.fileno(), 65536)
+        if len(data) == 0:
+            break
+
+        pending += data
+        end = 0
+        for m in OUTPUT_LINE.finditer(pending):
+            end = m.end()
+            yield m.group(0)
+        pending = pending[end:]
+
+    if len(pending) > 0:
+        yield pending
+
+# Print a line of a concurrent job, prefixed with its tag
+def job_print(tag, line, color=''):
+    print_lock.acquire()
+    print "    %s[%s]%s %s%s%s" % (ANSI_BOLD, tag, ANSI_RESET, color, line, ANSI_RESET)
+    sys.stdout.flush()
+    print_lock.release()
+
+# Run a command and process its output as it arrives: every line goes to
+# the log file, compiler warnings are highlighted right away and only a
+# bounded part of the output is kept in memory. It returns a tuple with
+# the wait() status, the buffered output and the number of warnings.
+#
+# Commands running at the same time give their 'tag': the warnings, and a
+# progress line every JOB_PROGRESS seconds if 'progress' is set, are
+# printed prefixed with it and serialized with print_lock.
+def stream_command(command, warnings=True, cwd=None, tag=None, progress=False):
+    log = log_open()
+    if log is not None:
+        log.write('\n$ %s\n' % command)
+        log.flush()
+
+    buf = OutputBuffer()
+    found = 0
+    last = 0
+
+    p = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, close_fds=False)
+    for line in output_lines(p.stdout):
+        if log is not None:
+            log.write(line)
+        buf.append(line)
+
+        text = line.rstrip('\r\n')
+        if warnings is True and line.find('warning') > 0:
+            if tag is not None:
+                job_print(tag, text, ANSI_GREEN)
+            else:
+                if found == 0:
+                    print
+                    print ANSI_BOLD + ANSI_RED + "--- Compiler Warnings ---" + ANSI_RESET
+                print ANSI_GREEN + text + ANSI_RESET
+                sys.stdout.flush()
+            found += 1
+        elif progress is True and len(text.strip()) > 0 and \
+                time.time() - last >= JOB_PROGRESS:
+            last = time.time()
+            job_print(tag, text.strip()[:100])
+
+    p.stdout.close()
+    p.wait()
+    if log is not None:
+        log.flush()
+
+    return (wait_status(p.returncode), buf.value(), found)
+
 # Print a failure message
 def fail_msg(msg):
     print ANSI_RED + "[-] " + ANSI_RESET + msg
 
+# Signals which mean the process crashed, a core dump may exist
+CRASH_SIGNALS = [signal.SIGSEGV, signal.SIGABRT, signal.SIGBUS, signal.SIGFPE,
+                 signal.SIGILL, signal.SIGTRAP, signal.SIGSYS]
+
+# Seconds a core dump handler (systemd-coredump, apport) gets to store the
+# core once the process is gone
+CORE_WAIT = 10
+
+# Frames of every thread on the full backtrace
+GDB_FRAMES = 64
+
+# Seconds gdb gets to analyze a core, the report is composed with what it
+# printed so far
+GDB_TIMEOUT = 120
+
+# Printed by gdb between the crashing thread and the backtrace of all of
+# them
+GDB_MARK = '--- dudac: all threads ---'
+
+# DUDAC_HOME, the gdb index cache and the cores taken from the core dump
+# handlers are stored there
+CRASH_PATH = None
+
+# Stack build (stage) the crashes happen on
+CRASH_STACK = None
+
+def set_crash_path(path):
+    global CRASH_PATH
+    CRASH_PATH = path
+
+def set_crash_stack(stack):
+    global CRASH_STACK
+    CRASH_STACK = stack
+
+# The signal that crashed a process from its wait() status, None if it did
+# not crash. The shell reports a command killed by a signal as 128 + signal.
+def crash_signal(status):
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+    elif os.WIFEXITED(status) and os.WEXITSTATUS(status) > 128:
+        sig = os.WEXITSTATUS(status) - 128
+    else:
+        return None
+
+    if sig in CRASH_SIGNALS:
+        return sig
+    return None
+
+def signal_name(sig):
+    for name in dir(signal):
+        if name.startswith('SIG') and not name.startswith('SIG_') and \
+                getattr(signal, name) == sig:
+            return name
+    return 'signal %i' % sig
+
 # Determinate if the system create coredumps with PID or not
 def core_with_pid():
     f = open('/proc/sys/kernel/core_uses_pid')
@@ -57,33 +291,227 @@ def core_with_pid():
 
     return True
 
-def gdb_trace(command, core):
+def core_pattern():
+    try:
+        f = open('/proc/sys/kernel/core_pattern')
+        pattern = f.read().strip()
+        f.close()
+    except IOError:
+        return 'core'
+
+    if len(pattern) == 0:
+        return 'core'
+    return pattern
+
+# The program executed by a command line
+def executable(command):
+    for arg in shlex.split(command):
+        if arg == 'exec' or arg.find('=') > 0:
+            continue
+        if arg.find('/') >= 0:
+            return arg
+        path = find_executable(arg)
+        if path is not None:
+            return path
+        return arg
+
+    return None
+
+# Expand a core_pattern into a glob, the values we can not know (thread
+# id, time) match anything
+def core_glob(pattern, pid, exe, sig=None):
+    values = {'p': str(pid), 'P': str(pid), 'u': str(os.getuid()),
+              'g': str(os.getgid()), 'h': socket.gethostname(), '%': '%'}
+    if sig is not None:
+        values['s'] = str(sig)
+    if exe is not None:
+        values['E'] = os.path.abspath(exe).replace('/', '!')
+
+    path = re.sub(r'%(.)', lambda m: values.get(m.group(1), '*'), pattern)
+    if pattern.find('%p') < 0 and core_with_pid() is True:
+        path += '.' + str(pid)
+
+    return path
+
+# Take the core from systemd-coredump, it's stored on its journal
+def core_systemd(pid):
+    target = os.path.join(CRASH_PATH or '.', 'cores', 'core.%i' % pid)
+    if os.path.isdir(os.path.dirname(target)) is False:
+        os.makedirs(os.path.dirname(target))
+
+    end = time.time() + CORE_WAIT
+    while True:
+        ret = commands.getstatusoutput('coredumpctl --no-pager -q dump %i --output=%s 2>&1' % \
+                                           (pid, target))
+        if ret[0] == 0 and os.path.isfile(target):
+            return target
+        if ret[0] == 127 or time.time() >= end:
+            return None
+        time.sleep(0.5)
+
+# Find the core dump of a process honoring the kernel core_pattern: a
+# path (relative to the working directory of the process) or a handler
+# that gets the core through a pipe
+def find_core(pid, exe, sig=None, since=0, cwd=None):
+    pattern = core_pattern()
+
+    if pattern.startswith('|'):
+        if pattern.find('systemd-coredump') >= 0:
+            return core_systemd(pid)
+
+        if pattern.find('apport') >= 0:
+            path = '/var/lib/apport/coredump/core.*.%i.*' % pid
+        else:
+            fail_msg("Core dumps are sent to '%s'" % pattern[1:].split()[0])
+            return None
+    else:
+        path = core_glob(pattern, pid, exe, sig)
+        if os.path.isabs(path) is False:
+            path = os.path.join(cwd or os.getcwd(), path)
+
+    end = time.time() + CORE_WAIT
+    while True:
+        cores = [c for c in glob.glob(path) if os.path.isfile(c) and
+                 os.path.getmtime(c) >= since - 1]
+        if len(cores) > 0:
+            cores.sort(key=lambda c: os.path.getmtime(c))
+            return cores[-1]
+
+        # only the pipe handlers write the core after the process is gone
+        if pattern.startswith('|') is False or time.time() >= end:
+            return None
+        time.sleep(0.5)
+
+# Print the backtrace of the crashing thread, the frame that got the
+# signal is highlighted
+def gdb_print(output):
     next_highlight = False
-    gdb = 'gdb --batch -ex bt --core=' + core + ' ' + command
-    sys.stdout.flush()
-    ret = commands.getstatusoutput(gdb)
-    if ret[0] == 0:
-        fail_msg('Stack Trace lookup')
-        os.write(0, ANSI_YELLOW)
-        for line in ret[1].split('\n'):
-            if len(line) < 2:
-                continue
+    fail_msg('Stack Trace lookup')
+    os.write(1, ANSI_YELLOW)
+    for line in output.split('\n'):
+        if len(line) < 2 or line[0] != '#':
+            continue
 
-            if line[0] == '#':
-                if next_highlight is True:
-                    print ANSI_BOLD + ANSI_YELLOW + '    ' + \
-                        line + ANSI_RESET + ANSI_YELLOW
-                    next_highlight = False
-                    continue
+        if next_highlight is True:
+            print ANSI_BOLD + ANSI_YELLOW + '    ' + \
+                line + ANSI_RESET + ANSI_YELLOW
+            next_highlight = False
+            continue
 
-                if line.find('<signal handler called>') > 0:
-                    next_highlight = True
+        if line.find('<signal handler called>') > 0:
+            next_highlight = True
 
-                print '    ' + line
+        print '    ' + line
 
-        os.write(0, ANSI_RESET)
+    sys.stdout.flush()
+    os.write(1, ANSI_RESET)
+
+# Analyze a core dump with gdb in background: the crashing thread is
+# available first, the backtrace of all the threads comes after. The
+# symbols index is cached under DUDAC_HOME, so the next core of the same
+# binaries loads faster.
+class CrashAnalysis:
+    def __init__(self, exe, core):
+        self.exe = exe
+        self.core = core
+        self.lines = []
+        self.crashed = None
+        self.process = None
+        self.first = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def command(self):
+        cmd = ['gdb', '--batch', '-iex', 'set debuginfod enabled off']
+        if CRASH_PATH is not None:
+            cache = os.path.join(CRASH_PATH, 'gdb-cache')
+            if os.path.isdir(cache) is False:
+                os.makedirs(cache)
+            cmd += ['-iex', 'set index-cache directory ' + cache,
+                    '-iex', 'set index-cache on']
+
+        cmd += ['-ex', 'set pagination off', '-ex', 'bt',
+                '-ex', 'echo ' + GDB_MARK + '\\n',
+                '-ex', 'thread apply all bt full %i' % GDB_FRAMES,
+                self.exe, self.core]
+        return cmd
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+        except OSError:
+            self.first.set()
+            return
+
+        for line in iter(self.process.stdout.readline, ''):
+            if line.startswith(GDB_MARK):
+                self.crashed = ''.join(self.lines)
+                self.first.set()
+            self.lines.append(line)
+
+        self.process.wait()
+        self.first.set()
+
+    # Backtrace of the crashing thread
+    def crashing_thread(self, timeout=GDB_TIMEOUT):
+        self.first.wait(timeout)
+        return self.crashed
+
+    # Full output, gdb is stopped if it did not finish on time
+    def wait(self, timeout=GDB_TIMEOUT):
+        self.thread.join(timeout)
+        if self.thread.is_alive() and self.process is not None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.thread.join()
+
+        if len(self.lines) == 0:
+            return None
+        return ''.join(self.lines)
+
+# Seconds a function called through gdb on a running process can take. The
+# process is stopped meanwhile, and if it was interrupted holding a lock
+# the called function needs it never returns.
+GDB_CALL_TIMEOUT = 10
+
+# Call a function of a running process through gdb, it returns a tuple
+# with the wait() status and the output, or None if the call did not
+# finish on time: gdb is interrupted, the call frame is discarded and the
+# process continues from where it was stopped.
+def gdb_call(pid, call, timeout=GDB_CALL_TIMEOUT):
+    cmd = ['gdb', '--batch', '-p', str(pid), '-ex', 'set unwindonsignal on',
+           '-ex', 'call ' + call]
+    out = tempfile.TemporaryFile()
+    try:
+        p = subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT)
+    except OSError, e:
+        return (127 << 8, str(e))
+
+    end = time.time() + timeout
+    while p.poll() is None and time.time() < end:
+        time.sleep(0.05)
+
+    if p.poll() is None:
+        p.send_signal(signal.SIGINT)
+        end = time.time() + 2
+        while p.poll() is None and time.time() < end:
+            time.sleep(0.05)
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        out.close()
+        return None
 
-    return ret[1]
+    out.seek(0)
+    output = out.read()
+    out.close()
+    return (p.returncode << 8, output)
 
 def output_pid(out):
     pid = None
@@ -96,37 +524,31 @@ def output_pid(out):
 
     return pid
 
-def gdb_analyze(command, out):
+# Look for the core dump of a crashed process and start its analysis, it
+# returns the CrashAnalysis running or None
+def gdb_analyze(command, pid, sig=None, since=0, cwd=None):
+    fail_msg("Crash detected, trying to find some core dump for PID %s" % str(pid))
+
+    exe = executable(command)
+    core = find_core(int(pid), exe, sig, since, cwd)
+    if core is None:
+        fail_msg('No core dump was found (core_pattern: %s)' % core_pattern())
+
+        # Check ulimit value
+        ret = commands.getstatusoutput('ulimit -c')
+        if ret[1] != 'unlimited':
+            print ANSI_YELLOW + '    --'
+            print ANSI_YELLOW + '    Enable core dumps with:'
+            print
+            print '        $ ulimit -c unlimited'
+            print '    --' + ANSI_RESET
 
-    pid = output_pid(out)
-    if pid is None:
         return None
 
-    # Check if a core dump file exists
-    if out.find('[stack trace]') > 0 or out.find('backtrace'):
-        fail_msg("Crash detected, trying to find some core dump for PID " + pid)
-        if core_with_pid() is False:
-            core_file = 'core'
-        else:
-            core_file = 'core.' + pid
-
-        if os.path.isfile(core_file) is True:
-            fail_msg('Core dump found: \'' + core_file + '\'')
-            ret = gdb_trace(command, core_file)
-            return ret
-        else:
-            fail_msg('No core dump was found:')
-
-            # Check ulimit value
-            ret = commands.getstatusoutput('ulimit -c')
-            if ret[1] != 'unlimited':
-                print ANSI_YELLOW + '    --'
-                print ANSI_YELLOW + '    Enable core dumps with:'
-                print
-                print '        $ ulimit -c unlimited'
-                print '    --' + ANSI_RESET
-
-            return None
+    fail_msg('Core dump found: \'' + core + '\'')
+    analysis = CrashAnalysis(exe, core)
+    analysis.start()
+    return analysis
 
 # Execute a command and print the output to stdout
 def execute_stdout(header, command, head=True):
@@ -147,116 +569,281 @@ def execute(header, command, status=True, crash_debug=False, head=True):
 
     sys.stdout.flush()
 
-    ret = commands.getstatusoutput(command)
+    # Warnings are only relevant for commands that reports a status
+    code, output, warnings = stream_command(command, status)
+    ret = (code, output)
+
+    # Warnings were printed after the header, close the block and repeat
+    # the header for the status
+    if warnings > 0:
+        print ANSI_BOLD + ANSI_RED + "--- * --- * --- * --- * ---" + ANSI_RESET
+        if head is True:
+            print "%s %-70s" % (MSG_NEW, header),
+
     if os.WEXITSTATUS(ret[0]) == 0:
         if status is True:
             print MSG_OK
-        if ret[1].find('warning') > 0:
-            print ANSI_BOLD + ANSI_RED + "--- Compiler Warnings ---" + ANSI_RESET
-
-            lines = ret[1].split('\n')
-            for l in lines:
-                if l.find('warning') > 0:
-                    print ANSI_GREEN + l + ANSI_RESET
-
-            print ANSI_BOLD + ANSI_RED + "--- * --- * --- * --- * ---"
-            print ANSI_RESET
     else:
         if status is True:
             print MSG_FAIL
 
-        # The tricky part: what's the real process return status ?, according
-        # to Python documentation the value or ret[0] represents the following:
-        #
-        # "The exit status for the command can be interpreted according to the
-        #  rules for the C function wait()."
-        #
-        # what ?, back to C manpages:
-        #
-        #  This integer can be inspected with the following macros (which take
-        #  the integer itself as  an  argument,  not a pointer to it, as is
-        #  done in wait() and waitpid()!):
-        #
-        #  WIFEXITED(status)...
-        #  WEXITSTATUS(status)...
-        #  WIFSIGNALED(status)...
-        #  WTERMSIG(status)...
-        #  WCOREDUMP(status)...
-        #  WIFSTOPPED(status)...
-        #  WSTOPSIG(status)...
-        #  WIFCONTINUED(status)...
-        #
-        # ok, so where are those macros on Python ??, Google -> Python WIFEXITED:
-        #
-        #   => os.WIFEXITED
-        #
-        # So everything i wanted to know was in the 'os' package, so why you tell
-        # me to go to C man page ?..lovely Python...
-        #
-
-        print
-        fail_msg("Command exit (status=%i): %s" % (os.WEXITSTATUS(ret[0]), command))
-
-
-        status = ret[0]
-
-        """
-        print "WIFEXITED=", os.WIFEXITED(status)
-        print "WEXITSTATUS=", os.WEXITSTATUS(status)
-        print "WIFSIGNALED=", os.WIFSIGNALED(status)
-        print "WTERMSIG=", os.WTERMSIG(status)
-        print "WCOREDUMP=", os.WCOREDUMP(status)
-        print "WIFSTOPPED=", os.WIFSTOPPED(status)
-        print "WSTOPSIG=", os.WSTOPSIG(status)
-        print "WIFCONTINUED=", os.WIFCONTINUED(status)
-        """
-
-        if os.WIFSIGNALED(ret[0]) is False:
-            print ANSI_YELLOW + '-------------------------------' + ANSI_RESET
-            print ret[1]
-            print ANSI_YELLOW + '-------------------------------' + ANSI_RESET
-
-        if os.WEXITSTATUS(status) < 134: # 128 base + 11 SIGSEV
-            exit(1)
-
-        crash_ret = None
-        if crash_debug is True:
-            crash_ret = gdb_analyze(command, ret[1])
-
-
-        # Store outout to log file
+        command_failed(command, ret, crash_debug)
+
+    return ret
+
+# A command failed: print its output and exit. When the process crashed
+# the core dump is analyzed and the crash is stored on the crashes database
+def command_failed(command, ret, crash_debug=False, pid=None, since=0, cwd=None):
+    # The tricky part: what's the real process return status ?, according
+    # to Python documentation the value or ret[0] represents the following:
+    #
+    # "The exit status for the command can be interpreted according to the
+    #  rules for the C function wait()."
+    #
+    # what ?, back to C manpages:
+    #
+    #  This integer can be inspected with the following macros (which take
+    #  the integer itself as  an  argument,  not a pointer to it, as is
+    #  done in wait() and waitpid()!):
+    #
+    #  WIFEXITED(status)...
+    #  WEXITSTATUS(status)...
+    #  WIFSIGNALED(status)...
+    #  WTERMSIG(status)...
+    #  WCOREDUMP(status)...
+    #  WIFSTOPPED(status)...
+    #  WSTOPSIG(status)...
+    #  WIFCONTINUED(status)...
+    #
+    # ok, so where are those macros on Python ??, Google -> Python WIFEXITED:
+    #
+    #   => os.WIFEXITED
+    #
+    # So everything i wanted to know was in the 'os' package, so why you tell
+    # me to go to C man page ?..lovely Python...
+    #
+
+    print
+    fail_msg("Command exit (status=%i): %s" % (os.WEXITSTATUS(ret[0]), command))
+
+
+    status = ret[0]
+
+    """
+    print "WIFEXITED=", os.WIFEXITED(status)
+    print "WEXITSTATUS=", os.WEXITSTATUS(status)
+    print "WIFSIGNALED=", os.WIFSIGNALED(status)
+    print "WTERMSIG=", os.WTERMSIG(status)
+    print "WCOREDUMP=", os.WCOREDUMP(status)
+    print "WIFSTOPPED=", os.WIFSTOPPED(status)
+    print "WSTOPSIG=", os.WSTOPSIG(status)
+    print "WIFCONTINUED=", os.WIFCONTINUED(status)
+    """
+
+    if os.WIFSIGNALED(ret[0]) is False:
+        print ANSI_YELLOW + '-------------------------------' + ANSI_RESET
+        print ret[1]
+        print ANSI_YELLOW + '-------------------------------' + ANSI_RESET
+        if log_name() is not None:
+            fail_msg("Full output at " + log_name())
+
+    sig = crash_signal(status)
+    if sig is None:
+        exit(1)
+
+    fail_msg("Process killed by %s" % signal_name(sig))
+
+    # The pid comes from the caller or from the Monkey output
+    if pid is None:
         pid = output_pid(ret[1])
-        if pid is not None:
-            target = 'logs/crash_report.' + pid
-        else:
-            print ret[1]
-            exit(1)
-
-        report = time.strftime('%Y/%m/%d %H:%M:%S: ')
-        report += 'Duda I/O Web Service Crash Report\n'
-        report += '======================================================\n\n'
-        report += '>>>>>>>>>>>>>>>> HTTP Server Output <<<<<<<<<<<<<<<<\n'
-        report += '                 ^^^^^^^^^^^^^^^^^^\n\n'
-        report += ret[1]
-
-        report += '\n\n'
-        report += '>>>>>>>>>>>>>>>> Stack Trace Analysis <<<<<<<<<<<<<<<<\n'
-        report += '                 ^^^^^^^^^^^^^^^^^^^^\n\n'
-
-        if crash_ret is None:
-            report += 'Error: core dump file not found.\n'
+    if pid is None:
+        print ret[1]
+        exit(1)
+
+    # gdb runs in background: the crash is reported and stored with the
+    # backtrace of the crashing thread as soon as it's printed, the
+    # backtrace of all the threads is added to it once gdb finish
+    analysis = None
+    if crash_debug is True:
+        analysis = gdb_analyze(command, pid, sig, since, cwd)
+
+    core = None
+    backtrace = None
+    pending = False
+    if analysis is not None:
+        core = analysis.core
+        backtrace = analysis.crashing_thread()
+        if backtrace is not None:
+            gdb_print(backtrace)
+            pending = True
         else:
-            report += crash_ret
-            report += '\n'
+            # gdb failed or got stuck, keep what it printed
+            backtrace = analysis.wait(0)
+            if backtrace is None:
+                fail_msg("gdb could not analyze the core dump " + core)
+
+    # Store the crash on the database, counted with the previous ones of
+    # the same signature
+    path = os.path.join(CRASH_PATH or '.', 'crashes.db')
+    try:
+        db = crashdb.CrashDB(path)
+        crash_id, signature, count = db.add(signal_name(sig), CRASH_STACK, int(pid),
+                                            command, core, log_name(), ret[1],
+                                            backtrace)
+    except (sqlite3.Error, OSError), e:
+        fail_msg("Error: cannot store the crash on %s: %s" % (path, str(e)))
+        exit(1)
 
-        f = open(target, 'wa+')
-        f.write(report)
-        f.close()
+    if signature is None:
+        fail_msg("Crash stored without signature, no backtrace was found")
+    else:
+        fail_msg("Crash %s stored (seen %i times), details with 'dudac crashes %s'" % \
+                     (signature, count, signature))
+
+    if pending is True:
+        print_info("Waiting for the backtrace of all the threads, Ctrl-C skips it")
+        try:
+            full = analysis.wait()
+        except KeyboardInterrupt:
+            full = analysis.wait(0)
+
+        try:
+            db.update(crash_id, full)
+            print_info("Backtrace of all the threads added to the crash")
+        except sqlite3.Error, e:
+            fail_msg("Error: cannot store the backtrace on %s: %s" % (path, str(e)))
+
+    db.close()
+    exit(1)
+
+# Create a new directory under 'path' named after the current time and
+# our pid, a counter is added if it already exists: two server instances
+# can be started in the same second (a handoff, a quick restart).
+def run_directory(path):
+    if os.path.isdir(path) is False:
+        os.makedirs(path)
+
+    name = '%s-%i' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    target = os.path.join(path, name)
+    n = 1
+    while True:
+        try:
+            os.mkdir(target)
+            return target
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        target = os.path.join(path, '%s.%i' % (name, n))
+        n += 1
+
+# Write a file only if the new content differs from the current one, so
+# the modification time is preserved for tools like make. The new content
+# is renamed over the old file, readers never see a partial write.
+def write_if_changed(path, content, current=None):
+    mode = 0644
+    if os.path.isfile(path):
+        if current is None:
+            f = open(path, 'r')
+            current = f.read()
+            f.close()
+
+        if current == content:
+            return False
+
+        mode = os.stat(path).st_mode & 07777
+
+    tmp = path + '.dudac-tmp'
+    f = open(tmp, 'w')
+    f.write(content)
+    f.close()
 
-        fail_msg("Crash report saved at " + target)
+    os.chmod(tmp, mode)
+    os.rename(tmp, path)
+
+    return True
+
+# Serialize the output of commands running at the same time
+print_lock = threading.Lock()
+
+# Run a command from a job thread. Its warnings (and progress lines if
+# requested) are printed prefixed with the tag as they arrive, once it
+# finish its status line is printed. It returns a tuple with the wait()
+# status and the output.
+def execute_job(header, command, cwd=None, tag=None, progress=False):
+    if tag is None:
+        tag = header.split(':')[0].strip()
+
+    code, out, found = stream_command(command, True, cwd, tag, progress)
+
+    print_lock.acquire()
+    if os.WEXITSTATUS(code) == 0:
+        print "%s %-70s %s" % (MSG_NEW, header, MSG_OK)
+    else:
+        print "%s %-70s %s" % (MSG_NEW, header, MSG_FAIL)
+    sys.stdout.flush()
+    print_lock.release()
+
+    return (code, out)
+
+# Report a failed job
+def execute_failed(command, status, output):
+    print
+    fail_msg("Command exit (status=%i): %s" % (os.WEXITSTATUS(status), command))
+    print ANSI_YELLOW + '-------------------------------' + ANSI_RESET
+    print output
+    print ANSI_YELLOW + '-------------------------------' + ANSI_RESET
+    if log_name() is not None:
+        fail_msg("Full output at " + log_name())
+
+# Run a set of commands concurrently. Every job is a tuple with the header,
+# the command and the working directory (None for the current one). While
+# they run their progress is printed line by line, every line prefixed
+# with the job tag, and the status line of each job once it finish. It
+# returns the (status, output) tuples in the same order of the jobs.
+def execute_many(jobs, workers=None):
+    def run(job):
+        header, command, cwd = job
+        return execute_job(header, command, cwd, progress=True)
+
+    if workers is None:
+        workers = len(jobs)
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = pool.map(run, jobs)
+    finally:
+        pool.close()
+
+    failed = False
+    for i in range(len(jobs)):
+        status, out = results[i]
+        if status == 0:
+            continue
+
+        failed = True
+        execute_failed(jobs[i][1], status, out)
+
+    if failed is True:
         exit(1)
 
-    return ret
+    return results
+
+# Copy a file, if the filesystem supports it (Btrfs, XFS) the data blocks
+# are shared instead of copied. The destination is replaced atomically.
+def clone_file(src, dst):
+    tmp = dst + '.dudac-tmp'
+    fs = open(src, 'rb')
+    fd = open(tmp, 'wb')
+    try:
+        try:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        except (IOError, OSError):
+            shutil.copyfileobj(fs, fd)
+    finally:
+        fs.close()
+        fd.close()
+
+    os.rename(tmp, dst)
 
 def print_msg(msg, status = 0):
     print "%s %-70s" % (MSG_NEW, msg),
@@ -0,0 +1,291 @@
+# Copyright (C) 2012-2014, Eduardo Silva <eduardo@monkey.io>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Files watcher
+# =============
+# Report the files changed under a directory tree. On Linux it uses inotify
+# through ctypes, if it's not available (or we run out of watches) the tree
+# is scanned periodically. A burst of events (an editor saving, git checkout)
+# is reported as a single change once the tree is quiet.
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from utils import *
+
+# Seconds without events to consider a burst finished
+WATCH_DEBOUNCE = 0.3
+
+# Seconds between scans when polling
+WATCH_POLL = 1.0
+
+# Files generated by the build or by editors
+WATCH_IGNORE = ('.o', '.d', '.duda', '.so', '.swp', '.swx', '~', '.tmp',
+                '.dudac-tmp')
+
+# inotify(7)
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 00004000
+IN_CLOEXEC     = 02000000
+
+IN_EVENT       = struct.Struct('iIII')
+WATCH_MASK     = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+def ignored(path):
+    name = os.path.basename(path)
+    if name.startswith('.') or name == 'Makefile':
+        return True
+
+    return name.endswith(WATCH_IGNORE)
+
+class Watcher:
+    def __init__(self, root, prune=[], debounce=WATCH_DEBOUNCE):
+        self.root = os.path.abspath(root)
+        self.prune = prune
+        self.debounce = debounce
+
+    # Directories of the tree to watch
+    def walk(self, path):
+        for root, subdirs, files in os.walk(path):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            if root == self.root:
+                subdirs[:] = [d for d in subdirs if d not in self.prune]
+
+            yield root, files
+
+    # Modification time and size of the files under path
+    def snapshot(self, path):
+        files = {}
+        for root, names in self.walk(path):
+            for n in names:
+                f = os.path.join(root, n)
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                files[f] = (st.st_mtime, st.st_size)
+
+        return files
+
+    # Wait for changes, it returns the set of paths changed or an empty
+    # set if nothing happened before the timeout
+    def wait(self, timeout=None):
+        changes = self.events(timeout)
+        if len(changes) == 0:
+            return changes
+
+        while True:
+            more = self.events(self.debounce)
+            if len(more) == 0:
+                break
+            changes |= more
+
+        return set([c for c in changes if not ignored(c)])
+
+    def close(self):
+        pass
+
+# Files that differ between two snapshots
+def snapshot_diff(old, new):
+    changes = set()
+    for path, st in new.iteritems():
+        if old.get(path) != st:
+            changes.add(path)
+    for path in old:
+        if path not in new:
+            changes.add(path)
+
+    return changes
+
+class PollWatcher(Watcher):
+    def __init__(self, root, prune=[], debounce=WATCH_DEBOUNCE):
+        Watcher.__init__(self, root, prune, debounce)
+        self.files = self.scan()
+
+    def scan(self):
+        return self.snapshot(self.root)
+
+    def events(self, timeout):
+        start = time.time()
+        while True:
+            files = self.scan()
+            changes = snapshot_diff(self.files, files)
+            self.files = files
+            if len(changes) > 0:
+                return changes
+
+            if timeout is not None:
+                left = timeout - (time.time() - start)
+                if left <= 0:
+                    return changes
+                time.sleep(min(WATCH_POLL, left))
+            else:
+                time.sleep(WATCH_POLL)
+
+class InotifyWatcher(Watcher):
+    def __init__(self, root, prune=[], debounce=WATCH_DEBOUNCE):
+        Watcher.__init__(self, root, prune, debounce)
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+
+        self.wds = {}
+
+        # Subtrees that could not be watched (no more watches, permissions),
+        # they are scanned periodically
+        self.polled = {}
+        try:
+            self.add_tree(self.root)
+        except OSError:
+            self.close()
+            raise
+
+    # Watch every directory under path, it returns the files found so the
+    # ones created before the watch was set are not lost
+    def add_tree(self, path):
+        found = set()
+        for root, names in self.walk(path):
+            wd = self.add_watch(self.fd, root, WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in [errno.ENOENT, errno.ENOTDIR]:
+                    continue
+                raise OSError(e, 'inotify_add_watch: ' + root)
+
+            self.wds[wd] = root
+            for n in names:
+                found.add(os.path.join(root, n))
+
+        return found
+
+    # Scan a subtree that inotify can not watch, it returns its files like
+    # add_tree()
+    def poll_tree(self, path, error):
+        fail_msg("Warning: cannot watch %s (%s), polling it every %.1fs" % \
+                     (path, os.strerror(error.errno), WATCH_POLL))
+        self.polled[path] = self.snapshot(path)
+        return set(self.polled[path].keys())
+
+    def poll_changes(self):
+        changes = set()
+        for path in self.polled.keys():
+            files = self.snapshot(path)
+            changes |= snapshot_diff(self.polled[path], files)
+            if os.path.isdir(path) is False:
+                del self.polled[path]
+            else:
+                self.polled[path] = files
+
+        return changes
+
+    def events(self, timeout):
+        start = time.time()
+        while True:
+            # the polled subtrees are scanned while we wait for events
+            wait = timeout
+            if len(self.polled) > 0:
+                wait = WATCH_POLL
+                if timeout is not None:
+                    wait = max(0, min(WATCH_POLL, timeout - (time.time() - start)))
+
+            ready = len(select.select([self.fd], [], [], wait)[0]) > 0
+            changes = self.poll_changes()
+            if ready is True:
+                changes |= self.read()
+
+            if len(changes) > 0 or len(self.polled) == 0:
+                return changes
+            if timeout is not None and time.time() - start >= timeout:
+                return changes
+
+    def read(self):
+        changes = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return changes
+            raise
+
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            wd, mask, cookie, size = IN_EVENT.unpack_from(data, offset)
+            offset += IN_EVENT.size
+            name = data[offset:offset + size].rstrip('\0')
+            offset += size
+
+            # The queue overflowed, anything may have changed
+            if mask & IN_Q_OVERFLOW:
+                changes.add(self.root)
+                continue
+
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+
+            base = self.wds.get(wd)
+            if base is None:
+                continue
+
+            path = base
+            if len(name) > 0:
+                path = os.path.join(base, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and \
+                        (base != self.root or name not in self.prune):
+                    # out of watches (ENOSPC) or not readable (EACCES)
+                    try:
+                        changes |= self.add_tree(path)
+                    except OSError, e:
+                        changes |= self.poll_tree(path, e)
+                continue
+
+            changes.add(path)
+
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# Return the best watcher available for this system
+def watcher(root, prune=[], debounce=WATCH_DEBOUNCE):
+    try:
+        return InotifyWatcher(root, prune, debounce)
+    except (OSError, AttributeError, TypeError):
+        return PollWatcher(root, prune, debounce)